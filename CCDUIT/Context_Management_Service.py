@@ -807,11 +807,6 @@ def get_data_model_by_id(data_model_id):
     entity_url = f"{context_broker_url}/urn:ngsi-ld:DataModel:{data_model_id}"
 
     try:
-        # Fetch the context JSON from GitHub
-        context_response = requests.get(context_url)
-        context_response.raise_for_status()  # Raise an error if fetching fails
-        context_json = context_response.json()  # Parse the JSON content
-
         # Prepare headers for the GET request
         # headers = {
         #     "Accept": "application/ld+json",  # Request JSON-LD format
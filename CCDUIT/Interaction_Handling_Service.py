@@ -806,11 +806,6 @@ def get_interaction_by_id(interaction_id):
     entity_url = f"{context_broker_url}/urn:ngsi-ld:CommunityInteraction:{interaction_id}"
 
     try:
-        # Fetch the context JSON from GitHub
-        context_response = requests.get(context_url)
-        context_response.raise_for_status()  # Raise an error if fetching fails
-        context_json = context_response.json()  # Parse the JSON content
-
         response = requests.get(entity_url, headers=headersget)
         response.raise_for_status()  # Raise an exception for HTTP errors
 
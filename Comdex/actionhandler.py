@@ -16,27 +16,44 @@ import getopt
 import subprocess
 import time
 import threading
-import multiprocessing
 import re
+import uuid
 import ast
 import datetime
+import collections
 import shapely.geometry as shape_geo
-import urllib.request
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
 from getpass import getpass
-import paho.mqtt.client as mqtt
-from pickle import TRUE
+import mqttsession
+import codec
+from mqttsession import get_session
+from mirror import get_mirror, start_mirror
+from multiplexer import get_multiplexer
+from providercache import provider_cache, advertisement_view
+from contextcache import context_cache
+from ngsildquery import compile_query, QuerySyntaxError
+from geoquery import compile_geo_query, GeoQuerySyntaxError, geometry_types
+from sinks import PageSink, PrettyPrintSink, ListSink, DeduplicatingSink, make_sink, make_endpoint_sink
+from notifications import NotificationDispatcher
+from timeseries import query_temporal, parse_time
+from idsummary import IdSummary, may_hold
+from changefilter import change_filter
+import instrumentation
+import parallelreassembly
 
 #default values of mqtt broker to communicate with
 default_broker_address='localhost'
 default_broker_port=1026
 default_ngsild_context="https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld"
 
-#global advertisement flag (to avoid for now passing it in every function)
+#global advertisement flags (to avoid for now passing them in every function)
 singleidadvertisement=False
+#one advertisement per type carrying a summary of its entity ids (see idsummary.py)
+summaryadvertisement=False
 
 #TO DO convert these globals to nonlocals 
 #exists=False
-exists_topic=''
 full_data=''
 
 allow_anonymous   = True
@@ -149,24 +166,26 @@ def unlock_mosquitto():
 #- qos: The quality of service level for message delivery.
 #- my_loc: The location of the broker (used for advanced advertisements with geoqueries).
 #- bypass_existence_check (optional): Flag to bypass the existence check of the entity (default: 0).
-#- client (optional): MQTT client object (default: mqtt.Client(clean_session=True)).
-# Returns: None
-def post_entity(data,my_area,broker,port,qos,my_loc,bypass_existence_check=0,client=mqtt.Client(clean_session=True),username=None, password=None):
+#- client (optional): Session (or connected MQTT client) to publish with (default: the pooled session of the broker).
+# Returns: False if the entity is invalid or an entity with this id already exists, True otherwise.
+@instrumentation.instrumented("POST/entities")
+def post_entity(data,my_area,broker,port,qos,my_loc,bypass_existence_check=0,client=None,username=None, password=None):
     
 
     global singleidadvertisement
 
-    client.loop_start()     
+    if client is None:
+        client=get_session(broker,port,username,password)
     if 'type' in data:
         typee=str(data['type'])
     else:
         print("Error, ngsi-ld entity without a type \n")
-        sys.exit(2)
+        return False
     if 'id' in data:  
         id=str(data['id'])
     else:
         print("Error, ngsi-ld entity without a id \n")
-        sys.exit(2)
+        return False
     if '@context' in data:
         if( str(type(data["@context"]))=="<class 'str'>"):
             context=data['@context'].replace("/", "§")
@@ -177,7 +196,11 @@ def post_entity(data,my_area,broker,port,qos,my_loc,bypass_existence_check=0,cli
         
     else:    
         print("Error, ngsi-ld entity without context \n")
-        sys.exit(2)
+        return False
+    error=topic_level_error(id,[typee]+[k for k in data if k not in ('id','type','@context')])
+    if error is not None:
+        print(f"Error, {error}")
+        return False
     if 'location' in data:
         location=data['location'] 
     else:
@@ -191,33 +214,51 @@ def post_entity(data,my_area,broker,port,qos,my_loc,bypass_existence_check=0,cli
     print("Checking existence of entity...")
     
    
+    created=True
     if(bypass_existence_check==0):
-        if (check_existence(broker,port,check_topic,username=username,password=password)!=False):
+        if check_existence(broker,port,check_topic,username=username,password=password) is not None:
             print("Error entity with this id already exists, did you mean to patch?")
-            return
+            return False
+    elif summaryadvertisement and not singleidadvertisement:
+        # the id summary counts the entities an overwrite creates
+        created=check_existence(broker,port,check_topic,username=username,password=password) is None
 
     #check for remote existance maybe in the future
       
     ################### CREATE SMALL TOPICS!!!!!!!!!!!!!!!#######################
+    # one timestamp for the whole entity, also used by the advertisement when every attribute is skipped as unchanged
+    curr_time=str(datetime.datetime.now())
+    time_rels = { "createdAt": [curr_time],"modifiedAt": [curr_time] }
+    unchanged=0
     for key in data.items():
         if key[0]!="type" and key[0]!="id" and key[0]!='@context':
             
             small_topic=my_area+'/entities/'+context+'/'+typee+'/LNA/'+id+'/'+key[0]
             #print(small_topic)
+            # with --skip_unchanged an overwrite only publishes the attributes that changed (see changefilter.py)
+            if not change_filter.changed(broker,port,small_topic,key[1],force=bypass_existence_check==0):
+                unchanged+=1
+                continue
             print("Publishing message to subtopic")    
-            
-            client.publish(small_topic,str(key[1]),retain=True,qos=qos)
-            
-            curr_time=str(datetime.datetime.now())
-            time_rels = { "createdAt": [curr_time],"modifiedAt": [curr_time] }
 
-            small_topic=my_area+'/entities/'+context+'/'+typee+'/LNA/'+id+'/'+ key[0]+"_timerelsystem_CreatedAt"
+            with instrumentation.span('publish'):
+                if codec.temporal_layout=='envelope':
+                    # one retained topic per attribute, the temporal values travel inside it
+                    client.publish(small_topic,codec.encode(codec.wrap_attribute(key[1],time_rels["createdAt"],time_rels["modifiedAt"])),retain=True,qos=qos)
+                    continue
+
+                client.publish(small_topic,codec.encode(key[1]),retain=True,qos=qos)
+
+                small_topic=my_area+'/entities/'+context+'/'+typee+'/LNA/'+id+'/'+ key[0]+"_timerelsystem_CreatedAt"
                 
-            client.publish(small_topic,str(time_rels["createdAt"]),retain=True,qos=qos)
+                client.publish(small_topic,codec.encode(time_rels["createdAt"]),retain=True,qos=qos)
             
-            small_topic=my_area+'/entities/'+context+'/'+typee+'/LNA/'+id+'/'+ key[0]+"_timerelsystem_modifiedAt"
-            client.publish(small_topic,str(time_rels["modifiedAt"]),retain=True,qos=qos)     
+                small_topic=my_area+'/entities/'+context+'/'+typee+'/LNA/'+id+'/'+ key[0]+"_timerelsystem_modifiedAt"
+                client.publish(small_topic,codec.encode(time_rels["modifiedAt"]),retain=True,qos=qos)     
 
+    change_filter.save()
+    if unchanged:
+        print(f"Skipped {unchanged} unchanged attributes")
     ############################################################################
     check_topic2="provider/+/+/"+my_area+'/'+context+'/'+typee+'/'
     
@@ -227,19 +268,11 @@ def post_entity(data,my_area,broker,port,qos,my_loc,bypass_existence_check=0,cli
         special_context_provider_broadcast= 'provider/' + broker + '/' +str(port) + '/'+my_area+'/' + context + '/' +typee +'/'+id
         bypass_existence_check=1
     
-    if(bypass_existence_check==1):
-        print("Bypassing existence check for advertisement")
-        client.publish(special_context_provider_broadcast,"Provider Message: { CreatedAt:" + str(time_rels["createdAt"]) +",location:" + str(my_loc)+"}" ,retain=True,qos=2)
-        print(special_context_provider_broadcast) 
-    elif(check_existence(broker,port,special_context_provider_broadcast,username=username,password=password)==False):
-        print("checking existence of advertisement...")
-        info= client.publish(special_context_provider_broadcast,"Provider Message: { CreatedAt:" + str(time_rels["createdAt"]) +",location:" + str(my_loc)+"}" ,retain=True,qos=2)
-        # Check the result code
-        if info.rc == 0:
-            print("Publishing message to provider table")
-            print(special_context_provider_broadcast)     
-        else:
-            print(f"Failed to send publish request to {special_context_provider_broadcast}. Return code: {info.rc}")
+    # the advertisement is published once, and extended when the entity lies outside its bounding box
+    print("checking existence of advertisement...")
+    if advertise_provider(client,broker,port,special_context_provider_broadcast,my_loc,time_rels["createdAt"],entity_bbox([data]),username,password,ids=[id],new=[id] if created else []):
+        print("Publishing message to provider table")
+        print(special_context_provider_broadcast)
 
           
         #old logging of published messages
@@ -247,9 +280,7 @@ def post_entity(data,my_area,broker,port,qos,my_loc,bypass_existence_check=0,cli
         #handler = logging.FileHandler('logfile_advertisement_published.log')
         #logger.addHandler(handler)
         #logger.error(time.time_ns()/(10**6))
-
-           
-    client.loop_stop()
+    return True
 
 
 #Description: This function checks if an entity or advertisement already exists inside the broker.
@@ -258,47 +289,57 @@ def post_entity(data,my_area,broker,port,qos,my_loc,bypass_existence_check=0,cli
 #- port: The port number of the broker.
 #- topic: The topic name or identifier of the message to check.
 #Returns:
-#- True if the entity/advertisement exists in the broker, False otherwise.
+#- The topic of the first retained message found if the entity/advertisement exists in the broker, None otherwise.
+#  The caller reads the type, location and context of an existing entity from that topic.
 
+@instrumentation.timed('existence_check')
 def check_existence(broker,port,topic, username=None, password=None):
-    print("checking existence of topic: " + topic + " to the broker: " + broker + " on port: " + str(port) + "using username: " + str(username) + " and password: " + str(password))
-    run_flag=TRUE
-    exists=False
-    expires=1
-    def on_connect(client3, userdata, flags, rc):
-        print("Connected for existence check with result code "+str(rc))
+    print("checking existence of topic: " + topic + " to the broker: " + broker + " on port: " + str(port) + (" as user: " + str(username) if username else ""))
+    exists_topic=None
+
+    mirror=get_mirror(broker,port)
+    if mirror is not None:
+        hit=mirror.first_matching(topic)
+        return hit.topic if hit is not None else None
 
     # The callback for when a PUBLISH message is received from the server.
-    def on_message(client3, userdata, msg):
-        global exists_topic
-        nonlocal exists
-        nonlocal expires
-        exists=True
-        exists_topic=msg.topic
-        expires-=1
+    # The first retained hit answers the check, so the collection stops right away.
+    def on_message(msg):
+        nonlocal exists_topic
+        if msg.payload:
+            exists_topic=msg.topic
+            return True
     
-    client3 = mqtt.Client()   
-    client3.username_pw_set(username, password) if username and password else None
-    client3.on_connect = on_connect
-    client3.on_message = on_message
+    # Absence is only known once the retained snapshot of the topic is complete
+    collect_retained(broker, port, [topic], 1, on_message, username=username, password=password)
+    return exists_topic
 
-    
-    client3.connect(broker, port)
-    client3.loop_start()
-    client3.subscribe(topic,qos=1)
 
-    start=time.perf_counter()
-    try:
-        while run_flag:
-            tic_toc=time.perf_counter()
-            if (tic_toc-start) > expires:
-                run_flag=False
-    except:
-        pass
-    #time.sleep(1)
-    client3.loop_stop()  
-    #print(exists)
-    return exists    
+# Function: collect_retained
+# Description: This function collects the retained messages matching topic filters: from the resident mirror of the broker
+# when one is running (see mirror.py), otherwise from a retained replay of the broker over the pooled session.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - topics: A list of topic filters.
+#   - qos: The quality of service level of the subscriptions.
+#   - callback: Function called with every retained message, returning True to stop the collection.
+#   - quiet (optional): Quiet window of the retained replay in seconds.
+#   - timeout (optional): Upper bound of the retained replay in seconds.
+# Returns: True if the snapshot completed.
+
+@instrumentation.timed('retained_collection')
+def collect_retained(broker, port, topics, qos, callback, quiet=None, username=None, password=None, timeout=None):
+    # the messages are counted, and the callback (run by the network thread) is timed within the current operation
+    callback = instrumentation.observed(callback)
+    mirror = get_mirror(broker, port)
+    if mirror is not None:
+        for msg in mirror.messages_matching(topics):
+            if callback(msg):
+                break
+        return True
+    session = get_session(broker, port, username, password)
+    return session.collect_retained(topics, qos, callback, quiet=quiet, timeout=timeout)
 
 
 # Function: GET
@@ -307,21 +348,20 @@ def check_existence(broker,port,topic, username=None, password=None):
 #   - broker: The name or IP address of the broker.
 #   - port: The port number of the broker.
 #   - topics: A list of topics to subscribe to.
-#   - expires: The expiration time in seconds.
+#   - expires: Quiet window in seconds, the retained snapshot is complete once no message arrived for this long
+#     (only relied upon when the broker does not answer the completion marker, see Session.collect_retained).
 #   - qos: The quality of service level for message delivery.
 #   - limit (optional): The maximum number of entities to retrieve (default: 2000).
 # Returns:
 #   - A list of received messages (entities) ordered via their id.
 
 def GET(broker, port, topics, expires, qos, limit=2000,username=None, password=None):
-    run_flag = True
     messagez = []
     messages_by_id = {}
 
     # The callback for when a PUBLISH message is received from the server.
-    def on_message(client, userdata, msg):
+    def on_message(msg):
         nonlocal messagez
-        nonlocal expires
         nonlocal messages_by_id
         nonlocal limit
         if msg.retain == 1:
@@ -329,34 +369,12 @@ def GET(broker, port, topics, expires, qos, limit=2000,username=None, password=N
             id = initial_topic[-2]
             messages_by_id.setdefault(id, []).append(msg)
             if len(messages_by_id) == limit + 1:
-                expires -= 10000000
-            else:
-                messagez.append(msg)
-                expires += 0.5
-
-    # Create an MQTT client
-    client = mqtt.Client()
-    client.username_pw_set(username, password) if username and password else None
-    client.on_message = on_message
-    client.connect(broker, port)
-
-    client.loop_start()
-
-    # Subscribe to the specified topics
-    for topic in topics:
-        client.subscribe(topic, qos)
-
-    start = time.perf_counter()
-
-    try:
-        while run_flag:
-            tic_toc = time.perf_counter()
-            if tic_toc - start > expires:
-                run_flag = False
-    except:
-        pass
+                # pagination limit reached, stop collecting
+                return True
+            messagez.append(msg)
 
-    client.loop_stop()
+    # Reuse the pooled connection of the broker (or its mirror) and block until the retained snapshot is complete
+    collect_retained(broker, port, topics, qos, on_message, expires, username, password)
 
     # Return the received messages (entities)
     return messagez
@@ -376,11 +394,11 @@ def GET(broker, port, topics, expires, qos, limit=2000,username=None, password=N
 #   - coordinates: Coordinates for the geospatial condition (optional, default: '').
 #   - geoproperty: Geospatial property for the geospatial condition (optional, default: '').
 #   - context_given: Context value for entity comparison (optional, default: '').
-# Returns: None
+#   - sink: Sink receiving the recreated entity (optional, default: None, print it as indented JSON).
+# Returns:
+#   - The recreated entity if it passed the query conditions, None otherwise.
 
-def recreate_single_entity(messagez, query='', topics='', timee='', georel='', geometry='', coordinates='', geoproperty='', context_given=''):
-    query_flag_passed = False
-    subqueries_flags = {}
+def recreate_single_entity(messagez, query='', topics='', timee='', georel='', geometry='', coordinates='', geoproperty='', context_given='', sink=None):
     default_context = "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld"
 
     # Extract initial topic information
@@ -403,301 +421,74 @@ def recreate_single_entity(messagez, query='', topics='', timee='', georel='', g
     data['type'] = typee
 
     # Check if a specific context is given for comparison
+    # (term definitions come from the local context cache, not from a download per entity)
     if context_given == '+':
-        with urllib.request.urlopen(context_text) as url:
-            data_from_web = json.loads(url.read().decode())
-        try:
-            data['type'] = data_from_web["@context"][typee]
-        except:
-            dummy_command = "This is a dummy command for except"
-
-    if query == '':
-        for msg in messagez:
-            attr_str = msg.payload
-            attr_str = attr_str.decode(encoding='UTF-8', errors='strict')
-            attr_str = attr_str.replace("\'", "\"")
-            data2 = json.loads(attr_str)
-            topic = (msg.topic).split('/')
-
-            # Check geospatial condition if specified
-            if georel != '':
-                if topic[-1] == geoproperty:
-                    geo_type = str(data2["value"]["type"])
-                    geo_coord = str(data2["value"]["coordinates"])
-                    geo_ok = 0
-
-                    geo_type = geo_type.replace(" ", "")
-                    geo_coord = geo_coord.replace(" ", "")
-                    coordinates = coordinates.replace(" ", "")
-
-                    geo_entity = shape_geo.shape((data2["value"]))
-
-                    if geometry == "Point":
-                        query_gjson = shape_geo.Point(json.loads(coordinates))
-                    elif geometry == "LineString":
-                        query_gjson = shape_geo.LineString(json.loads(coordinates))
-                    elif geometry == "Polygon":
-                        query_gjson = shape_geo.Polygon(json.loads(coordinates))
-                    elif geometry == "MultiPoint":
-                        query_gjson = shape_geo.MultiPoint(json.loads(coordinates))
-                    elif geometry == "MultiLineString":
-                        query_gjson = shape_geo.MultiLineString(json.loads(coordinates))
-                    elif geometry == "MultiPolygon":
-                        query_gjson = shape_geo.MultiPolygon(json.loads(coordinates))
-
-                    # Check specific georelation condition
-                    if georel == "equals":
-                        if geo_entity.equals(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-                    elif georel == "within":
-                        if geo_entity.within(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-                    elif georel == "intersects":
-                        if geo_entity.intersects(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-                    elif re.search("near;", georel):
-                        near_query = georel.split(';')
-                        near_operator = re.findall('[><]|==|>=|<=', near_query[1])
-                        near_geo_queries = (re.split('[><]|==|>=|<=', near_query[1]))
-
-                        if str(near_geo_queries[0]) == "maxDistance":
-                            if str(near_operator[0]) == "==":
-                                if geo_entity.distance(query_gjson) > float(near_geo_queries[1]):
-                                    return
-                        elif str(near_geo_queries[0]) == "minDistance":
-                            if str(near_operator[0]) == "==":
-                                if geo_entity.distance(query_gjson) < float(near_geo_queries[1]):
-                                    return
-                    elif georel == "contains":
-                        if geo_entity.contains(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-                    elif georel == "disjoint":
-                        if geo_entity.disjoint(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-                    elif georel == "overlaps":
-                        if geo_entity.overlaps(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-
-            # Check topic filters if specified
-            if topics != '' and topics != "#":
-                if topic[-1] in topics:
-                    data[topic[-1]] = data2
-                if topic[-1].endswith("_CreatedAt") or topic[-1].endswith("_modifiedAt"):
-                    if timee != '':
-                        time_topic = (topic[-1].split('_timerelsystem_'))
-                        if context_given == '+':
-                            try:
-                                time_topic[-2] = data_from_web["@context"][time_topic[-2]]
-                            except:
-                                dummy_command = "This is a dummy command for except"
-
+        context_terms = context_cache.terms(context_text)
+        data['type'] = context_terms.get(typee, typee)
+
+    # The query is parsed once per GET (compile_query is cached) and evaluated on the attributes of the entity
+    if query != '':
+        query_predicate = compile_query(query)
+    attributes = {}
+
+    for msg in messagez:
+        # attributes stored in the 'envelope' temporal layout carry their createdAt/modifiedAt values
+        data2, temporal = codec.unwrap_attribute(codec.decode_message(msg))
+        topic = (msg.topic).split('/')
+
+        # Check geospatial condition if specified (the query geometry is built and prepared once per GET)
+        if georel != '':
+            if topic[-1] == geoproperty:
+                geo_entity = shape_geo.shape((data2["value"]))
+                if not compile_geo_query(georel, geometry, coordinates).matches(geo_entity):
+                    return
+
+        if not (topic[-1].endswith("_CreatedAt") or topic[-1].endswith("_modifiedAt")):
+            # Every attribute takes part in the query, even the ones left out by the attrs projection
+            attributes[topic[-1]] = data2
+
+        # Check topic filters if specified
+        if topics != '' and topics != "#":
+            if topic[-1] in topics:
+                data[topic[-1]] = data2
+            if topic[-1].endswith("_CreatedAt") or topic[-1].endswith("_modifiedAt"):
+                if timee != '':
+                    time_topic = (topic[-1].split('_timerelsystem_'))
+                    if context_given == '+':
+                        time_topic[-2] = context_terms.get(time_topic[-2], time_topic[-2])
+
+                    if time_topic[-2] in data:
                         data[time_topic[-2]][time_topic[-1]] = data2
 
-            else:
-                if topic[-1].endswith("_CreatedAt") or topic[-1].endswith("_modifiedAt"):
-                    if timee != '':
-                        time_topic = (topic[-1].split('_timerelsystem_'))
-                        if context_given == '+':
-                            try:
-                                time_topic[-2] = data_from_web["@context"][time_topic[-2]]
-                            except:
-                                dummy_command = "This is a dummy command for except"
+        else:
+            if topic[-1].endswith("_CreatedAt") or topic[-1].endswith("_modifiedAt"):
+                if timee != '':
+                    time_topic = (topic[-1].split('_timerelsystem_'))
+                    if context_given == '+':
+                        time_topic[-2] = context_terms.get(time_topic[-2], time_topic[-2])
 
+                    if time_topic[-2] in data:
                         data[time_topic[-2]][time_topic[-1]] = data2
-                else:
-                    data[topic[-1]] = data2
-
-        data['@context'] = contextt
-
-        json_data = json.dumps(data, indent=4, ensure_ascii=False)
-        print(json_data)
+            else:
+                data[topic[-1]] = data2
 
-    elif query != '':
-        logical_operators = re.findall('[;|()]', query)
-        queries_big = re.split(('[;|()]'), query)
-
-        for msg in messagez:
-            attr_str = msg.payload
-            attr_str = attr_str.decode(encoding='UTF-8', errors='strict')
-            attr_str = attr_str.replace("\'", "\"")
-            data2 = json.loads(attr_str)
-            topic = (msg.topic).split('/')
-
-            # Check geospatial condition if specified
-            if georel != '':
-                if topic[-1] == geoproperty:
-                    geo_type = str(data2["value"]["type"])
-                    geo_coord = str(data2["value"]["coordinates"])
-                    geo_ok = 0
-
-                    geo_type = geo_type.replace(" ", "")
-                    geo_coord = geo_coord.replace(" ", "")
-                    coordinates = coordinates.replace(" ", "")
-
-                    geo_entity = shape_geo.shape((data2["value"]))
-
-                    if geometry == "Point":
-                        query_gjson = shape_geo.Point(json.loads(coordinates))
-                    elif geometry == "LineString":
-                        query_gjson = shape_geo.LineString(json.loads(coordinates))
-                    elif geometry == "Polygon":
-                        query_gjson = shape_geo.Polygon(json.loads(coordinates))
-                    elif geometry == "MultiPoint":
-                        query_gjson = shape_geo.MultiPoint(json.loads(coordinates))
-                    elif geometry == "MultiLineString":
-                        query_gjson = shape_geo.MultiLineString(json.loads(coordinates))
-                    elif geometry == "MultiPolygon":
-                        query_gjson = shape_geo.MultiPolygon(json.loads(coordinates))
-
-                    # Check specific georelation condition
-                    if georel == "equals":
-                        if geo_entity.equals(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-                    elif georel == "within":
-                        if geo_entity.within(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-                    elif georel == "intersects":
-                        if geo_entity.intersects(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-                    elif re.search("near;", georel):
-                        near_query = georel.split(';')
-                        near_operator = re.findall('[><]|==|>=|<=', near_query[1])
-                        near_geo_queries = (re.split('[><]|==|>=|<=', near_query[1]))
-
-                        if str(near_geo_queries[0]) == "maxDistance":
-                            if str(near_operator[0]) == "==":
-                                if geo_entity.distance(query_gjson) > float(near_geo_queries[1]):
-                                    return
-                        elif str(near_geo_queries[0]) == "minDistance":
-                            if str(near_operator[0]) == "==":
-                                if geo_entity.distance(query_gjson) < float(near_geo_queries[1]):
-                                    return
-                    elif georel == "contains":
-                        if geo_entity.contains(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-                    elif georel == "disjoint":
-                        if geo_entity.disjoint(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-                    elif georel == "overlaps":
-                        if geo_entity.overlaps(query_gjson):
-                            geo_ok = 1
-                        else:
-                            return
-
-            # Allowing combination of logical queries
-            for query2 in queries_big:
-                operator = re.findall('[><]|==|>=|<=', query2)
-                queries = (re.split('[><]|==|>=|<=', query2))
-                subqueries_flags.setdefault(queries[0], False)
-
-                if queries[0] == topic[-1]:
-
-                    if str(operator[0]) == "==":
-
-                        if isinstance(data2["value"], list):
-                            for data3 in data2["value"]:
-                                if data3 == queries[1]:
-                                    subqueries_flags[queries[0]] = True
-
-                        elif data2["value"] == queries[1]:
-                            subqueries_flags[queries[0]] = True
-                    elif queries[1].isnumeric():
-                        if str(operator[0]) == ">":
-                            if float(data2["value"]) > float(queries[1]):
-                                subqueries_flags[queries[0]] = True
-                        elif str(operator[0]) == "<":
-                            if float(data2["value"]) < float(queries[1]):
-                                subqueries_flags[queries[0]] = True
-                        elif str(operator[0]) == "<=":
-                            if float(data2["value"]) <= float(queries[1]):
-                                subqueries_flags[queries[0]] = True
-                        elif str(operator[0]) == ">=":
-                            if float(data2["value"]) >= float(queries[1]):
-                                subqueries_flags[queries[0]] = True
-
-            # Check topic filters if specified
-            if topics != '' and topics != "#":
-                if topic[-1] in topics:
-                    data[topic[-1]] = data2
-                if topic[-1].endswith("_CreatedAt") or topic[-1].endswith("_modifiedAt"):
-                    if timee != '':
-                        time_topic = (topic[-1].split('_timerelsystem_'))
-                        if context_given == '+':
-                            try:
-                                time_topic[-2] = data_from_web["@context"][time_topic[-2]]
-                            except:
-                                dummy_command = "This is a dummy command for except"
+        if temporal is not None and timee != '' and isinstance(data.get(topic[-1]), dict):
+            for name, value in temporal.items():
+                data[topic[-1]][codec.temporal_names.get(name, name)] = value
 
-                        data[time_topic[-2]][time_topic[-1]] = data2
+    if query != '' and not query_predicate(attributes):
+        return None
 
-            else:
-                if topic[-1].endswith("_CreatedAt") or topic[-1].endswith("_modifiedAt"):
-                    if timee != '':
-                        time_topic = (topic[-1].split('_timerelsystem_'))
-                        if context_given == '+':
-                            try:
-                                time_topic[-2] = data_from_web["@context"][time_topic[-2]]
-                            except:
-                                dummy_command = "This is a dummy command for except"
-
-                        data[time_topic[-2]][time_topic[-1]] = data2
-                else:
-                    data[topic[-1]] = data2
-
-        data['@context'] = contextt
-
-        l = 0
-        full_logical_equation = []
-        subqueries_flags.pop('', None)
-        for results in subqueries_flags.values():
-            full_logical_equation.append(str(results))
-            if l < (len(logical_operators)):
-                if logical_operators[l] != '':
-                    if logical_operators[l] == ";":
-                        full_logical_equation.append('and')
-                    elif logical_operators[l] == "|":
-                        full_logical_equation.append('or')
-                    else:
-                        full_logical_equation.append(logical_operators[l])
-                    if l + 1 < (len(logical_operators) - 1):
-                        while logical_operators[l + 1] != ';' and logical_operators[l + 1] != '|':
-                            l = l + 1
-                            full_logical_equation.append(logical_operators[l])
-
-            l = l + 1
-
-        query_flag_passed = eval(' '.join(full_logical_equation))
-        if query_flag_passed == True:
-            json_data = json.dumps(data, indent=4, ensure_ascii=False)
-            print(json_data)
-        
-                 
+    data['@context'] = contextt
 
+    if sink is None:
+        json_data = json.dumps(data, indent=4, ensure_ascii=False)
+        print(json_data)
+    else:
+        sink.emit(data)
+    return data
 
 
-        
 # Function: recreate_multiple_entities
 # Description: This function recreates multiple entities from the received messages based on the specified query conditions. It basically calls the 
 # recreate single entity command, over a list of MQTT messages, based on their id.
@@ -712,31 +503,217 @@ def recreate_single_entity(messagez, query='', topics='', timee='', georel='', g
 #   - coordinates: Coordinates for the geospatial condition (optional, default: '').
 #   - geoproperty: Geospatial property for the geospatial condition (optional, default: '').
 #   - context_given: Context value for entity comparison (optional, default: '').
-# Returns: None
+#   - sink: Sink receiving the recreated entities (optional, default: None, print them as indented JSON).
+# Returns:
+#   - A list of the recreated entities that passed the query conditions. With reassembly workers and at least
+#     parallelreassembly.min_messages messages, the entities are rebuilt by the worker processes and come in id order.
+
+def recreate_multiple_entities(messagez, query='', topics='', timee='', limit=2000, georel='', geometry='', coordinates='', geoproperty='', context_given='', sink=None):
+    if parallelreassembly.workers > 0 and len(messagez) >= parallelreassembly.min_messages:
+        entities = parallelreassembly.recreate(messagez, query, topics, timee, georel, geometry, coordinates, geoproperty, context_given)
+        if limit < len(entities):
+            entities = entities[:max(0, int(limit))]
+        for entity in entities:
+            if sink is None:
+                print(json.dumps(entity, indent=4, ensure_ascii=False))
+            else:
+                sink.emit(entity)
+        return entities
 
-def recreate_multiple_entities(messagez, query='', topics='', timee='', limit=2000, georel='', geometry='', coordinates='', geoproperty='', context_given=''):
     messages_by_id = {}
+    entities = []
+    located = {}
 
     # Separate each message by ID to recreate using the recreate_single_entity function
     for message in messagez:
         initial_topic = (message.topic).split('/')
         id = initial_topic[-2]
         messages_by_id.setdefault(id, []).append(message)
+        if georel != '' and initial_topic[-1] == geoproperty:
+            located[id] = message
+
+    # Answer the geo-query for all entities at once: their geometries are bulk-loaded into an STRtree
+    # and only the index candidates are tested against the prepared query geometry
+    if georel != '':
+        ids = list(located)
+        geometries = []
+        for id in ids:
+            geometries.append(shape_geo.shape(codec.unwrap_attribute(codec.decode_message(located[id]))[0]["value"]))
+        matching = compile_geo_query(georel, geometry, coordinates).filter(geometries)
+        messages_by_id = {ids[i]: messages_by_id[ids[i]] for i in matching}
+        georel = ''
 
     # Iterate over single entities and recreate them using recreate_single_entity function
     for single_entities in messages_by_id.values():
-        recreate_single_entity(single_entities, query, topics, timee, georel, geometry, coordinates, geoproperty, context_given)
+        entity = recreate_single_entity(single_entities, query, topics, timee, georel, geometry, coordinates, geoproperty, context_given, sink)
+        if entity is not None:
+            entities.append(entity)
 
         # Countdown pagination limit
         limit = limit - 1
         if limit == 0:
             break
 
+    return entities
+
 
 
 
         
 
+# Class: EntityReassembler
+# Description: Reassembles entities while their retained attribute messages arrive. The broker replays the retained messages
+# of a wildcard subscription in topic order, so the attributes of an entity arrive back to back: as soon as a message of
+# another id shows up the previous entity is complete and is handed over, and only the entity being received is kept in
+# memory. With several topic filters (attrs projections) the attributes of an id are spread over the replays of the
+# filters, so entities are only complete once the whole snapshot is.
+# Parameters:
+#   - on_entities: Function called with a list of complete entities (each one a list of its messages). If it returns True
+#     the reassembly is over (e.g. the pagination limit was reached).
+#   - contiguous (optional): Whether the attributes of an entity arrive back to back (default: True).
+#   - batch_size (optional): Number of complete entities handed over at once (default: 1).
+
+class EntityReassembler:
+
+    def __init__(self, on_entities, contiguous=True, batch_size=1):
+        self.on_entities = on_entities
+        self.contiguous = contiguous
+        self.batch_size = batch_size
+        self.current_id = None
+        self.open_entities = {}
+        self.completed_ids = set()
+        self.complete = []
+
+    # Function: add
+    # Description: Adds a retained attribute message.
+    # Returns: True once the reassembly is over.
+    def add(self, msg):
+        id = msg.topic.split('/')[-2]
+        if id in self.completed_ids:
+            # replayed again, e.g. by an overlapping subscription
+            return False
+        if self.contiguous and self.current_id is not None and id != self.current_id:
+            self._complete(self.current_id)
+        self.current_id = id
+        self.open_entities.setdefault(id, []).append(msg)
+        return self._hand_over(self.batch_size)
+
+    # Function: finish
+    # Description: Hands over every entity still being received, to be called once the retained snapshot is complete.
+    # Returns: True once the reassembly is over.
+    def finish(self):
+        for id in list(self.open_entities):
+            self._complete(id)
+        return self._hand_over(1)
+
+    def _complete(self, id):
+        messages = self.open_entities.pop(id, None)
+        if messages:
+            self.completed_ids.add(id)
+            self.complete.append(messages)
+
+    def _hand_over(self, batch_size):
+        if len(self.complete) < batch_size:
+            return False
+        batch, self.complete = self.complete, []
+        return bool(self.on_entities(batch))
+
+
+# Function: stream_entities
+# Description: This function retrieves entities like GET, but reassembles and filters every entity while the retained snapshot
+# is still arriving and delivers it to a sink right away. A large GET therefore runs in bounded memory and the first result
+# is available after milliseconds instead of after the full scan. Geo-queries are answered in batches of geo_batch_size
+# entities, so they keep the STRtree pruning of recreate_multiple_entities. With reassembly workers (see
+# parallelreassembly.py) the complete entities are handed to the worker processes in batches of
+# parallelreassembly.batch_entities while the snapshot keeps arriving, and the entities of each batch are delivered in
+# id order.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - topics: A list of topics to subscribe to.
+#   - qos: The quality of service level for message delivery.
+#   - sink: Sink receiving the entities (see sinks.py).
+#   - limit (optional): The maximum number of entities to deliver (default: 2000).
+#   - query, attrs, timee, georel, geometry, coordinates, geoproperty, context_given (optional): As in recreate_multiple_entities.
+#   - expires (optional): Quiet window of the retained snapshot in seconds (default: 0.5).
+#   - stop (optional): threading.Event ending the retrieval early when set (e.g. a merged limit was reached elsewhere).
+#   - timeout (optional): Upper bound of the retrieval in seconds (default: mqttsession.default_collect_timeout).
+#   - ids (optional): Set of entity ids, the messages of other entities are ignored (default: None, every entity).
+# Returns:
+#   - The number of entities delivered to the sink.
+
+geo_batch_size=1000
+
+def stream_entities(broker, port, topics, qos, sink, limit=2000, query='', attrs='#', timee='', georel='', geometry='', coordinates='', geoproperty='', context_given='', expires=0.5, username=None, password=None, stop=None, timeout=None, ids=None):
+    delivered = 0
+    lock = threading.Lock()
+
+    parallel = parallelreassembly.workers > 0
+    # batches handed to the worker processes and not delivered yet, oldest first
+    pending = collections.deque()
+
+    def on_entities(batch):
+        with instrumentation.span('filter'):
+            if parallel:
+                pending.append(parallelreassembly.submit([msg for messages in batch for msg in messages], query, attrs, timee, georel, geometry, coordinates, geoproperty, context_given))
+                # deliver the batches already reassembled, and wait for the oldest ones while too many are queued
+                return deliver(lambda: len(pending) > 2 * parallelreassembly.workers)
+            return filter_entities(batch)
+
+    def deliver(wait):
+        nonlocal delivered
+        while pending and delivered < limit and (pending[0].done() or wait()):
+            for entity in pending.popleft().result():
+                sink.emit(entity)
+                delivered += 1
+                if delivered >= limit:
+                    break
+        return delivered >= limit or (stop is not None and stop.is_set())
+
+    def filter_entities(batch):
+        nonlocal delivered
+        if georel != '':
+            messagez = [msg for messages in batch for msg in messages]
+            delivered += len(recreate_multiple_entities(messagez, query, attrs, timee, limit - delivered, georel, geometry, coordinates, geoproperty, context_given, sink))
+        else:
+            for messages in batch:
+                if recreate_single_entity(messages, query, attrs, timee, context_given=context_given, sink=sink) is not None:
+                    delivered += 1
+                    if delivered >= limit:
+                        break
+        return delivered >= limit or (stop is not None and stop.is_set())
+
+    if parallel:
+        batch_size = parallelreassembly.batch_entities
+    else:
+        batch_size = geo_batch_size if georel != '' else 1
+    reassembler = EntityReassembler(on_entities, contiguous=len(topics) == 1, batch_size=batch_size)
+    done = False
+
+    def on_message(msg):
+        nonlocal done
+        if msg.retain == 1 and (ids is None or msg.topic.split('/')[-2] in ids):
+            with lock, instrumentation.span('reassembly'):
+                if not done:
+                    done = reassembler.add(msg)
+                return done
+
+    try:
+        collect_retained(broker, port, topics, qos, on_message, expires, username, password, timeout)
+        with lock, instrumentation.span('reassembly'):
+            if not done:
+                done = reassembler.finish()
+            if parallel and not done:
+                with instrumentation.span('filter'):
+                    deliver(lambda: True)
+    finally:
+        with lock:
+            for reassembly in pending:
+                reassembly.cancel()
+            pending.clear()
+    return delivered
+
+
 # Function: multiple_subscriptions
 # Description: This function sets up multiple subscriptions based on the specified flags and parameters.
 # Parameters:
@@ -755,6 +732,29 @@ def recreate_multiple_entities(messagez, query='', topics='', timee='', limit=20
 # Returns: None
 
 def multiple_subscriptions(entity_type_flag, watched_attributes_flag, entity_id_flag, area, context, truetype, true_id, expires, broker, port, qos, watched_attributes):
+    topic = subscription_topics(entity_type_flag, watched_attributes_flag, entity_id_flag, area, context, truetype, true_id, watched_attributes)
+    if not topic:
+        print("Something has gone wrong, program did not find the topics to subscribe to!")
+        sys.exit(2)
+    
+    # Call the subscribe function with the generated topics
+    subscribe(broker, port, topic, expires, qos, context_given=context)
+
+
+# Function: subscription_topics
+# Description: This function builds the entity topics a subscription listens to on one context provider.
+# Parameters:
+#   - entity_type_flag: Flag indicating whether entity type is specified.
+#   - watched_attributes_flag: Flag indicating whether watched attributes are specified.
+#   - entity_id_flag: Flag indicating whether entity ID is specified.
+#   - area: Area of the context provider.
+#   - context: Context of the subscription.
+#   - truetype: Entity type value for the subscriptions.
+#   - true_id: Entity ID value for the subscriptions.
+#   - watched_attributes: List of watched attributes for the subscriptions.
+# Returns: List of topic filters (empty if no flag is set).
+
+def subscription_topics(entity_type_flag, watched_attributes_flag, entity_id_flag, area, context, truetype, true_id, watched_attributes):
     topic = []
     
     if entity_type_flag and watched_attributes_flag and entity_id_flag:
@@ -789,14 +789,70 @@ def multiple_subscriptions(entity_type_flag, watched_attributes_flag, entity_id_
         for attr in watched_attributes:
             topic.append(area + '/entities/' + context + '/+/+/+/' + attr)
     
-    else:
-        print("Something has gone wrong, program did not find the topics to subscribe to!")
-        sys.exit(2)
-    
-    # Call the subscribe function with the generated topics
-    subscribe(broker, port, topic, expires, qos, context_given=context)
-    
+    return topic
+
+
+# Function: read_credentials
+# Description: This function looks up the MQTT credentials of a broker in passwd_mapping.txt
+# (lines of the form "address:port username password").
+# Parameters:
+#   - broker_address: MQTT broker address.
+#   - port: MQTT broker port.
+# Returns: A (username, password) tuple, (None, None) if the broker is not listed.
+
+def read_credentials(broker_address, port):
+    try:
+        with open('passwd_mapping.txt', 'r') as f:
+            for line in f:
+                parts = line.strip().split()
+                if len(parts) != 3:
+                    continue
+                addr_port, username, password = parts
+                addr, prt = addr_port.split(':')
+                if addr == broker_address and int(prt) == int(port):
+                    return username, password
+    except FileNotFoundError:
+        print("Error: passwd_mapping.txt file not found.")
+    return None, None
+
+
+# Function: notification_handler
+# Description: This function returns the callback that turns the attribute messages of a subscription into notifications.
+# Parameters:
+#   - context_given: Context value for entity comparison.
+#   - dispatcher (optional): NotificationDispatcher coalescing the messages into notifications (default: None, print one
+#     entity per attribute message).
+# Returns: A function taking a received message.
+
+def notification_handler(context_given, dispatcher=None):
+    if dispatcher is not None:
+        return dispatcher.handler(context_given)
+
+    def on_message(msg):
+        if msg.payload:
+            messagez = []
+            messagez.append(msg)
+            if msg.topic.endswith("_CreatedAt") or msg.topic.endswith("_modifiedAt"):
+                # Do nothing for special system time topics (ignore them, no temporal subscriptions)
+                do_nothing = 1
+            else:
+                # Recreate single entity based on the received message
+                recreate_single_entity(messagez, timee=0, context_given=context_given)
+        else:
+            print("\n Message on topic:" + msg.topic + ", was deleted")
 
+    return on_message
+
+
+# Function: notification_entity
+# Description: This function builds the entity of a notification from the coalesced attribute messages of one entity.
+# Parameters:
+#   - messagez: The latest attribute messages of the entity.
+#   - context_given: Context value for entity comparison.
+# Returns: The entity.
+
+def notification_entity(messagez, context_given):
+    return recreate_single_entity(messagez, timee=0, context_given=context_given, sink=ListSink())
 
 
 # Function: subscribe
@@ -811,124 +867,51 @@ def multiple_subscriptions(entity_type_flag, watched_attributes_flag, entity_id_
 # Returns: None
 
 def subscribe(broker, port, topics, expires, qos, context_given):
-    run_flag = True
-    
-    def read_credentials(broker_address, port):
-        try:
-            with open('passwd_mapping.txt', 'r') as f:
-                for line in f:
-                    parts = line.strip().split()
-                    if len(parts) != 3:
-                        continue
-                    addr_port, username, password = parts
-                    addr, prt = addr_port.split(':')
-                    if addr == broker_address and int(prt) == port:
-                        return username, password
-        except FileNotFoundError:
-            print("Error: passwd_mapping.txt file not found.")
-        return None, None
-
-    def on_connect(client, userdata, flags, rc):
-        if rc == 0:
-            print("Connected successfully.")
-        else:
-            print(f"Connection failed with return code {rc}")
 
     def connect_with_logic(broker_address, port):
-        client = mqtt.Client() 
-
         username, password = read_credentials(broker_address, port)
 
         if username and password:
-            client.username_pw_set(username, password)
             print(f"Trying to connect to {broker_address}:{port} with credentials from file...")
             try:
-                client.connect(broker_address, port)
-                client.loop_start()
-                return client
-            except Exception as e:
+                return get_session(broker_address, port, username, password)
+            except ConnectionError as e:
                 print(f"Error: Connection with credentials failed. Details: {e}")
                 return None
         else:
             print(f"No credentials found in file for {broker_address}:{port}. Trying anonymous connection...")
             try:
-                client.connect(broker_address, port)
-                client.loop_start()
-                return client
-            except Exception as e:
+                return get_session(broker_address, port)
+            except ConnectionError as e:
                 print(f"Anonymous connection also failed. Please provide credentials in passwd_mapping.txt.")
                 return None
 
-
-
-    # # The callback for when the client receives a CONNACK response from the server.
-    # def on_connect(client, userdata, flags, rc):
-    #     print("Connected with result code " + str(rc))
-
-    # The callback for when a PUBLISH message is received from the server.
-    def on_message(client, userdata, msg):
-        # Perform operations on received message
-        if msg.payload.decode() != '':
-            stamp = time.time_ns() / (10 ** 6)
-            initial_topic = (msg.topic).split('/')
-            ids = initial_topic[-2]
-            tmp = msg.payload
-            attr_str = msg.payload.decode(encoding='UTF-8', errors='strict')
-            attr_str = attr_str.replace("\'", "\"")
-            data2 = json.loads(attr_str)
-
-            #Older logging messages for experiments
-            # Logging the message arrival time difference
-            #handler = logging.FileHandler('logfile_mqtt_notification_arrived.log')
-            # logger.addHandler(handler)
-            # logger.error(str(stamp - float(data2["value"])))
-
-        if msg.payload.decode() != '':
-            messagez = []
-            messagez.append(msg)
-            if msg.topic.endswith("_CreatedAt") or msg.topic.endswith("_modifiedAt"):
-                # Do nothing for special system time topics (ignore them, no temporal subscriptions)
-                do_nothing = 1
-            else:
-                # Recreate single entity based on the received message
-                recreate_single_entity(messagez, timee=0, context_given=context_given)
-        else:
-            print("\n Message on topic:" + msg.topic + ", was deleted")
-
-    client = connect_with_logic(broker, port)
-    if client is None:
+    session = connect_with_logic(broker, port)
+    if session is None:
         print("Failed to connect to the broker. Exiting...")
         return
-    
-    client.on_message = on_message
-
-    # Connect to MQTT broker
-    client.connect(broker, port, keepalive=expires)
 
-    client.loop_start()
+    on_message = notification_handler(context_given)
+    handlers = []
     for topic in topics:
-        client.subscribe(topic, qos)
+        handlers.append(session.subscribe(topic, qos, on_message))
         #print("Subscribing to topic: " +topic)
 
-    start = time.perf_counter()
-
+    # Block (without spinning) until the subscriptions expire
     try:
-        while run_flag:
-            tic_toc = time.perf_counter()
-            if (tic_toc - start) > expires:
-                run_flag = False
+        threading.Event().wait(expires)
     except:
         pass
 
     print("Subscriptions expired, exiting.....")
-    # Blocking call that processes network traffic, dispatches callbacks and handles reconnecting.
-    # Other loop*() functions are available that give a threaded interface and a manual interface.
-    client.loop_stop()
+    for handler in handlers:
+        session.unsubscribe(handler)
 
 # Function: subscribe_for_advertisement_notification
 # Description: This function sets up subscriptions for advertisement notifications based on the specified flags and parameters, basically to
 # find if a new advertisement of interest arrives while an intersted subscriber is active (so that the subscriber while also connect to the
-# new advertised source "on the fly").
+# new advertised source "on the fly"). The provider subscriptions are routes of the process-wide subscription multiplexer: a new
+# advertisement subscribes to the provider's entity topics over a shared connection, a deleted one unsubscribes them.
 # Parameters:
 #   - broker: MQTT broker address.
 #   - port: MQTT broker port.
@@ -940,181 +923,1425 @@ def subscribe(broker, port, topics, expires, qos, context_given):
 #   - entity_id_flag: Flag indicating whether entity ID is specified.
 #   - watched_attributes: List of watched attributes for the subscriptions.
 #   - true_id: Entity ID value for the subscriptions.
+#   - dispatcher (optional): NotificationDispatcher delivering the notifications (see notification_handler).
+#   - stop (optional): A threading.Event ending the subscriptions before they expire.
 # Returns: None
 
-def subscribe_for_advertisement_notification(broker, port, topics, expires, qos, entity_type_flag, watched_attributes_flag, entity_id_flag, watched_attributes, true_id,username=None, password=None):
-    run_flag = True
+def subscribe_for_advertisement_notification(broker, port, topics, expires, qos, entity_type_flag, watched_attributes_flag, entity_id_flag, watched_attributes, true_id,username=None, password=None, dispatcher=None, stop=None):
+    multiplexer = get_multiplexer()
+    # routes of this subscription, keyed by advertisement
+    subscription_key = uuid.uuid4().hex
     advertisement_exists = {}
-    jobs_to_terminate = {}
+    lock = threading.Lock()
     print(topics)
-    # The callback for when the client receives a CONNACK response from the server.
-    def on_connect(client, userdata, flags, rc):
-        print(f"Connecting to MQTT broker at {broker}:{port} {'with credentials' if username else 'anonymously'}")
-        print("Connected for advertisement notification with result code " + str(rc))
-        if rc == 5:
-            print("Authentication failed: invalid username or password.")
-            client.loop_stop()
-            raise ConnectionError("MQTT authentication failed with result code 5 (Not authorized)")
-        elif rc != 0:
-            print(f"Connection failed with result code {rc}")
-            client.loop_stop()
-            raise ConnectionError(f"MQTT connection failed with code {rc}")
+
+    def follow_provider(topic2, broker_remote, port_remote, area_remote, context, truetype):
+        provider_topics = subscription_topics(entity_type_flag, watched_attributes_flag, entity_id_flag, area_remote, context, truetype, true_id, watched_attributes)
+        if not provider_topics:
+            print("Something has gone wrong, program did not find the topics to subscribe to!")
+            return
+        remote_username, remote_password = read_credentials(broker_remote, port_remote)
+        try:
+            multiplexer.add((subscription_key, topic2), broker_remote, port_remote, provider_topics, qos,
+                            notification_handler(context, dispatcher), remote_username, remote_password)
+        except ConnectionError as e:
+            print(f"Could not follow the context provider {broker_remote}:{port_remote}: {e}")
+            with lock:
+                advertisement_exists.pop(topic2, None)
+            return
+        with lock:
+            withdrawn = topic2 not in advertisement_exists
+        if withdrawn:
+            # deleted (or expired) while connecting
+            multiplexer.remove((subscription_key, topic2))
 
     # The callback for when a PUBLISH message is received from the server.
-    def on_message(client, userdata, msg):
-        print("MESSAGE advert HERE")
-        print(msg.payload.decode())
+    def on_message(msg):
+        initial_topic = (msg.topic).split('/')
+        broker_remote = initial_topic[1]
+        port_remote = int(initial_topic[2])
+        area_remote = initial_topic[3]
+        context = initial_topic[4]
+        truetype = initial_topic[5]
+
+        topic2 = "provider/" + broker_remote + '/' + str(port_remote) + '/' + area_remote + '/' + context + '/' + truetype
+
         if msg.payload.decode() != '':
-            # Calculate at which time an interested subscriber received an advertisement message
-            # that did not exist prior to its subscription
-            nonlocal advertisement_exists
-
-            stamp = time.time_ns() / (10 ** 6)
-
-            initial_topic = (msg.topic).split('/')
-            broker_remote = initial_topic[1]
-            port_remote = int(initial_topic[2])
-            area_remote = initial_topic[3]
-            context = initial_topic[4]
-            truetype = initial_topic[5]
-
-            topic2 = "provider/" + broker_remote + '/' + str(port_remote) + '/' + area_remote + '/' + context + '/' + truetype
-            attr_str = topic2
-            print(attr_str)
-
-            if topic2 in advertisement_exists.keys():
-                print("advertisement_already_exists")
-                return ()
-            else:
+            with lock:
+                if topic2 in advertisement_exists:
+                    print("advertisement_already_exists")
+                    return
                 print("found_brand_new_advertisement")
-                advertisement_exists.setdefault(topic2, [])
-
-            topic = []
-
-            context_providers_addresses = []
-            context_providers_ports = []
-            context_providers_areas = []
-            number_of_threads = 1
-
-            context_providers_addresses.append(initial_topic[1])
-            context_providers_ports.append(initial_topic[2])
-            context_providers_areas.append(initial_topic[3])
-
-            nonlocal jobs_to_terminate
-            jobs = []
-            for i in range(0, number_of_threads):
-                #print("How many threads???")
-                process = multiprocessing.Process(
-                    target=multiple_subscriptions,
-                    args=(
-                        entity_type_flag, watched_attributes_flag, entity_id_flag,
-                        context_providers_areas[i], context, truetype, true_id, expires,
-                        context_providers_addresses[i], int(context_providers_ports[i]), qos, watched_attributes
-                    )
-                )
-                jobs.append(process)
-
-            print(jobs)
-            jobs_to_terminate.setdefault(topic2, jobs)
-            jobs_to_terminate[topic2] = jobs
-            for j in jobs:
-                print(j)
-                j.start()
-
+                advertisement_exists[topic2] = True
+            print(topic2)
+            # connecting to a new provider must not hold up the network loop delivering this message
+            threading.Thread(target=follow_provider, args=(topic2, broker_remote, port_remote, area_remote, context, truetype), daemon=True).start()
         else:
-            initial_topic = (msg.topic).split('/')
-            broker_remote = initial_topic[1]
-            port_remote = int(initial_topic[2])
-            area_remote = initial_topic[3]
-            context = initial_topic[4]
-            truetype = initial_topic[5]
-
-            topic2 = "provider/" + broker_remote + '/' + str(port_remote) + '/' + area_remote + '/' + context + '/' + truetype
             print("Advertisement Deleted")
-            advertisement_exists.pop(topic2, 1)
-            print(jobs_to_terminate)
-            for j in jobs_to_terminate[topic2]:
-                print(j)
-                j.kill()
-
-    client = mqtt.Client()
-    print("username and password")
-    print(username, password)
-    client.username_pw_set(username, password) if username and password else None
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.connect(broker, port, keepalive=expires)
-
-    client.loop_start()
+            with lock:
+                advertisement_exists.pop(topic2, None)
+            multiplexer.remove((subscription_key, topic2))
+
+    print(f"Connecting to MQTT broker at {broker}:{port} {'with credentials' if username else 'anonymously'}")
+    try:
+        session = get_session(broker, port, username, password)
+    except ConnectionError as e:
+        print(f"Connection for advertisement notification failed: {e}")
+        raise
+
+    handlers = []
     for topic in topics:
-        client.subscribe(topic, qos)
+        handlers.append(session.subscribe(topic, qos, on_message))
         print("Subscribing to topic: " + topic)
 
-    start = time.perf_counter()
-
+    # Block (without spinning) until the subscriptions expire or are stopped
     try:
-        while run_flag:
-            tic_toc = time.perf_counter()
-            if (tic_toc - start) > expires:
-                run_flag = False
+        (stop or threading.Event()).wait(expires)
     except:
         pass
 
     print("Subscriptions expired, exiting.....")
-    client.loop_stop()
+    for handler in handlers:
+        session.unsubscribe(handler)
+    with lock:
+        followed = list(advertisement_exists)
+        advertisement_exists.clear()
+    for topic2 in followed:
+        multiplexer.remove((subscription_key, topic2))
 
 
 # Function: clear_retained
-# Description: This function clears the retained messages on the specified topic(s).
+# Description: This function clears the retained messages on the specified topic(s): the matching topics are collected
+# from one retained snapshot, then cleared with null publishes pipelined over the pooled session.
 # Parameters:
 #   - broker: MQTT broker address.
 #   - port: MQTT broker port.
 #   - retained: Single topic or list of topics to clear retained messages from.
-# Returns: None
+# Returns: The number of cleared topics.
 
 def clear_retained(broker, port, retained,username=None, password=None):
-    run_flag = True
-    expires = 0.5
-
-    # The callback for when the client receives a CONNACK response from the server.
-    def on_connect(client, userdata, flags, rc):
-        print("Connected with result code " + str(rc))
+    topics=[]
 
     # The callback for when a PUBLISH message is received from the server.
-    def on_message(client, userdata, msg):
-        nonlocal expires
-
-        if (msg.retain == 1):
-            # Publish a null message to clear the retained message
-            client2.publish(msg.topic, None, 0, True)
-            print("Clearing retained on topic -", msg.topic)
-            expires += 0.1
-
-    client = mqtt.Client()
-    client2 = mqtt.Client()
-    client.username_pw_set(username, password) if username and password else None
-    client2.username_pw_set(username, password) if username and password else None
-    client.on_connect = on_connect
-    client2.on_connect = on_connect
-    client.on_message = on_message
-
-    client.connect(broker, port)
-    client2.connect(broker, port)
-    client.loop_start()
-    client2.loop_start()
-    client.subscribe(retained, qos=1)
-
-    start = time.perf_counter()
+    def on_message(msg):
+        if msg.retain == 1 and msg.payload:
+            topics.append(msg.topic)
+
+    session = get_session(broker, port, username, password)
+    collect_retained(broker, port, retained if isinstance(retained, list) else [retained], 1, on_message, username=username, password=password)
+    window = mqttsession.PublishWindow(session)
+    for topic in topics:
+        # Publish a null message to clear the retained message
+        window.publish(topic, None, qos=1, retain=True)
+        print("Clearing retained on topic -", topic)
+    window.flush()
+    return len(topics)
+
+
+# Function: read_location_awareness
+# Description: This function reads the area and location configured for a broker in broker_location_awareness.txt.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+# Returns:
+#   - A (my_area, my_loc) tuple, ("unknown_area", "unknown_location") when nothing is configured.
+
+def read_location_awareness(broker, port):
+    my_area = "unknown_area"
+    my_loc = "unknown_location"
+    open("broker_location_awareness.txt", "a+").close()
+    with open("broker_location_awareness.txt", "r") as f:
+        contents = f.read()
     try:
-        while run_flag:
-            tic_toc = time.perf_counter()
-            if (tic_toc - start) > expires:
-                run_flag = False
+        location_awareness = ast.literal_eval(contents)
+        area_key = f"{broker}:{port}:area"
+        loc_key  = f"{broker}:{port}:loc"
+        if area_key in location_awareness:
+            my_area = location_awareness[area_key]
+        if loc_key in location_awareness:
+            my_loc = location_awareness[loc_key]
     except:
         pass
+    return my_area, my_loc
 
-    client.loop_stop()
-    client2.loop_stop()
+
+# Function: subscription_lifetime
+# Description: Seconds a subscription stays active, from its NGSI-LD expiresAt DateTime or from its 'expires' seconds.
+# Parameters:
+#   - data: The NGSI-LD subscription.
+#   - expires (optional): Seconds when the subscription has neither (default: 3600).
+# Returns: The seconds left (0 when expiresAt has passed). Raises ValueError if expiresAt or expires is invalid.
+
+def subscription_lifetime(data, expires=3600):
+    if data.get('expiresAt') is not None:
+        if not isinstance(data['expiresAt'], str):
+            raise ValueError(f"expiresAt must be a DateTime: {data['expiresAt']!r}")
+        try:
+            return max(0.0, parse_time(data['expiresAt']) - time.time())
+        except ValueError:
+            raise ValueError(f"expiresAt must be a DateTime: {data['expiresAt']!r}")
+    expires = data.get('expires', expires)
+    try:
+        if isinstance(expires, bool):
+            raise ValueError
+        expires = float(expires)
+    except (TypeError, ValueError):
+        raise ValueError(f"expires must be a number of seconds: {expires!r}")
+    if not expires >= 0:
+        raise ValueError(f"expires must be a number of seconds: {expires!r}")
+    return expires
+
+
+# Function: validate_subscription
+# Description: Checks an NGSI-LD subscription before it is recorded, and builds its sink.
+# Parameters:
+#   - data: The NGSI-LD subscription.
+#   - expires (optional): Seconds when the subscription has neither expiresAt nor expires (default: 3600).
+#   - sink (optional): Sink receiving the notifications (default: the notification.endpoint.uri webhook of the
+#     subscription if it has one, indented JSON on stdout otherwise, see sinks.make_endpoint_sink).
+# Returns: An (expires, throttling, time_interval, sink) tuple. Raises ValueError if the subscription is invalid.
+
+def validate_subscription(data, expires=3600, sink=None):
+    if data.get('type')!='Subscription': raise ValueError(f"Subscription has invalid type: {data.get('type')}")
+    if 'id' not in data: raise ValueError("Error, ngsi-ld Subscription without a id ")
+    ctx=data.get('@context')
+    if not (ctx is None or isinstance(ctx,str) or (isinstance(ctx,list) and all(isinstance(c,str) for c in ctx))):
+        raise ValueError("@context must be a URL or a list of URLs")
+    entities=data.get('entities')
+    if entities is not None and not (isinstance(entities,list) and entities and isinstance(entities[0],dict)):
+        raise ValueError("entities must be a non empty list of entity selectors")
+    if 'watchedAttributes' in data and not data['watchedAttributes']: raise ValueError("Watched attributes without content")
+    if not (entities and ('type' in entities[0] or 'id' in entities[0])) and 'watchedAttributes' not in data:
+        raise ValueError("Error, ngsi-ld subscription without information about topics")
+    expires=subscription_lifetime(data,expires)
+    try:
+        throttling=float(data.get('throttling',0)); time_interval=float(data.get('timeInterval',0))
+    except (TypeError,ValueError): raise ValueError("throttling and timeInterval must be numbers of seconds")
+    if throttling<0 or time_interval<0 or (throttling and time_interval): raise ValueError("Invalid throttling/timeInterval, they are positive and exclusive")
+    if sink is None:
+        endpoint=(data.get('notification') or {}).get('endpoint') or {}
+        if not isinstance(endpoint,dict): raise ValueError("notification.endpoint must be an object")
+        sink=make_endpoint_sink(endpoint['uri']) if endpoint.get('uri') else PrettyPrintSink()
+    return expires, throttling, time_interval, sink
+
+
+# Function: create_subscription
+# Description: This function records an NGSI-LD subscription and follows the matching provider advertisements until it expires.
+# Parameters:
+#   - data: The NGSI-LD subscription.
+#   - my_area: The area or domain of the subscriber.
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - qos: The quality of service level for message delivery.
+#   - expires (optional): Expiration time in seconds, overridden by the 'expiresAt' or 'expires' member of the subscription
+#     (default: 3600, see subscription_lifetime).
+#   - sink (optional): Sink receiving the notifications (default: the notification.endpoint.uri webhook of the
+#     subscription if it has one, indented JSON on stdout otherwise).
+#   - window (optional): Seconds the attribute messages of an entity are coalesced (default: notifications.default_coalesce_window).
+#   - stop (optional): A threading.Event ending the subscription before it expires (e.g. when it is deleted).
+# Returns:
+#   - False if the subscription is invalid (see validate_subscription), True once it has expired or was stopped.
+
+def create_subscription(data, my_area, broker, port, qos, expires=3600, username=None, password=None, sink=None, window=None, stop=None):
+    truetype=''; true_id=''; entity_type_flag=False; watched_attributes_flag=False; entity_id_flag=False; watched_attributes=''
+    try: expires,throttling,time_interval,sink=validate_subscription(data,expires,sink)
+    except ValueError as e: print(e); return False
+    sid = str(data['id'])
+    ctx = data.get('@context');
+    if isinstance(ctx,str): context=ctx.replace('/','§')
+    else: context=ctx[0].replace('/','§') if ctx else '+'
+    if 'entities' in data:
+        ie=data['entities'][0]
+        if 'type' in ie: truetype=str(ie['type']); entity_type_flag=True
+        if 'id' in ie:   true_id=str(ie['id']);   entity_id_flag=True
+    if 'watchedAttributes' in data:
+        watched_attributes=data['watchedAttributes']; watched_attributes_flag=True
+    big_topic=f"{my_area}/Subscriptions/{context}/Subscription/LNA/{sid}"
+
+    dispatcher=NotificationDispatcher(sink,sid,notification_entity,window,throttling,time_interval)
+    try:
+        session=get_session(broker,port,username,password)
+        session.publish(big_topic,codec.encode(data),qos=qos)
+        area=data.get('area',['+']); truetype2=truetype or '#'; trueid2=true_id or '#'; check_top=[]
+        for z in area:
+            if not singleidadvertisement: check_top.append(f"provider/+/+/{z}/{context}/{truetype2}")
+            else:                      check_top.append(f"provider/+/+/{z}/{context}/{truetype}/{trueid2}")
+        subscribe_for_advertisement_notification(broker,port,check_top,expires,qos,entity_type_flag,watched_attributes_flag,entity_id_flag,watched_attributes,true_id,username=username,password=password,dispatcher=dispatcher,stop=stop)
+    finally:
+        dispatcher.close()
+    return True
+
+
+# Function: delete_entity
+# Description: This function deletes an entity, or a single attribute of it, by clearing its retained topics.
+# The provider advertisement is cleared too when no other entity of the same type remains.
+# Parameters:
+#   - entity_id: The id of the entity to delete.
+#   - my_area: The area or domain of the entity.
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - HLink (optional): Context link of the entity (default: any context).
+#   - attr (optional): Only delete this attribute (default: None, the whole entity).
+# Returns:
+#   - False if the entity (or its attribute attr) does not exist, True otherwise.
+
+@instrumentation.instrumented("DELETE/entities")
+def delete_entity(entity_id, my_area, broker, port, HLink='', attr=None, username=None, password=None):
+    result=bulk_delete_entities([entity_id],my_area,broker,port,HLink,attr,username=username,password=password)
+    if not result['deleted']:
+        if attr is None: print("Entity with this id doesn't exist, no need for deletion")
+        else: print(f"Entity with this id has no attribute {attr}, no need for deletion")
+        return False
+    return True
+
+
+# Function: patch_entity
+# Description: This function updates the attributes of an existing entity and refreshes their modifiedAt timestamps.
+# Parameters:
+#   - entity_id: The id of the entity to update.
+#   - data: The attributes to publish.
+#   - my_area: The area or domain of the entity.
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - qos: The quality of service level for message delivery.
+#   - HLink (optional): Context link of the entity (default: any context).
+#   - attr (optional): Attribute named in the PATCH path, '' for a whole entity patch (default: '').
+# Returns:
+#   - False if the entity does not exist, True otherwise.
+
+@instrumentation.instrumented("PATCH/entities")
+def patch_entity(entity_id, data, my_area, broker, port, qos, HLink='', attr='', username=None, password=None):
+    H=HLink.replace('/','§') if HLink else '+'
+    ct=f"+/entities/{H}/+/+/{entity_id}/#";
+    exists_topic=check_existence(broker,port,ct,username=username,password=password)
+    if exists_topic is None: print("Error: id doesn't exist"); return False
+
+    session=get_session(broker,port,username,password)
+    # context, type and location of the entity found, also when HLink was not given
+    H=exists_topic.split('/')[-5]; tp=exists_topic.split('/')[-4]; loc=exists_topic.split('/')[-3]
+    bbox=entity_bbox([data])
+    if bbox is not None:
+        # a moved entity can leave the bounding box its advertisement covers
+        advertisement=f"provider/{broker}/{port}/{my_area}/{H}/{tp}"+(f"/{entity_id}" if singleidadvertisement else '')
+        advertise_provider(session,broker,port,advertisement,read_location_awareness(broker,port)[1],[str(datetime.datetime.now())],bbox,username,password)
+    if codec.temporal_layout=='envelope':
+        return patch_entity_envelope(entity_id, data, my_area, broker, port, qos, H, tp, loc, attr, session, username, password)
+    unchanged=0
+    if attr=='':
+        for k,v in data.items():
+            if k not in ('type','id','@context'):
+                st=f"{my_area}/entities/{H}/{tp}/LNA/{entity_id}/{k}"
+                if not change_filter.changed(broker,port,st,v): unchanged+=1; continue
+                with instrumentation.span('publish'):
+                    session.publish(st,codec.encode(v),retain=True,qos=qos)
+                    now=str(datetime.datetime.now()); rel={'modifiedAt':[now]}
+                    session.publish(f"{my_area}/entities/{H}/{tp}/LNA/{entity_id}/{k}_timerelsystem_modifiedAt",codec.encode(rel['modifiedAt']),retain=True,qos=qos)
+    else:
+        for k,v in data.items():
+            st=f"{my_area}/entities/{H}/{tp}/{loc}/{entity_id}/{k}"
+            if not change_filter.changed(broker,port,st,v): unchanged+=1; continue
+            with instrumentation.span('publish'):
+                session.publish(st,codec.encode(v),retain=True,qos=qos)
+                now=str(datetime.datetime.now()); rel={'modifiedAt':[now]}
+                session.publish(f"{my_area}/entities/{H}/{tp}/LNA/{entity_id}/{k}_timerelsystem_modifiedAt",codec.encode(rel['modifiedAt']),retain=True,qos=qos)
+    change_filter.save()
+    if unchanged: print(f"Skipped {unchanged} unchanged attributes")
+    return True
+
+
+# Function: patch_entity_envelope
+# Description: PATCH in the 'envelope' temporal layout: every patched attribute is written as one envelope keeping the
+# createdAt of the attribute (read from its envelope, or from its _timerelsystem_CreatedAt topic if it was stored in the
+# 'topics' layout, whose temporal topics are then cleared).
+# Parameters:
+#   - entity_id, data, my_area, broker, port, qos, attr: As in patch_entity.
+#   - H: The context of the entity in topic form.
+#   - tp, loc: The type and location levels of the existing entity.
+#   - session: The session to publish over.
+# Returns: True
+
+def patch_entity_envelope(entity_id, data, my_area, broker, port, qos, H, tp, loc, attr, session, username=None, password=None):
+    created={}; temporal_topics={}
+
+    def on_message(msg):
+        if not (msg.retain and msg.payload):
+            return
+        name=msg.topic.split('/')[-1]
+        if '_timerelsystem_' in name:
+            k,_,kind=name.partition('_timerelsystem_')
+            temporal_topics.setdefault(k,[]).append(msg.topic)
+            if kind=='CreatedAt':
+                created.setdefault(k,codec.decode_message(msg))
+        else:
+            temporal=codec.unwrap_attribute(codec.decode_message(msg))[1]
+            if temporal is not None:
+                created[name]=temporal.get('createdAt')
+
+    collect_retained(broker,port,[f"+/entities/{H}/{tp}/+/{entity_id}/#"],1,on_message,username=username,password=password)
+    now=[str(datetime.datetime.now())]
+    unchanged=0
+    for k,v in data.items():
+        if attr=='' and k in ('type','id','@context'):
+            continue
+        st=f"{my_area}/entities/{H}/{tp}/{'LNA' if attr=='' else loc}/{entity_id}/{k}"
+        # an attribute still stored in the 'topics' layout is rewritten, to migrate it
+        if not temporal_topics.get(k) and not change_filter.changed(broker,port,st,v):
+            unchanged+=1
+            continue
+        with instrumentation.span('publish'):
+            session.publish(st,codec.encode(codec.wrap_attribute(v,created.get(k) or now,now)),retain=True,qos=qos)
+            for topic in temporal_topics.get(k,[]):
+                session.publish(topic,'',retain=True,qos=qos)
+    change_filter.save()
+    if unchanged: print(f"Skipped {unchanged} unchanged attributes")
+    return True
+
+
+# Provider advertisements
+#
+# An advertisement (provider/<broker>/<port>/<area>/<context>/<type>[/<id>]) is a retained JSON document:
+# {"type": "ProviderAdvertisement", "createdAt": [...], "location": <loc>, "bbox": [minx, miny, maxx, maxy] or null}.
+# "location" is the loc configured for the broker in broker_location_awareness.txt; when it is a GeoJSON geometry or a
+# [minx, miny, maxx, maxy] bounding box it declares the coverage of the provider. Otherwise the coverage is "bbox", the
+# bounding box of every GeoProperty written under the advertisement (null while there is none), which is extended by the
+# writers and never shrinks. Geo-queries are only forwarded to providers whose coverage can match (see
+# GeoQuery.covering). Advertisements of older versions ("Provider Message: {...}") have no coverage and are always queried.
+# With -A summary the advertisement also has an "ids" member, the IdSummary of the entities of the type, which the writers
+# keep up to date and a GET by id tests before querying the provider. Writers in the other modes drop it, since they do
+# not maintain it.
+
+# Function: advertisement_payload
+# Description: This function builds the retained payload of a provider advertisement.
+# Parameters:
+#   - created: The createdAt value of the advertisement.
+#   - my_loc: The location of the broker.
+#   - bbox (optional): Bounding box of the located entities of the provider (default: None, none).
+#   - ids (optional): IdSummary of the entities of the advertisement (default: None, no summary).
+# Returns:
+#   - The payload (JSON bytes, whatever --payload_format is).
+
+def advertisement_payload(created, my_loc, bbox=None, ids=None):
+    advert={'type':'ProviderAdvertisement','createdAt':created,'location':my_loc,'bbox':bbox}
+    if ids is not None:
+        advert['ids']=ids.to_dict()
+    return codec.encode(advert,'json')
+
+
+# Function: parse_advertisement
+# Description: This function decodes the payload of a provider advertisement.
+# Parameters:
+#   - payload: The retained payload.
+# Returns:
+#   - The advertisement dictionary, None for advertisements of older versions or unreadable ones.
+
+def parse_advertisement(payload):
+    try:
+        advert=codec.decode(payload)
+    except ValueError:
+        return None
+    return advert if isinstance(advert,dict) and advert.get('type')=='ProviderAdvertisement' else None
+
+
+def _bbox_polygon(bbox):
+    minx,miny,maxx,maxy=bbox
+    # the box of a single point, or of points on one line, has no area and would not be a valid polygon
+    if minx==maxx and miny==maxy:
+        return {'type':'Point','coordinates':[minx,miny]}
+    if minx==maxx or miny==maxy:
+        return {'type':'LineString','coordinates':[[minx,miny],[maxx,maxy]]}
+    return {'type':'Polygon','coordinates':[[[minx,miny],[maxx,miny],[maxx,maxy],[minx,maxy],[minx,miny]]]}
+
+
+# Function: declared_coverage
+# Description: This function reads the coverage a broker location declares.
+# Parameters:
+#   - my_loc: The location of the broker (a name, a GeoJSON geometry or a [minx, miny, maxx, maxy] bounding box).
+# Returns:
+#   - A GeoJSON geometry, None when the location is not a geometry.
+
+def declared_coverage(my_loc):
+    if isinstance(my_loc,dict) and my_loc.get('type') in geometry_types and 'coordinates' in my_loc:
+        return my_loc
+    if isinstance(my_loc,(list,tuple)) and len(my_loc)==4 and all(isinstance(c,(int,float)) for c in my_loc):
+        return _bbox_polygon(my_loc)
+    return None
+
+
+# Function: advertisement_coverage
+# Description: This function returns the coverage of an advertisement, in the form taken by GeoQuery.covering.
+# Parameters:
+#   - advert: The advertisement, as returned by parse_advertisement.
+# Returns:
+#   - None when the coverage is unknown, otherwise a list of GeoJSON geometries (empty when no entity is located).
+
+def advertisement_coverage(advert):
+    if advert is None:
+        return None
+    declared=declared_coverage(advert.get('location'))
+    if declared is not None:
+        return [declared]
+    bbox=advert.get('bbox')
+    return [_bbox_polygon(bbox)] if bbox else []
+
+
+# Function: entity_bbox
+# Description: This function computes the bounding box of the GeoProperties of entities.
+# Parameters:
+#   - entities: List of NGSI-LD entities.
+# Returns:
+#   - [minx, miny, maxx, maxy], None when no entity has a GeoProperty.
+
+def entity_bbox(entities):
+    bbox=None
+    for data in entities:
+        for k,v in data.items():
+            if k in ('type','id','@context') or not isinstance(v,dict) or v.get('type')!='GeoProperty':
+                continue
+            try:
+                bbox=bbox_union(bbox,list(shape_geo.shape(v['value']).bounds))
+            except (ValueError, TypeError, KeyError, AttributeError, IndexError):
+                print(f"Ignoring the unreadable GeoProperty {k} of {data.get('id')}")
+    return bbox
+
+
+def bbox_union(a, b):
+    if not a:
+        return b
+    if not b:
+        return a
+    return [min(a[0],b[0]),min(a[1],b[1]),max(a[2],b[2]),max(a[3],b[3])]
+
+
+# Function: read_advertisement
+# Description: This function returns the current payload of an advertisement: from the AdvertisementView of the broker
+# (see providercache.py) when it holds the topic, otherwise from a retained read of the broker.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - topic: The advertisement topic.
+#   - fresh (optional): Always read the broker, e.g. to read back a publish (default: False).
+# Returns:
+#   - The payload, None if there is no advertisement.
+
+def read_advertisement(broker, port, topic, username=None, password=None, fresh=False):
+    if not fresh:
+        known,payload=advertisement_view(broker,port,username,password).get(topic)
+        if known:
+            return payload
+    current=[]
+
+    def on_message(msg):
+        if msg.payload:
+            current.append(msg.payload)
+            return True
+
+    collect_retained(broker,port,[topic],1,on_message,username=username,password=password)
+    return current[0] if current else None
+
+
+# Function: publish_advertisement
+# Description: This function publishes an advertisement and waits for the broker to acknowledge it.
+# Parameters:
+#   - client: The session (or connected MQTT client) to publish with.
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - topic: The advertisement topic.
+#   - payload: The advertisement payload.
+# Returns:
+#   - True if the broker acknowledged the advertisement within advertisement_timeout seconds.
+
+advertisement_timeout=10
+
+def publish_advertisement(client, broker, port, topic, payload, username=None, password=None):
+    view=advertisement_view(broker,port,username,password)
+    if not isinstance(client,mqttsession.Session):
+        # publishes of the sessions reach the view through their publish observers
+        view.sending(topic,payload)
+    info=client.publish(topic,payload,qos=2,retain=True)
+    try:
+        info.wait_for_publish(advertisement_timeout)
+        acknowledged=info.is_published()
+    except (RuntimeError, ValueError):
+        # not sent at all, e.g. while the connection is down
+        acknowledged=False
+    if acknowledged:
+        return True
+    print(f"Warning: the advertisement {topic} was not acknowledged by the broker within {advertisement_timeout}s")
+    # the view would take the lost advertisement as current
+    view.reset()
+    return False
+
+
+# Function: advertise_provider
+# Description: This function publishes the advertisement of a provider, or extends the bounding box of the existing one
+# to new located entities (and, with -A summary, its id summary to the written ids). The current advertisement comes
+# from the AdvertisementView of the broker, so a write that does not change it costs no round trip. A changed
+# advertisement is read back from the broker, so concurrent writers extending it do not lose each other's box or ids.
+# Parameters:
+#   - client: The session (or connected MQTT client) to publish with.
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - topic: The advertisement topic.
+#   - my_loc: The location of the broker.
+#   - created: The createdAt value of a new advertisement.
+#   - bbox: Bounding box of the located entities being written (None if there is none).
+#   - ids (optional): The ids of the entities being written, summarized with -A summary (default: None, the summary is
+#     kept as it is).
+#   - new (optional): The ids among ids that did not exist before the write, counted by the summary (default: none).
+# Returns:
+#   - True if the advertisement was published (False also when the broker did not acknowledge it).
+
+@instrumentation.timed('advertisement')
+def advertise_provider(client, broker, port, topic, my_loc, created, bbox, username=None, password=None, ids=None, new=()):
+    published=False
+    summarize=summaryadvertisement and ids is not None
+    new=set(new)
+    for attempt in range(3):
+        summary=None
+        current=read_advertisement(broker,port,topic,username,password,fresh=published)
+        if current:
+            advert=parse_advertisement(current)
+            if advert is None:
+                # advertisement of an older version, it keeps being queried by every geo-query
+                return published
+            merged=bbox_union(advert.get('bbox'),bbox)
+            added=0
+            if summaryadvertisement:
+                summary=IdSummary.from_dict(advert.get('ids'))
+                if summarize and (summary is None or summary.stale()):
+                    # written in another mode, or to be resized: the summary is rebuilt from the entities of the provider,
+                    # which already counts the written ones
+                    summary=summarize_provider(broker,port,topic,username,password)
+                    new=set()
+                    added=1
+                if summarize:
+                    if published:
+                        # a concurrent writer replaced the advertisement just published: only the created ids it
+                        # lost are counted again
+                        new={entity_id for entity_id in new if entity_id not in summary}
+                    added+=summary.add(ids,new)
+            elif 'ids' in advert:
+                # a summary this writer does not maintain would hide the entities it writes
+                added=1
+            if merged==advert.get('bbox') and advert.get('location')==my_loc and not added:
+                return published
+            created=advert.get('createdAt',created)
+            bbox=merged
+        elif summarize:
+            summary=IdSummary.build(ids)
+        if not publish_advertisement(client,broker,port,topic,advertisement_payload(created,my_loc,bbox,summary),username,password):
+            return False
+        published=True
+    return published
+
+
+# Function: summarize_provider
+# Description: This function builds the id summary of an advertisement from the retained entities of the provider.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - topic: The advertisement topic (provider/<broker>/<port>/<area>/<context>/<type>).
+# Returns:
+#   - An IdSummary.
+
+def summarize_provider(broker, port, topic, username=None, password=None):
+    area,context,typee=topic.split('/')[3:6]
+    ids=set()
+
+    def on_message(msg):
+        if msg.retain and msg.payload:
+            ids.add(msg.topic.split('/')[5])
+
+    collect_retained(broker,port,[f"{area}/entities/{context}/{typee}/+/+/#"],1,on_message,username=username,password=password)
+    return IdSummary.build(ids)
+
+
+# Function: retract_summary
+# Description: This function accounts for deleted entities in the id summary of an advertisement (with -A summary).
+# Their ids stay in the filter until it is rebuilt, which is done here once it holds more deleted ids than live ones.
+# A single update is enough: a concurrent writer that loses its ids to it adds them back when reading back.
+# Parameters:
+#   - client: The session (or connected MQTT client) to publish with.
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - topic: The advertisement topic.
+#   - ids: The ids of the deleted entities.
+# Returns:
+#   - True if the advertisement was published and acknowledged.
+
+@instrumentation.timed('advertisement')
+def retract_summary(client, broker, port, topic, ids, username=None, password=None):
+    current=read_advertisement(broker,port,topic,username,password)
+    advert=parse_advertisement(current) if current else None
+    summary=IdSummary.from_dict(advert.get('ids')) if advert else None
+    if summary is None or not summary.remove(ids):
+        return False
+    if summary.stale():
+        summary=summarize_provider(broker,port,topic,username,password)
+    return publish_advertisement(client,broker,port,topic,advertisement_payload(advert.get('createdAt'),advert.get('location'),advert.get('bbox'),summary),username,password)
+
+
+# Function: discover_providers
+# Description: This function finds the context providers advertising data under the given advertisement topic filters.
+# Discovery results are reused from the provider cache (see providercache.py) while valid, and looked up in the broker's
+# retained advertisements (or its mirror) otherwise.
+# Parameters:
+#   - broker: The name or IP address of the broker holding the advertisements.
+#   - port: The port number of the broker.
+#   - check_top: List of advertisement topic filters, e.g. provider/+/+/<area>/<context>/<type>.
+#   - with_coverage (optional): Also return the coverage of every provider (default: False).
+#   - with_summary (optional): Also return the id summaries of every provider (default: False).
+# Returns:
+#   - A list of distinct (address, port, area) tuples, followed by the coverage of the provider with_coverage and by its
+#     id summaries with_summary. The coverage is None when unknown or a list of GeoJSON geometries (see
+#     advertisement_coverage), the summaries None when unknown or the list of the "ids" members of its advertisements
+#     (see idsummary.may_hold).
+
+@instrumentation.timed('discovery')
+def discover_providers(broker, port, check_top, username=None, password=None, with_coverage=False, with_summary=False):
+    use_cache=get_mirror(broker,port) is None
+    providers=provider_cache.lookup(broker,port,check_top) if use_cache else None
+    if providers is None:
+        coverages={}
+        summaries={}
+        for messg in GET(broker,port,check_top,0.1,1,username=username,password=password):
+            initial_topic=(messg.topic).split('/')
+            provider=(initial_topic[1],initial_topic[2],initial_topic[3])
+            advert=parse_advertisement(messg.payload)
+            coverage=advertisement_coverage(advert)
+            summary=[advert['ids']] if advert is not None and advert.get('ids') is not None else None
+            if provider not in coverages:
+                coverages[provider]=coverage
+                summaries[provider]=summary
+                continue
+            # the provider is known by several advertisements (types, or ids with single id advertisements)
+            if coverages[provider] is not None:
+                coverages[provider]=None if coverage is None else coverages[provider]+coverage
+            if summaries[provider] is not None:
+                summaries[provider]=None if summary is None else summaries[provider]+summary
+        providers=[provider+(coverages[provider],summaries[provider]) for provider in coverages]
+        if use_cache:
+            provider_cache.store(broker,port,check_top,providers)
+    # entries cached by older versions have no coverage nor summaries
+    providers=[tuple(provider[:3])+tuple(provider[3:5])+(None,)*(5-len(provider)) for provider in providers]
+    return [provider[:3]+((provider[3],) if with_coverage else ())+((provider[4],) if with_summary else ()) for provider in providers]
+
+
+# Function: query_parameters
+# Description: Builds the query_string of get_entities from decoded parameters, percent-encoding every value (and every
+# element of the comma separated type, attrs and area lists), so values containing & = or , are not split.
+# Parameters:
+#   - parameters: List of (name, value) pairs, e.g. from urllib.parse.parse_qsl.
+# Returns: The query string, with its leading '?' ('' without parameters).
+
+list_parameters=('type','attrs','area')
+
+def query_parameters(parameters):
+    encoded=[]
+    for name,value in parameters:
+        if name in list_parameters:
+            value=','.join(urllib.parse.quote(v,safe='') for v in value.split(','))
+        else:
+            value=urllib.parse.quote(value,safe='')
+        encoded.append(f"{urllib.parse.quote(name,safe='')}={value}")
+    return '?'+'&'.join(encoded) if encoded else ''
+
+
+# Function: get_entities
+# Description: This function runs an NGSI-LD GET entities query: it discovers the context providers advertising matching
+# data and retrieves, recreates and filters the entities from all of them concurrently (up to max_fanout retrievals at a
+# time, each provider broker over its own pooled connection), so a federated query takes the time of the slowest provider.
+# Entities found at several providers are delivered once and the limit applies to the merged result.
+# With limit, offset or count=true the query is paged (see page_entities): entities are delivered in entity id order, and
+# count=true reports the total number of matching entities.
+# Parameters:
+#   - query_string: The query part of the command, e.g. "?type=Turbine&q=rpm>100" (may be empty). Values are
+#     percent-decoded (the elements of type, attrs and area one by one), see query_parameters.
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - HLink (optional): Context link to be used for the GET request (default: any context).
+#   - sink (optional): Sink receiving each entity as soon as it is complete (default: print them as indented JSON).
+#   - timeout (optional): Deadline of the whole query in seconds (default: mqttsession.default_collect_timeout).
+# Returns:
+#   - The number of entities delivered to the sink, None if the query could not be parsed.
+
+max_fanout=16
+
+@instrumentation.instrumented("GET/entities")
+def get_entities(query_string, broker, port, HLink='', username=None, password=None, sink=None, timeout=None):
+    context_flag=True
+    entity_id_flag=False
+    entity_id_pattern_flag=False
+    entity_type_flag=False
+    entity_attrs_flag=False
+    entity_query_flag=False
+    context_flag=True
+    Forwarding=1
+    area=[]
+    typee_multi=[]
+    timee=''
+    limit=1800
+    offset=0
+    count=False
+    paged=False
+    id='+'
+    attrs='#'
+    query=''
+    geometry=''
+    georel=''
+    coordinates=''
+    geoproperty='location'  #default value for ngsild
+    geovar_count=0
+    retrievals=[]
+    if sink is None:
+        sink=PrettyPrintSink()
+
+    if HLink=='':
+        HLink='+'
+        context_flag=False
+    else:
+        HLink=HLink.replace("/", "§")
+
+    command=query_string
+    if len(command) > 0 and command[0] == "?":
+        command=command[1:]
+    command_parts = command.split("&")
+
+    for current in command_parts:
+        current=current.split("=", 1)
+        print(current[0])
+        # values are percent-decoded after the split, so they can contain an encoded & = or ,
+        value=urllib.parse.unquote(current[1]) if len(current)>1 else ''
+        if(current[0]=="id"):
+            print("id detected")
+            entity_id_flag=True
+            id=value
+        elif(current[0]=="idPattern"):
+            entity_id_pattern_flag=True
+            print("id pattern detected")
+        elif(current[0]=="type"):
+            entity_type_flag=True
+            typee_multi=[urllib.parse.unquote(v) for v in current[1].split(',')]
+            print("type detected")
+        elif(current[0]=="time"):
+            timee=value
+            print("time detected")
+        elif(current[0]=="limit"):
+            try:
+                limit=int(value)
+            except ValueError:
+                print("Invalid pagination limit")
+                return None
+            paged=True
+            print("pagination limit detected")
+        elif(current[0]=="offset"):
+            try:
+                offset=int(value)
+            except ValueError:
+                print("Invalid pagination offset")
+                return None
+            paged=True
+            print("pagination offset detected")
+        elif(current[0]=="count"):
+            if value not in ("true","false"):
+                print("count must be true or false")
+                return None
+            count=value=="true"
+            paged=True
+            print("count detected")
+        elif(current[0]=="attrs"):
+            entity_attrs_flag=True
+            attrs=[urllib.parse.unquote(v) for v in current[1].split(',')]
+            print("attrs detected")
+        elif(current[0]=="q"):
+            entity_query_flag=True
+            query=value
+            print("query detected")
+        elif(current[0]=="geoproperty"):
+            geoproperty=value
+            print("geoproperty detected")
+        elif(current[0]=="geometry"):
+            geometry=value
+            print("geometry detected")
+            geovar_count+=1
+        elif(current[0]=="georel"):
+            georel=value
+            print("georel detected")
+            geovar_count+=1
+        elif(current[0]=="coordinates"):
+            coordinates=value
+            print("coordinates detected")
+            geovar_count+=1
+        elif(current[0]=="area"):
+            area=[urllib.parse.unquote(v) for v in current[1].split(',')]
+        elif(current[0]==""):
+            continue
+        else:
+            print("Query not recognised")
+            return None
+
+    if(limit<0 or offset<0):
+        print("Pagination limit and offset must not be negative")
+        return None
+    if(limit==0 and not count):
+        print("limit=0 is only valid with count=true")
+        return None
+
+    if(geovar_count!=0 and geovar_count!=3):
+        print("Incomplete geoquery!")
+        return None
+
+    if(query!=''):
+        try:
+            compile_query(query)
+        except QuerySyntaxError as e:
+            print(f"Invalid query: {e}")
+            return None
+
+    if(georel!=''):
+        try:
+            compile_geo_query(georel, geometry, coordinates)
+        except GeoQuerySyntaxError as e:
+            print(f"Invalid geoquery: {e}")
+            return None
+
+    if(area==[]):
+        area.append('+')
+
+    if(entity_type_flag==False):
+        typee_multi=[1]
+    if(entity_id_flag==False):
+        id="#"
+
+    for typee in typee_multi:
+        check_top=[]
+        if(typee==1):
+            typee="#"
+
+        for z in area:
+            if(singleidadvertisement==False):
+                check_topic2=f"provider/+/+/{z}/{HLink}/{typee}"
+            else:
+                if(typee=="#"):
+                    typee="+"
+                check_topic2=f"provider/+/+/{z}/{HLink}/{typee}/{id}"
+            check_top.append(check_topic2)
+
+        if(typee=="#"):
+            typee="+"
+
+        if (Forwarding==1):
+            by_summary=entity_id_flag and not singleidadvertisement
+            providers=discover_providers(broker,port,check_top,username,password,with_coverage=georel!='',with_summary=by_summary)
+            if by_summary:
+                # a GET by id only queries the providers whose id summary can hold it
+                holding=[provider for provider in providers if may_hold(provider[-1],id)]
+                if len(holding)<len(providers):
+                    print(f"GET by id skips {len(providers)-len(holding)} of {len(providers)} providers whose id summary does not hold {id}")
+                providers=holding
+            if georel!='':
+                # only the providers whose coverage can hold a matching entity are queried
+                covering=compile_geo_query(georel,geometry,coordinates).covering([provider[3] for provider in providers])
+                if len(covering)<len(providers):
+                    print(f"Geo-query skips {len(providers)-len(covering)} of {len(providers)} providers whose coverage cannot match")
+                providers=[providers[i] for i in covering]
+            for provider_address,provider_port,provider_area,*details in providers:
+                topic=[]
+                # '#' is only valid as the last level of a topic filter
+                id_level='+' if id=='#' else id
+                if attrs!='#':
+                    # the geoproperty is needed for the geo-query even when the projection leaves it out
+                    for i in attrs+([geoproperty] if georel!='' and geoproperty not in attrs else []):
+                        top=f"{provider_area}/entities/{HLink}/{typee}/+/{id_level}/{i}"
+                        topic.append(top)
+                else:
+                    top=f"{provider_area}/entities/{HLink}/{typee}/+/{id_level}/#"
+                    topic.append(top)
+                retrievals.append((provider_address,int(provider_port),topic))
+        else:
+            print("Forwarding left by default for now")
+
+    deadline=time.monotonic()+(timeout if timeout is not None else mqttsession.default_collect_timeout)
+    if paged:
+        return page_entities(retrievals,sink,offset,limit,count,query,attrs,timee,georel,geometry,coordinates,geoproperty,HLink,deadline)
+
+    # every provider and type is retrieved concurrently, the results are merged by entity id under one limit
+    merged=DeduplicatingSink(sink,limit)
+    fan_out(retrievals,lambda address,provider_port,topic,remaining:
+            stream_entities(address,provider_port,topic,1,merged,limit,query,attrs,timee,georel,geometry,coordinates,geoproperty,HLink,
+                            stop=merged.full,timeout=remaining),deadline)
+    # late results are dropped, so the GET ends at the deadline
+    merged.close()
+    return merged.delivered
+
+
+# Function: fan_out
+# Description: Runs one function per retrieval concurrently (up to max_fanout at a time) until a deadline, and reports the
+# providers that failed or did not answer in time.
+# Parameters:
+#   - retrievals: List of (address, port, topics, ...) tuples.
+#   - function: Function called with the elements of a retrieval and the seconds left before the deadline.
+#   - deadline: time.monotonic() value ending the wait.
+# Returns:
+#   - A list with the result of every retrieval, None for the ones that failed or are late.
+
+def fan_out(retrievals, function, deadline):
+    results=[None]*len(retrievals)
+    if not retrievals:
+        return results
+    pool=ThreadPoolExecutor(max_workers=min(len(retrievals),max_fanout))
+    futures={}
+    for index,retrieval in enumerate(retrievals):
+        future=pool.submit(instrumentation.bind(function),*retrieval,max(0,deadline-time.monotonic()))
+        futures[future]=index
+    finished,pending=wait(futures,timeout=max(0,deadline-time.monotonic()))
+    pool.shutdown(wait=False)
+    for future in finished:
+        address,provider_port=retrievals[futures[future]][:2]
+        if future.exception() is not None:
+            print(f"Context provider {address}:{provider_port} unreachable: {future.exception()}")
+        else:
+            results[futures[future]]=future.result()
+    for future in pending:
+        address,provider_port=retrievals[futures[future]][:2]
+        print(f"Context provider {address}:{provider_port} did not answer before the deadline")
+    return results
+
+
+# Function: index_entity_ids
+# Description: Builds the id index of a retrieval: the ids of the entities under its topic filters, read from the topic
+# names of the retained snapshot without decoding any payload.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - topics: The topic filters of the retrieval.
+#   - timeout (optional): Upper bound of the scan in seconds.
+# Returns:
+#   - The set of entity ids.
+
+def index_entity_ids(broker, port, topics, timeout=None):
+    ids=set()
+
+    def on_message(msg):
+        if msg.retain and msg.payload:
+            ids.add(msg.topic.split('/')[-2])
+
+    collect_retained(broker,port,topics,1,on_message,timeout=timeout)
+    return ids
+
+
+# Function: page_entities
+# Description: Answers a paged GET (limit, offset, count) with a stable order: entities are sorted by id across all
+# providers (an id found at several providers is taken from the first one retrieved) and the page
+# [offset, offset + limit) is delivered to the sink. Without q or geo-query the match is decided by the topic names
+# alone: an id index is built from the retained scan, the count is its size, and only the entities of the page are then
+# retrieved and reassembled (per-id topic filters for small pages). With a filter every entity has to be reassembled and
+# evaluated, but only the offset + limit lowest ids are kept (sinks.PageSink).
+# Parameters:
+#   - retrievals: List of (address, port, topics) tuples, as built by get_entities.
+#   - sink: Sink receiving the entities of the page.
+#   - offset, limit: The page.
+#   - count: Whether to report the number of matching entities (printed and passed to sink.set_count).
+#   - query, attrs, timee, georel, geometry, coordinates, geoproperty, HLink: As in get_entities.
+#   - deadline: time.monotonic() value ending the query.
+# Returns:
+#   - The number of entities delivered to the sink.
+
+def page_entities(retrievals, sink, offset, limit, count, query, attrs, timee, georel, geometry, coordinates, geoproperty, HLink, deadline):
+    if query!='' or georel!='':
+        page=PageSink(offset,limit)
+        fan_out(retrievals,lambda address,provider_port,topic,remaining:
+                stream_entities(address,provider_port,topic,1,page,float('inf'),query,attrs,timee,georel,geometry,coordinates,geoproperty,HLink,
+                                timeout=remaining),deadline)
+        total=page.count
+        entities=page.page()
+    else:
+        owner={}
+        for index,ids in enumerate(fan_out(retrievals,index_entity_ids,deadline)):
+            for id in ids or ():
+                owner.setdefault(id,index)
+        total=len(owner)
+        entities=[]
+        page_ids=sorted(owner)[offset:offset+limit]
+        if page_ids:
+            wanted=[[] for _ in retrievals]
+            for id in page_ids:
+                wanted[owner[id]].append(id)
+            jobs=[]
+            for index,ids in enumerate(wanted):
+                if not ids:
+                    continue
+                address,provider_port,topic=retrievals[index]
+                if len(ids)<=per_id_check_limit:
+                    # the id level of the filters ({area}/entities/{context}/{type}/+/+/{attr}) is set to each id
+                    topic=[f"{t.rsplit('/',2)[0]}/{id}/{t.rsplit('/',1)[1]}" for id in ids for t in topic]
+                jobs.append((address,provider_port,topic,set(ids)))
+            collected=PageSink(0,len(page_ids))
+            fan_out(jobs,lambda address,provider_port,topic,ids,remaining:
+                    stream_entities(address,provider_port,topic,1,collected,len(ids),'',attrs,timee,context_given=HLink,timeout=remaining,ids=ids),deadline)
+            entities=collected.page()
+
+    for entity in entities:
+        sink.emit(entity)
+    if count:
+        print(f"NGSILD-Results-Count: {total}")
+        sink.set_count(total)
+    return len(entities)
+
+
+# Function: batch_delete_entities
+# Description: This function implements entityOperations/delete, deleting every listed entity together with its provider advertisement.
+# Parameters:
+#   - entity_ids: List of the ids of the entities to delete.
+#   - my_area: The area or domain of the entities.
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - HLink (optional): Context link of the entities (default: any context).
+# Returns:
+#   - The dictionary returned by bulk_delete_entities.
+
+def batch_delete_entities(entity_ids, my_area, broker, port, HLink='', username=None, password=None, inflight=None):
+    return bulk_delete_entities(entity_ids,my_area,broker,port,HLink,username=username,password=password,inflight=inflight)
+
+
+# Function: bulk_delete_entities
+# Description: This function deletes many entities (or one attribute of each) as one bounded operation. The full set of
+# topics to clear is computed in a single pass over a retained snapshot: the attribute topics, their _timerelsystem_
+# topics, the per-id advertisements, and the advertisement of every type that has no entity left in the area. The null
+# publishes are then pipelined over one session (see mqttsession.PublishWindow), and the call returns once the broker
+# has acknowledged all of them. With -A summary the id summaries of the remaining advertisements are then updated.
+# Parameters:
+#   - entity_ids: List of the ids of the entities to delete.
+#   - my_area: The area or domain of the entities.
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - HLink (optional): Context link of the entities (default: any context).
+#   - attr (optional): Only delete this attribute of the entities (default: None, the whole entities).
+#   - inflight (optional): Maximum number of unacknowledged publishes (default: mqttsession.default_inflight_window).
+# Returns:
+#   - A dictionary with the number of entities deleted, the ids not found, the numbers of topics and advertisements
+#     cleared, the publishes not acknowledged and the elapsed seconds.
+
+@instrumentation.instrumented("entityOperations/delete")
+def bulk_delete_entities(entity_ids, my_area, broker, port, HLink='', attr=None, username=None, password=None, inflight=None):
+    start=time.monotonic()
+    H=HLink.replace('/','§') if HLink else '+'
+    ids=set(str(eid) for eid in entity_ids)
+    names=None if attr is None else {attr, attr+'_timerelsystem_CreatedAt', attr+'_timerelsystem_modifiedAt'}
+    wide=len(ids)>per_id_check_limit
+    topics=[]; found={}; present={}; id_advertisements={}
+
+    def on_message(msg):
+        if not (msg.retain and msg.payload):
+            return
+        # {area}/entities/{context}/{type}/{node}/{id}/{attr}, or provider/{broker}/{port}/{area}/{context}/{type}/{id}
+        levels=msg.topic.split('/')
+        if len(levels)!=7:
+            return
+        if levels[0]=='provider':
+            id_advertisements.setdefault((levels[4],levels[5]),{})[levels[6]]=msg.topic
+            return
+        kind=(levels[2],levels[3])
+        if wide:
+            present.setdefault(kind,set()).add(levels[5])
+        if levels[5] in ids and (names is None or levels[6] in names):
+            topics.append(msg.topic)
+            found.setdefault(kind,set()).add(levels[5])
+
+    # small batches read the topics of their ids, large ones one snapshot of the whole area
+    if wide:
+        filters=[f"{my_area}/entities/{H}/#"]
+    elif names is None:
+        filters=[f"{my_area}/entities/{H}/+/+/{eid}/#" for eid in ids]
+    else:
+        filters=[f"{my_area}/entities/{H}/+/+/{eid}/{name}" for eid in ids for name in names]
+    if attr is None:
+        # the per-id advertisements are found in the same pass
+        filters+=[f"provider/{broker}/{port}/{my_area}/{H}/+/+"] if wide else [f"provider/{broker}/{port}/{my_area}/{H}/+/{eid}" for eid in ids]
+    collect_retained(broker,port,filters,1,on_message,username=username,password=password)
+
+    advertisements=[]; retractions=[]
+    if attr is None:
+        for (context,typee),deleted in found.items():
+            by_id=id_advertisements.get((context,typee),{})
+            advertisements.extend(by_id[eid] for eid in deleted if eid in by_id)
+            if wide:
+                remaining=bool(present.get((context,typee),set())-deleted)
+            else:
+                remaining=False
+
+                def on_remaining(msg):
+                    nonlocal remaining
+                    if msg.retain and msg.payload and msg.topic.split('/')[5] not in deleted:
+                        remaining=True
+                        return True
+
+                collect_retained(broker,port,[f"{my_area}/entities/{context}/{typee}/+/+/#"],1,on_remaining,username=username,password=password)
+            if not remaining:
+                advertisements.append(f"provider/{broker}/{port}/{my_area}/{context}/{typee}")
+            elif summaryadvertisement:
+                retractions.append((f"provider/{broker}/{port}/{my_area}/{context}/{typee}",deleted))
+
+    session=get_session(broker,port,username,password)
+    window=mqttsession.PublishWindow(session, inflight or mqttsession.default_inflight_window)
+    with instrumentation.span('publish'):
+        for topic in topics+advertisements:
+            window.publish(topic,None,qos=1,retain=True)
+    with instrumentation.span('publish_flush'):
+        failed=window.flush()
+    change_filter.save()
+    # the summaries are updated once the entities are gone, so a rebuild does not find them
+    for topic,deleted in retractions:
+        retract_summary(session,broker,port,topic,deleted,username,password)
+
+    deleted=set().union(*found.values()) if found else set()
+    elapsed=time.monotonic()-start
+    if failed:
+        print(f"Warning: {failed} null publishes were not acknowledged by the broker")
+    print(f"Delete done: {len(deleted)} entities, {len(topics)} topics and {len(advertisements)} advertisements cleared, {len(ids-deleted)} not found, in {elapsed:.2f}s")
+    return {'deleted': len(deleted), 'not_found': sorted(ids-deleted), 'topics_cleared': len(topics),
+            'advertisements_cleared': len(advertisements), 'failed_publishes': failed, 'seconds': elapsed}
+
+
+# Function: entity_topic_parts
+# Description: This function extracts the topic levels of an entity (type, id and context with '/' replaced by '§').
+# Parameters:
+#   - data: The NGSI-LD entity.
+# Returns:
+#   - A (type, id, context) tuple, None if the entity lacks one of them.
+
+def entity_topic_parts(data):
+    if 'type' not in data or 'id' not in data or '@context' not in data:
+        return None
+    context=data['@context'] if isinstance(data['@context'],str) else data['@context'][0]
+    return str(data['type']), str(data['id']), context.replace("/", "§")
+
+
+# Function: topic_level_error
+# Description: This function checks that an entity id, type or attribute name can be used as a topic level: a '/' would
+# shift the levels of the topic scheme, and '+' or '#' are wildcards MQTT does not accept in a published topic.
+# Parameters:
+#   - entity_id: The id of the entity.
+#   - names (optional): Its type and attribute names (e.g. the keys of a POST or PATCH body).
+# Returns:
+#   - A description of the first invalid level, None if they are all valid.
+
+def topic_level_error(entity_id, names=()):
+    for kind,level in [('id',entity_id)]+[('name',name) for name in names]:
+        level=str(level)
+        if level=='' or any(c in level for c in '/+#'):
+            return f"Invalid entity {kind} {level!r}: it must not be empty nor contain '/', '+' or '#'"
+    return None
+
+
+# Function: existing_entity_ids
+# Description: This function answers the existence check of a whole batch with a single retained snapshot. Small batches
+# subscribe to the topics of their ids, large ones to the whole entity type, so the cost is one snapshot per
+# (context, type) instead of one blocking probe per entity.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - context: Context of the entities (with '/' replaced by '§').
+#   - typee: Type of the entities.
+#   - ids: The ids to check.
+# Returns:
+#   - The set of ids among `ids` that already exist in any area.
+
+per_id_check_limit=16
+
+@instrumentation.timed('existence_check')
+def existing_entity_ids(broker, port, context, typee, ids, username=None, password=None):
+    found=set()
+
+    def on_message(msg):
+        if msg.retain and msg.payload:
+            found.add(msg.topic.split('/')[5])
+
+    if len(ids)<=per_id_check_limit:
+        topics=[f"+/entities/{context}/{typee}/+/{id}/#" for id in ids]
+    else:
+        topics=[f"+/entities/{context}/{typee}/+/+/#"]
+    collect_retained(broker, port, topics, 1, on_message, username=username, password=password)
+    return found & set(ids)
+
+
+# Function: batch_post_entities
+# Description: This function implements entityOperations/create, update and upsert over a list of entities as a pipeline:
+# the entities are grouped by (context, type), the existence check of each group runs once against a retained snapshot,
+# each type is advertised once, and the attribute publishes are pipelined through a window of unacknowledged QoS 1/2
+# messages (see mqttsession.PublishWindow) instead of publishing entity by entity.
+# Parameters:
+#   - entities: List of NGSI-LD entities.
+#   - my_area: The area or domain of the entities.
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - qos: The quality of service level for message delivery.
+#   - my_loc: The location of the broker.
+#   - bypass_existence_check (optional): 0 to reject entities that already exist (create), 1 to overwrite them (update/upsert).
+#   - inflight (optional): Maximum number of unacknowledged publishes (default: mqttsession.default_inflight_window).
+# Returns:
+#   - A dictionary with the number of entities written and rejected, the number of unchanged attributes skipped (see
+#     changefilter.py), the elapsed seconds and the entities per second.
+
+@instrumentation.instrumented(lambda entities, my_area, broker, port, qos, my_loc, bypass_existence_check=0, *args, **kwargs:
+                               "entityOperations/upsert" if bypass_existence_check else "entityOperations/create")
+def batch_post_entities(entities, my_area, broker, port, qos, my_loc, bypass_existence_check=0, username=None, password=None, inflight=None):
+    start=time.monotonic()
+    session=get_session(broker,port,username,password)
+    window=mqttsession.PublishWindow(session, inflight or mqttsession.default_inflight_window)
+    rejected=0
+    unchanged=0
+
+    groups={}
+    for data in entities:
+        parts=entity_topic_parts(data)
+        if parts is None:
+            print(f"Error, ngsi-ld entity without a type, id or context: {data.get('id', data)}")
+            rejected+=1
+            continue
+        typee,id,context=parts
+        error=topic_level_error(id,[typee]+[k for k in data if k not in ('id','type','@context')])
+        if error is not None:
+            print(f"Error, {error}")
+            rejected+=1
+            continue
+        groups.setdefault((context,typee),{}).setdefault(id,[]).append(data)
+
+    written=0
+    for (context,typee),by_id in groups.items():
+        existing=set()
+        written_versions=[]
+        if bypass_existence_check==0 or (summaryadvertisement and not singleidadvertisement):
+            # with -A summary upserts also check, since the id summary counts the entities they create
+            existing=existing_entity_ids(broker,port,context,typee,list(by_id),username,password)
+        for id,versions in by_id.items():
+            if id in existing and bypass_existence_check==0:
+                print(f"Error entity with id {id} already exists, did you mean to patch?")
+                rejected+=len(versions)
+                continue
+            if bypass_existence_check==0 and len(versions)>1:
+                print(f"Error entity with id {id} appears {len(versions)} times in the batch, only the first one is created")
+                rejected+=len(versions)-1
+                versions=versions[:1]
+            curr_time=str(datetime.datetime.now())
+            for data in versions:
+                for k,v in data.items():
+                    if k in ('type','id','@context'):
+                        continue
+                    small_topic=f"{my_area}/entities/{context}/{typee}/LNA/{id}/{k}"
+                    # with --skip_unchanged updates and upserts only publish the attributes that changed
+                    if not change_filter.changed(broker,port,small_topic,v,force=bypass_existence_check==0):
+                        unchanged+=1
+                        continue
+                    with instrumentation.span('publish'):
+                        if codec.temporal_layout=='envelope':
+                            window.publish(small_topic,codec.encode(codec.wrap_attribute(v,[curr_time],[curr_time])),qos=qos,retain=True)
+                            continue
+                        window.publish(small_topic,codec.encode(v),qos=qos,retain=True)
+                        window.publish(small_topic+"_timerelsystem_CreatedAt",codec.encode([curr_time]),qos=qos,retain=True)
+                        window.publish(small_topic+"_timerelsystem_modifiedAt",codec.encode([curr_time]),qos=qos,retain=True)
+                written+=1
+            if singleidadvertisement:
+                advertise_provider(session,broker,port,f"provider/{broker}/{port}/{my_area}/{context}/{typee}/{id}",my_loc,[curr_time],entity_bbox(versions),username,password)
+            written_versions.extend(versions)
+
+        # one advertisement per type, covering the located entities of the batch
+        if not singleidadvertisement and written_versions:
+            advertisement=f"provider/{broker}/{port}/{my_area}/{context}/{typee}"
+            written_ids=[str(v['id']) for v in written_versions]
+            if advertise_provider(session,broker,port,advertisement,my_loc,[str(datetime.datetime.now())],entity_bbox(written_versions),username,password,
+                                  ids=written_ids,new=[i for i in written_ids if i not in existing]):
+                print("Publishing message to provider table")
+                print(advertisement)
+
+    with instrumentation.span('publish_flush'):
+        failed=window.flush()
+    change_filter.save()
+    elapsed=time.monotonic()-start
+    rate=written/elapsed if elapsed>0 else 0.0
+    if failed:
+        print(f"Warning: {failed} publishes were not acknowledged by the broker")
+    print(f"Batch done: {written} entities written, {rejected} rejected, {unchanged} unchanged attributes skipped in {elapsed:.2f}s ({rate:.0f} entities/sec)")
+    return {'written': written, 'rejected': rejected, 'unchanged_attributes': unchanged, 'failed_publishes': failed, 'seconds': elapsed,
+            'entities_per_second': rate}
+
+
+# Class: ComDeXClient
+# Description: Importable API over the ComDeX operations. Every call made through the same broker and credentials shares
+# one pooled MQTT session (see mqttsession.py), so a batch job connects once instead of once per entity or existence check.
+# Parameters:
+#   - broker (optional): The name or IP address of the broker (default: localhost).
+#   - port (optional): The port number of the broker (default: 1026).
+#   - username / password (optional): MQTT credentials.
+#   - qos (optional): The quality of service level for message delivery (default: 0).
+#   - area / loc (optional): Area and location of the node (default: read from broker_location_awareness.txt).
+#   - HLink (optional): Context link used by GET, PATCH and DELETE (default: any context).
+#   - mirror (optional): Keep a resident in-memory mirror of the broker's retained store, so existence checks, GETs and
+#     provider discovery are answered locally (default: False, see mirror.py).
+# Example:
+#   client = ComDeXClient('localhost', 1026)
+#   client.post(entity)
+#   turbines = client.get('?type=Turbine&q=rpm>100')
+#   client.get('?type=Turbine', sink=CallbackSink(print))
+
+class ComDeXClient:
+
+    def __init__(self, broker=default_broker_address, port=default_broker_port, username=None, password=None, qos=0, area=None, loc=None, HLink='', mirror=False):
+        self.broker = broker
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.qos = qos
+        self.HLink = HLink
+        my_area, my_loc = read_location_awareness(broker, self.port)
+        self.area = area if area is not None else my_area
+        self.loc = loc if loc is not None else my_loc
+        self.session = get_session(broker, self.port, username, password)
+        self.mirror = start_mirror(broker, self.port, username, password) if mirror else None
+
+    def post(self, data, bypass_existence_check=0):
+        return post_entity(data, self.area, self.broker, self.port, self.qos, self.loc, bypass_existence_check, self.session, username=self.username, password=self.password)
+
+    # Function: get
+    # Description: Runs a GET entities query. Without a sink the entities are collected and returned as a list; with a sink
+    # (e.g. sinks.CallbackSink) each entity is delivered as soon as it is complete and the number of entities is returned.
+    def get(self, query_string='', sink=None, timeout=None):
+        if sink is not None:
+            return get_entities(query_string, self.broker, self.port, self.HLink, username=self.username, password=self.password, sink=sink, timeout=timeout)
+        results = ListSink()
+        if get_entities(query_string, self.broker, self.port, self.HLink, username=self.username, password=self.password, sink=results, timeout=timeout) is None:
+            return None
+        return results.entities
+
+    # Function: count
+    # Description: Returns the number of entities matching a GET query (count=true&limit=0), without retrieving them.
+    def count(self, query_string='', timeout=None):
+        query_string = query_string[1:] if query_string.startswith('?') else query_string
+        results = ListSink()
+        if get_entities('?' + '&'.join(filter(None, [query_string, 'count=true', 'limit=0'])), self.broker, self.port, self.HLink,
+                        username=self.username, password=self.password, sink=results, timeout=timeout) is None:
+            return None
+        return results.count
+
+    def patch(self, entity_id, data, attr=''):
+        return patch_entity(entity_id, data, self.area, self.broker, self.port, self.qos, self.HLink, attr, username=self.username, password=self.password)
+
+    def delete(self, entity_id, attr=None):
+        return delete_entity(entity_id, self.area, self.broker, self.port, self.HLink, attr, username=self.username, password=self.password)
+
+    def subscribe(self, subscription, expires=3600, sink=None, window=None):
+        return create_subscription(subscription, self.area, self.broker, self.port, self.qos, expires, username=self.username, password=self.password, sink=sink, window=window)
+
+    def create(self, entities, inflight=None):
+        return batch_post_entities(entities, self.area, self.broker, self.port, self.qos, self.loc, 0, username=self.username, password=self.password, inflight=inflight)
+
+    def upsert(self, entities, inflight=None):
+        return batch_post_entities(entities, self.area, self.broker, self.port, self.qos, self.loc, 1, username=self.username, password=self.password, inflight=inflight)
+
+    update = upsert
+
+    def delete_many(self, entity_ids, inflight=None):
+        return batch_delete_entities(entity_ids, self.area, self.broker, self.port, self.HLink, username=self.username, password=self.password, inflight=inflight)
 
 
 #debug functions to see mqtt broker communication
@@ -1159,13 +2386,33 @@ def usage():
     print("-h, --help                Show this help message and exit")
     print("  -L, --lock                Lock and secure Mosquitto (disable anonymous, set credentials)")
     print("  -U, --unlock   Re-enable anonymous and reload Mosquitto")
-    print("-c, --command             Provide the command, possible commands include [POST/entities,POST/Subscriptions,DELETE/entities/,PATCH/entities/,GET/entities/,entityOperations/delete,entityOperations/create,entityOperations/update,entityOperations/upsert]")
+    print("-c, --command             Provide the command, possible commands include [POST/entities,POST/Subscriptions,DELETE/entities/,PATCH/entities/,GET/entities/,GET/temporal/entities/,entityOperations/delete,entityOperations/create,entityOperations/update,entityOperations/upsert]")
     print("-f, --file                Specify the file to be used as input to the command")
     print("-b, --broker_address      Specify the address of the MQTT broker of the ComDeX node")
     print("-p, --port                Specify the port number of the MQTT broker of the ComDeX node")
     print("-q, --qos                 Specify the Quality of Service level (0, 1, or 2) to be used for the specified command")
     print("-H, --HLink               Specify the HLink, 'context link' to be used for the GET request")
     print("-A, --singleidadvertisement Specify if single ID advertisement is to be used (use 1 for True), default is false")
+    print("                          or 'summary' for one advertisement per type summarizing its entity ids (see idsummary.py)")
+    print("--quiet_window            Seconds without retained messages after which a retained scan is considered complete (default: 0.25)")
+    print("-o, --output              Output of GET and of subscription notifications: 'pretty' (indented JSON, default), 'ndjson' (one document per line")
+    print("                          on stdout), an NDJSON file path, an http(s):// webhook or 'orionld:<broker url>' (notifications only)")
+    print("--coalesce_window         Seconds the attribute updates of an entity are merged into one notification (default: 0.05)")
+    print("--deadline                Seconds after which a GET returns with the results of the providers that answered (default: 30)")
+    print("--provider_ttl            Seconds a context provider discovery is reused from the provider cache, 0 to disable (default: 5;")
+    print("                          without a comdexd watching the broker, advertisements changed by other nodes go unnoticed until then)")
+    print("--inflight                Maximum number of unacknowledged publishes of a batch operation (default: 100)")
+    print("--payload_format          Format of the written attribute payloads: 'json' (default), 'msgpack' or 'cbor' (all are read)")
+    print("--temporal_layout         Where createdAt/modifiedAt of written attributes are stored: 'topics' (default) or 'envelope' (all are read)")
+    print("--history                 Directory of the attribute time-series store queried by GET/temporal/entities/ (see timeseries.py)")
+    print("--skip_unchanged          Updates, upserts and PATCHes only publish the attributes that changed (see changefilter.py)")
+    print("--deadband                With --skip_unchanged, numeric values within this band of the last published one count as")
+    print("                          unchanged: '<band>' for every attribute and/or '<attribute>=<band>,...'")
+    print("--profile                 Time the phases of every operation (connect, existence check, publish, advertisement, discovery,")
+    print("                          retained collection, reassembly, filter): a JSON lines file, '-' (JSON lines on stderr) or")
+    print("                          'prometheus:<file>' (counters accumulated in a Prometheus text file, see instrumentation.py)")
+    print("--reassembly_workers      Processes rebuilding and filtering the entities of large GET results, or 'auto' for one per CPU")
+    print("                          (default: 0, in-process; see parallelreassembly.py)")
     
     print("\nExample:")
     print("python3 actionhandler.py -c POST/entities -f entity.ngsild -b localhost -p 1026 -q 1 -H HLink -A 0\n")
@@ -1179,7 +2426,7 @@ def usage():
 def main(argv):
 
     try:
-        opts, args = getopt.getopt(argv,"hc:f:b:p:l:q:H:A:K:U:N:S",["command=","file=","broker_address=","port=","qos=","HLink=","singleidadvertisement=","lock=","unlock=","username=","password="])
+        opts, args = getopt.getopt(argv,"hc:f:b:p:l:q:H:A:K:U:N:So:",["command=","file=","broker_address=","port=","qos=","HLink=","singleidadvertisement=","lock=","unlock=","username=","password=","quiet_window=","output=","coalesce_window=","inflight=","provider_ttl=","deadline=","payload_format=","temporal_layout=","history=","skip_unchanged","deadband=","profile=","reassembly_workers="])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -1189,18 +2436,21 @@ def main(argv):
     file = ''
     HLink = ''
     qos = 0
-    Forwarding = 1
     broker = default_broker_address
     port = default_broker_port
     expires = 3600
-    global singleidadvertisement
+    global singleidadvertisement, summaryadvertisement
     singleidadvertisement = False
-    my_area = "unknown_area"
-    my_loc = "unknown_location"
+    summaryadvertisement = False
     lock_flag = False
     unlock_flag = False
     username = None
     password = None
+    output = None
+    coalesce_window = None
+    inflight = None
+    deadline = None
+    history = None
     # Parse ComDeX flags
     for opt, arg in opts:
         if opt == '-h':
@@ -1221,6 +2471,7 @@ def main(argv):
             HLink = arg
         elif opt in ("-A", "--singleidadvertisement"):
             singleidadvertisement = (arg == "1")
+            summaryadvertisement = (arg == "summary")
         elif opt in ("-K","--lock"):
             lock_flag = True
         elif opt in ("-U","--unlock"):
@@ -1229,6 +2480,37 @@ def main(argv):
             username = arg
         elif opt in ("-S","--password"):
             password = arg
+        elif opt == "--quiet_window":
+            mqttsession.default_quiet_window = float(arg)
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt == "--coalesce_window":
+            coalesce_window = float(arg)
+        elif opt == "--inflight":
+            inflight = int(arg)
+        elif opt == "--deadline":
+            deadline = float(arg)
+        elif opt == "--provider_ttl":
+            provider_cache.ttl = float(arg)
+        elif opt == "--payload_format":
+            if not codec.set_default_format(arg):
+                sys.exit(2)
+        elif opt == "--temporal_layout":
+            if not codec.set_temporal_layout(arg):
+                sys.exit(2)
+        elif opt == "--history":
+            history = arg
+        elif opt == "--skip_unchanged":
+            change_filter.enabled = True
+        elif opt == "--deadband":
+            if not change_filter.set_deadbands(arg):
+                sys.exit(2)
+        elif opt == "--profile":
+            if not instrumentation.configure(arg):
+                sys.exit(2)
+        elif opt == "--reassembly_workers":
+            if not parallelreassembly.configure(arg):
+                sys.exit(2)
     # print(lock_flag,unlock_flag)        
     if lock_flag:
             lock_mosquitto()
@@ -1237,59 +2519,37 @@ def main(argv):
             unlock_mosquitto()
             print("Mosquitto is now unlocked")
             
-    # Broker location awareness
-    open("broker_location_awareness.txt", "a+").close()
-    with open("broker_location_awareness.txt", "r") as f:
-        contents = f.read()
-    try:
-        location_awareness = ast.literal_eval(contents)
-        area_key = f"{broker}:{port}:area"
-        loc_key  = f"{broker}:{port}:loc"
-        if area_key in location_awareness:
-            my_area = location_awareness[area_key]
-        if loc_key in location_awareness:
-            my_loc = location_awareness[loc_key]
-    except:
-        pass
+    my_area, my_loc = read_location_awareness(broker, port)
 
     if not command:
         print("No command found, exiting..."); sys.exit(2)
-    
-    def on_connect(client, userdata, flags, rc):
-        if rc == 0:
-            print("Connected successfully.")
-        else:
-            print(f"Connection failed with return code {rc}")
-   
-    def connect_mqtt(broker_address, port, username=None, password=None):
-        client = mqtt.Client(clean_session=True)
-        client.on_connect = on_connect
 
+    def connect_mqtt(broker_address, port, username=None, password=None):
         if username and password:
-            client.username_pw_set(username, password)
             print(f"Trying to connect to {broker_address}:{port} with credentials...")
             try:
-                client.connect(broker_address, port)
-                client.loop_start()
-                return client
-            except Exception as e:
+                return get_session(broker_address, port, username, password)
+            except ConnectionError as e:
                 print("Provide correct username and password.")
                 return None
         else:
             print(f"Trying anonymous connection to {broker_address}:{port}...")
             try:
-                client.connect(broker_address, port)
-                client.loop_start()
-                return client
-            except Exception as e:
+                return get_session(broker_address, port)
+            except ConnectionError as e:
                 print("Anonymous connection failed. Provide username and password.")
                 return None
 
+    # All commands share one pooled connection to the broker
+    with instrumentation.operation("connect"):
+        session = connect_mqtt(broker, port, username=username, password=password)
+    if session is None:
+        print("Failed to connect to the broker. Exiting...")
+        return
+
     # POST ENTITIES
     if command == "POST/entities":
         print("creating new instance")
-        client = connect_mqtt(broker, port, username=username, password=password)
-        client.on_message = on_message
         if not file:
             usage(); sys.exit(2)
 
@@ -1300,300 +2560,72 @@ def main(argv):
             except json.JSONDecodeError:
                 print("Can't parse the input file, are you sure it is valid JSON?")
                 sys.exit(2)
-        if client is None:
-            print("Failed to connect to the broker. Exiting...")
-            return
-        post_entity(data, my_area, broker, port, qos, my_loc, 0, client,username=username,password=password)
+        if not post_entity(data, my_area, broker, port, qos, my_loc, 0, session,username=username,password=password): sys.exit(2)
 
     # CREATION OF SUBSCRIPTIONS
     elif command == 'POST/Subscriptions':
-        
-        truetype=''; true_id=''; entity_type_flag=False; watched_attributes_flag=False; entity_id_flag=False; watched_attributes=''
         if not file: usage(); sys.exit(2)
         print("ngsild Post Subscription command detected")
         with open(file) as jf:
             try: data=json.load(jf)
             except: print("Can't parse the input file, are you sure it is valid json?"); sys.exit(2)
-        if data.get('type')!='Subscription': print(f"Subscription has invalid type: {data.get('type')}"); sys.exit(2)
-        sid = str(data['id']) if 'id' in data else (print("Error, ngsi-ld Subscription without a id "), sys.exit(2))[0]
-        ctx = data.get('@context');
-        if isinstance(ctx,str): context=ctx.replace('/','§')
-        else: context=ctx[0].replace('/','§') if ctx else '+'
-        if 'entities' in data:
-            ie=data['entities'][0]
-            if 'type' in ie: truetype=str(ie['type']); entity_type_flag=True
-            if 'id' in ie:   true_id=str(ie['id']);   entity_id_flag=True
-        if 'watchedAttributes' in data:
-            watched_attributes=data['watchedAttributes']; watched_attributes_flag=True
-            if watched_attributes is None: print("Watched attributes without content, exiting...."); sys.exit(2)
-        expires=int(data.get('expires',expires))
-        if not (entity_type_flag or watched_attributes_flag or entity_id_flag): print("Error, ngsi-ld subscription without information about topics, exiting.... "); sys.exit(2)
-        big_topic=f"{my_area}/Subscriptions/{context}/Subscription/LNA/{sid}"
-
-        client1=connect_mqtt(broker,port,username=username,password=password)
-        if client1 is None:
-            print("Failed to connect to the broker. Exiting...")
-            return
-        client1.on_message=on_message; 
-        client1.publish(big_topic,str(data),qos=qos); client1.loop_stop()
-        area=data.get('area',['+']); truetype2=truetype or '#'; trueid2=true_id or '#'; check_top=[]
-        for z in area:
-            if not singleidadvertisement: check_top.append(f"provider/+/+/{z}/{context}/{truetype2}")
-            else:                      check_top.append(f"provider/+/+/{z}/{context}/{truetype}/{trueid2}")
-        subscribe_for_advertisement_notification(broker,port,check_top,expires,qos,entity_type_flag,watched_attributes_flag,entity_id_flag,watched_attributes,true_id,username=username,password=password)
+        try: sink=make_sink(output) if output else None
+        except (ValueError,OSError) as e: print(e); sys.exit(2)
+        if not create_subscription(data,my_area,broker,port,qos,expires,username=username,password=password,sink=sink,window=coalesce_window): sys.exit(2)
 
     # DELETE/entities/
     elif re.search(r"DELETE/entities/",command):
-        username =username
-        password = password
-        client=connect_mqtt(broker,port,username=username,password=password)
-        if client is None:
-            print("Failed to connect to the broker. Exiting...")
-            return
         parts=command.split('/')
         if len(parts)<5:
-            H=HLink.replace('/','§') if HLink else '+'; eid=parts[2]
-            top=f"{my_area}/entities/{H}/+/+/{eid}/#"
-            if not check_existence(broker,port,top,username=username,password=password ): print("Entity with this id doesn't exist, no need for deletion"); sys.exit(2)
-            clear_retained(broker,port,top,username=username,password=password)
-            tp=exists_topic.split('/')[-4]; tc=f"{my_area}/entities/{H}/{tp}/+/+/#"
-            if not singleidadvertisement:
-                spec=f"provider/{broker}/{port}/{my_area}/{H}/{tp}"
-                if not check_existence(broker,port,tc,username=username,password=password): clear_retained(broker,port,spec,username=username,password=password)
-            else: spec=f"provider/{broker}/{port}/{my_area}/{H}/{tp}/{eid}"; clear_retained(broker,port,spec,username=username,password=password)
+            if not delete_entity(parts[2],my_area,broker,port,HLink,username=username,password=password): sys.exit(2)
         else:
-            H=HLink.replace('/','§') if HLink else '+'
             if parts[3]!='attrs': print("Please check delete attr cmd"); sys.exit(2)
-            eid=parts[2]; top=f"{my_area}/entities/{H}/+/+/{eid}/{parts[4]}"; clear_retained(broker,port,top,username=username,password=password)
+            if not delete_entity(parts[2],my_area,broker,port,HLink,attr=parts[4],username=username,password=password): sys.exit(2)
 
     # PATCH/entities/
     elif re.search(r"PATCH/entities/",command):
-        client=connect_mqtt(broker,port,username=username,password=password)
-        if client is None:
-            print("Failed to connect to the broker. Exiting...")
-            return
-        
-        H=HLink.replace('/','§') if HLink else '+'; parts=command.split('/')
+        parts=command.split('/')
         if len(parts)<5 or parts[3]!='attr': print("Please check patch cmd"); sys.exit(2)
-        eid=parts[2]; ct=f"+/entities/{H}/+/+/{eid}/#";
-        if not check_existence(broker,port,ct,username=username,password=password): print("Error: id doesn't exist"); sys.exit(2)
         with open(file) as jf: data=json.load(jf)
-        
-        client.on_message=on_message; 
-        tp=exists_topic.split('/')[-4]; loc=exists_topic.split('/')[-3]
-        if parts[4]=='':
-            for k,v in data.items():
-                if k not in ('type','id','@context'):
-                    st=f"{my_area}/entities/{H}/{tp}/LNA/{eid}/{k}"; client.publish(st,str(v),retain=True,qos=qos)
-                    now=str(datetime.datetime.now()); rel={'modifiedAt':[now]}
-                    client.publish(f"{my_area}/entities/{H}/{tp}/LNA/{eid}/{k}_timerelsystem_modifiedAt",str(rel['modifiedAt']),retain=True,qos=qos)
-        else:
-            for k,v in data.items():
-                st=f"{my_area}/entities/{H}/{tp}/{loc}/{eid}/{k}"; client.publish(st,str(v),retain=True,qos=qos)
-                now=str(datetime.datetime.now()); rel={'modifiedAt':[now]}
-                client.publish(f"{my_area}/entities/{H}/{tp}/LNA/{eid}/{k}_timerelsystem_modifiedAt",str(rel['modifiedAt']),retain=True,qos=qos)
-        client.loop_stop()
+        if not patch_entity(parts[2],data,my_area,broker,port,qos,HLink,attr=parts[4],username=username,password=password): sys.exit(2)
+
+    # GET/temporal/entities/
+    elif re.search(r"GET/temporal/entities/",command):
+        if not history: print("GET/temporal/entities/ needs the --history directory of a recorder (see timeseries.py)"); sys.exit(2)
+        sink=make_sink(output or 'pretty')
+        try:
+            if query_temporal(history,command.split("GET/temporal/entities/")[1],HLink,sink) is None: sys.exit(2)
+        finally:
+            sink.close()
 
     # GET/entities/
     elif re.search(r"GET/entities/",command):
-        context_flag=True
-        entity_id_flag=False
-        entity_id_pattern_flag=False
-        entity_type_flag=False
-        entity_attrs_flag=False
-        entity_query_flag=False
-        context_flag=True
-        topic=[]
-        area=[]
-        typee_multi=[]
-        timee=''
-        limit=1800
-        id='+'
-        attrs='#'
-        query=''
-        geometry=''
-        georel=''
-        coordinates=''
-        geoproperty='location'  #default value for ngsild
-        geovar_count=0
-
         print("Get entity command found")
-        client=connect_mqtt(broker,port,username=username,password=password)
-        if client is None:
-            print("Failed to connect to the broker. Exiting...")
-            return
-
-        if HLink=='':
-            HLink='+'
-            context_flag=False
-        else:
-            HLink=HLink.replace("/", "§")
-
-        command_parts = command.split("GET/entities/")
-        command=command_parts[1]
-        if len(command) > 0 and command[0] == "?":
-            command=command[1:]
-        command_parts = command.split("&")
-
-        for current in command_parts:
-            current=current.split("=", 1)
-            print(current[0])
-            if(current[0]=="id"):
-                print("id detected")
-                entity_id_flag=True
-                id=current[1]
-            elif(current[0]=="idPattern"):
-                entity_id_pattern_flag=True
-                print("id pattern detected")
-            elif(current[0]=="type"):
-                entity_type_flag=True
-                typee_multi=current[1].split(',')
-                print("type detected")
-            elif(current[0]=="time"):
-                timee=current[1]
-                print("time detected")
-            elif(current[0]=="limit"):
-                limit=int(current[1])
-                print("pagination limit detected")
-            elif(current[0]=="attrs"):
-                entity_attrs_flag=True
-                attrs=current[1].split(',')
-                print("attrs detected")
-            elif(current[0]=="q"):
-                entity_query_flag=True
-                query=current[1]
-                print("query detected")
-            elif(current[0]=="geoproperty"):
-                geoproperty=current[1]
-                print("geoproperty detected")
-            elif(current[0]=="geometry"):
-                geometry=current[1]
-                print("geometry detected")
-                geovar_count+=1
-            elif(current[0]=="georel"):
-                georel=current[1]
-                print("georel detected")
-                geovar_count+=1
-            elif(current[0]=="coordinates"):
-                coordinates=current[1]
-                print("coordinates detected")
-                geovar_count+=1
-            elif(current[0]=="area"):
-                area=current[1].split(',')
-            else:
-                print("Query not recognised")
-                return
-
-        if(geovar_count!=0 and geovar_count!=3):
-            print("Incomplete geoquery!")
-            return
-
-        if(area==[]):
-            area.append('+')
-
-        if(entity_type_flag==False):
-            typee_multi=[1]
-        if(entity_id_flag==False):
-            id="#"
-
-        for typee in typee_multi:
-            messages_for_context=[]
-            check_top=[]
-            if(typee==1):
-                typee="#"
-
-            for z in area:
-                if(singleidadvertisement==False):
-                    check_topic2=f"provider/+/+/{z}/{HLink}/{typee}"
-                else:
-                    if(typee=="#"):
-                        typee="+"
-                    check_topic2=f"provider/+/+/{z}/{HLink}/{typee}/{id}"
-                check_top.append(check_topic2)
-
-            if(Forwarding==1):
-                messages_for_context=GET(broker,port,check_top,0.1,1,username=username,password=password)
-            if(typee=="#"):
-                typee="+"
-
-            context_providers_addresses=[]
-            context_providers_ports=[]
-            context_providers_areas=[]
-            context_providers_full=[]
-
-            if (Forwarding==1):
-                for messg in messages_for_context:
-                    initial_topic=(messg.topic).split('/')
-                    if initial_topic[1]+initial_topic[2]+initial_topic[3] in context_providers_full:
-                        continue
-                    context_providers_addresses.append(initial_topic[1])
-                    context_providers_ports.append(initial_topic[2])
-                    context_providers_areas.append(initial_topic[3])
-                    context_providers_full.append(str(initial_topic[1]+initial_topic[2]+initial_topic[3]))
-                    top=initial_topic[3]
-                    if attrs!='#':
-                        for i in attrs:
-                            top=f"{initial_topic[3]}/entities/{HLink}/{typee}/+/{id}/{i}"
-                            topic.append(top)
-                    else:
-                        top=f"{initial_topic[3]}/entities/{HLink}/{typee}/+/{id}/#"
-                        topic.append(top)
-                    messages=GET(initial_topic[1],int(initial_topic[2]),topic,0.5,1,limit)
-                    if messages:
-                        recreate_multiple_entities(messages,query,attrs,timee=timee,limit=limit,georel=georel,geometry=geometry,coordinates=coordinates,geoproperty=geoproperty,context_given=HLink)
-            else:
-                print("Forwarding left by default for now")
+        sink=make_sink(output or 'pretty')
+        try:
+            get_entities(command.split("GET/entities/")[1],broker,port,HLink,username=username,password=password,sink=sink,timeout=deadline)
+        finally:
+            sink.close()
 
     elif re.search(r"entityOperations/delete",command):
         # batch delete
-        client= connect_mqtt(broker,port,username=username,password=password)
-        if client is None:
-            print("Failed to connect to the broker. Exiting...")
-            return
         with open(file) as jf: json_obj=json.load(jf)
-        for eid in json_obj:
-            top=f"{my_area}/entities/{(HLink or '+').replace('/','§')}/+/+/{eid}/#"
-            if check_existence(broker,port,top,username=username,password=password):
-                clear_retained(broker,port,top,username=username,password=password)
-                tp=exists_topic.split('/')[-4]
-                tc=f"{my_area}/entities/{(HLink or '+').replace('/','§')}/{tp}/#/"
-                if not singleidadvertisement:
-                    spec=f"provider/{broker}/{port}/{my_area}/{(HLink or '+').replace('/','§')}/{tp}/+"; clear_retained(broker,port,spec,username=username,password=password)
-                else:
-                    spec=f"provider/{broker}/{port}/{my_area}/{(HLink or '+').replace('/','§')}/{tp}/{eid}"; clear_retained(broker,port,spec,username=username,password=password)
+        batch_delete_entities(json_obj,my_area,broker,port,HLink,username=username,password=password,inflight=inflight)
 
     # entityOperations/create
     elif re.search(r"entityOperations/create",command):
-        advertisement_exists={}
-    
-        client=connect_mqtt(broker,port,username=username,password=password)
-        if client is None:  
-            print("Failed to connect to the broker. Exiting...")
-            return
-        client.on_message=on_message;
         with open(file) as jf: json_list=json.load(jf)
-        for data in json_list:
-            t=data.get('type','')
-            bypass=0 if singleidadvertisement or t in advertisement_exists else 0
-            post_entity(data,my_area,broker,port,qos,my_loc,bypass,client,username=username,password=password)
-            advertisement_exists.setdefault(t,[])
+        batch_post_entities(json_list,my_area,broker,port,qos,my_loc,0,username=username,password=password,inflight=inflight)
 
     # entityOperations/update
     elif re.search(r"entityOperations/update",command):
-        client=connect_mqtt(broker,port,username=username,password=password)
-        client.on_message=on_message; 
         with open(file) as jf: json_list=json.load(jf)
-        for data in json_list: post_entity(data,my_area,broker,port,qos,my_loc,1,client,username=username,password=password)
+        batch_post_entities(json_list,my_area,broker,port,qos,my_loc,1,username=username,password=password,inflight=inflight)
 
     # entityOperations/upsert
     elif re.search(r"entityOperations/upsert",command):
-        client=connect_mqtt(broker,port,username=username,password=password)
-        if client is None:
-            print("Failed to connect to the broker. Exiting...")
-            return
-        client.on_message=on_message; 
         with open(file) as jf: json_list=json.load(jf)
-        for data in json_list: post_entity(data,my_area,broker,port,qos,my_loc,1,client,username=username,password=password)
+        batch_post_entities(json_list,my_area,broker,port,qos,my_loc,1,username=username,password=password,inflight=inflight)
 
     else:
         print(f"Unknown command: {command}"); usage(); sys.exit(2)
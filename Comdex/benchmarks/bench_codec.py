@@ -0,0 +1,85 @@
+# ComDeX payload codec microbenchmark
+#
+# Measures encode/decode throughput of attribute payloads for every payload
+# format available (codec.py), next to the legacy str(dict) repr written by
+# older ComDeX versions and the quote-replacing decoder that used to read it.
+#
+# Usage:
+#   python3 benchmarks/bench_codec.py [-n ATTRIBUTES]
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import codec
+
+
+def synthetic_attributes(count, seed=1):
+    rng = random.Random(seed)
+    attributes = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            attributes.append({'type': 'Property', 'value': round(rng.uniform(0, 1000), 3),
+                               'unitCode': 'RPM', 'observedAt': '2024-05-01T10:00:00Z'})
+        elif kind == 1:
+            attributes.append({'type': 'GeoProperty', 'value': {'type': 'Point',
+                               'coordinates': [round(rng.uniform(-180, 180), 6), round(rng.uniform(-90, 90), 6)]}})
+        else:
+            attributes.append({'type': 'Property', 'value': f"Operator's note {i}: valve \"B\" checked"})
+    return attributes
+
+
+def legacy_decode(payload):
+    return json.loads(payload.decode('utf-8').replace("'", '"'))
+
+
+def measure(function, items):
+    start = time.perf_counter()
+    results = [function(item) for item in items]
+    return time.perf_counter() - start, results
+
+
+def run(attributes):
+    report = {'benchmark': 'payload_codec', 'attributes': len(attributes), 'orjson': codec.orjson is not None, 'formats': {}}
+
+    seconds, legacy = measure(lambda value: str(value).encode('utf-8'), attributes)
+    entry = {'encode_per_second': round(len(attributes) / seconds), 'bytes_per_payload': round(sum(map(len, legacy)) / len(legacy), 1)}
+    seconds, decoded = measure(codec.decode, legacy)
+    entry['decode_per_second'] = round(len(attributes) / seconds)
+    entry['roundtrip_ok'] = decoded == attributes
+    failed = 0
+    start = time.perf_counter()
+    for payload in legacy:
+        try:
+            legacy_decode(payload)
+        except ValueError:
+            failed += 1
+    entry['quote_replace_decode_per_second'] = round(len(attributes) / (time.perf_counter() - start))
+    entry['quote_replace_failures'] = failed
+    report['formats']['legacy_repr'] = entry
+
+    for fmt in codec.available_formats():
+        seconds, payloads = measure(lambda value: codec.encode(value, fmt), attributes)
+        entry = {'encode_per_second': round(len(attributes) / seconds), 'bytes_per_payload': round(sum(map(len, payloads)) / len(payloads), 1)}
+        seconds, decoded = measure(codec.decode, payloads)
+        entry['decode_per_second'] = round(len(attributes) / seconds)
+        entry['roundtrip_ok'] = decoded == attributes
+        report['formats'][fmt] = entry
+    return report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Encode/decode throughput of ComDeX attribute payloads')
+    parser.add_argument('-n', '--attributes', type=int, default=100000)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(synthetic_attributes(args.attributes)), indent=4))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
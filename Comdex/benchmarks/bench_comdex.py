@@ -0,0 +1,312 @@
+# ComDeX end-to-end benchmark suite
+#
+# Drives actionhandler operations with synthetic NGSI-LD entities against the
+# stand-in MQTT broker (standin_broker.py, started as a local subprocess so
+# no external service is needed and the CPU figures count ComDeX only), or
+# against an existing broker given with --broker. Reports as JSON:
+#
+#   - post: throughput of post_entity (with its existence check), of
+#     batch_post_entities and of bulk_delete_entities;
+#   - get: GET latency (p50/p99) per query kind, for every entity count of
+#     --sizes;
+#   - subscription: latency from a PATCH to the notification callback;
+#   - recreate: recreate_multiple_entities throughput on in-memory messages,
+#     without a broker (on --reassembly_workers processes, see
+#     parallelreassembly.py).
+#
+# Every figure comes with the CPU time of this process per operation.
+#
+# Usage:
+#   python3 benchmarks/bench_comdex.py [--sizes 100,1000] [--attributes 4] [--value_bytes 16] [--areas 1]
+#                                      [--types Turbine:3,Pump:1] [--repeat 10] [--broker host:port] [--reassembly_workers n]
+#                                      [-o report.json]
+
+import os
+import io
+import sys
+import json
+import time
+import queue
+import random
+import tempfile
+import argparse
+import platform
+import contextlib
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+# keep the provider cache of the benchmark away from the user's one
+os.environ.setdefault('COMDEX_PROVIDER_CACHE', os.path.join(tempfile.mkdtemp(prefix='comdex-bench-'), 'providers.json'))
+
+import paho.mqtt.client as mqtt
+import actionhandler
+import codec
+import mqttsession
+import parallelreassembly
+from sinks import ListSink
+
+core_context = 'https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld'
+
+
+def start_broker():
+    process = subprocess.Popen([sys.executable, os.path.join(here, 'standin_broker.py')], stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith('port '):
+        process.kill()
+        raise RuntimeError('the stand-in broker did not start')
+    return process, int(line.split()[1])
+
+
+def parse_types(spec):
+    types = []
+    for part in spec.split(','):
+        name, _, weight = part.partition(':')
+        types += [name] * int(weight or 1)
+    return types
+
+
+class Workload:
+
+    def __init__(self, args):
+        self.attributes = max(1, args.attributes)
+        self.value_bytes = args.value_bytes
+        self.areas = [f"area{i}" for i in range(max(1, args.areas))]
+        self.types = parse_types(args.types)
+        self.rng = random.Random(1)
+
+    def entity_type(self, i):
+        return self.types[i % len(self.types)]
+
+    def area(self, i):
+        return self.areas[i % len(self.areas)]
+
+    def entity_id(self, i, prefix='bench'):
+        return f"urn:ngsi-ld:{self.entity_type(i)}:{prefix}{i:07d}"
+
+    def entity(self, i, prefix='bench'):
+        entity = {'id': self.entity_id(i, prefix), 'type': self.entity_type(i), '@context': core_context,
+                  'rpm': {'type': 'Property', 'value': i % 1000},
+                  'location': {'type': 'GeoProperty', 'value': {'type': 'Point',
+                               'coordinates': [round(self.rng.uniform(5, 6), 6), round(self.rng.uniform(45, 46), 6)]}}}
+        for k in range(1, self.attributes):
+            entity[f"attr{k}"] = {'type': 'Property', 'value': 'x' * self.value_bytes}
+        return entity
+
+    def by_area(self, indices, prefix='bench'):
+        groups = {}
+        for i in indices:
+            groups.setdefault(self.area(i), []).append(self.entity(i, prefix))
+        return groups
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def latency_report(latencies, cpu_seconds):
+    return {'operations': len(latencies),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+            'cpu_ms_per_operation': round(cpu_seconds / len(latencies) * 1000, 3)}
+
+
+def throughput_report(operations, seconds, cpu_seconds):
+    return {'operations': operations, 'seconds': round(seconds, 3),
+            'per_second': round(operations / seconds, 1) if seconds else None,
+            'cpu_ms_per_operation': round(cpu_seconds / operations * 1000, 4) if operations else None}
+
+
+@contextlib.contextmanager
+def measured(result):
+    # ComDeX reports its progress on stdout, it is silenced while measuring
+    wall, cpu = time.perf_counter(), time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+    result['seconds'] = time.perf_counter() - wall
+    result['cpu'] = time.process_time() - cpu
+
+
+def bench_post(workload, broker, port, count):
+    report = {}
+    session = mqttsession.get_session(broker, port)
+    m = {}
+    with measured(m):
+        for i in range(count):
+            actionhandler.post_entity(workload.entity(i, 'post'), workload.area(i), broker, port, 1, 'bench_location', 0, session)
+        session.sync()
+    report['post_entity'] = throughput_report(count, m['seconds'], m['cpu'])
+
+    with measured(m):
+        for area, entities in workload.by_area(range(count, 2 * count), 'post').items():
+            actionhandler.batch_post_entities(entities, area, broker, port, 1, 'bench_location', 0)
+    report['batch_post_entities'] = throughput_report(count, m['seconds'], m['cpu'])
+
+    with measured(m):
+        for area, entities in workload.by_area(range(2 * count), 'post').items():
+            actionhandler.bulk_delete_entities([entity['id'] for entity in entities], area, broker, port, core_context)
+    report['bulk_delete_entities'] = throughput_report(2 * count, m['seconds'], m['cpu'])
+    return report
+
+
+def get_queries(workload, size):
+    rng = random.Random(size)
+    entity_type = workload.entity_type(0)
+    return {
+        'by_id': lambda: f"?type={entity_type}&id={workload.entity_id(rng.randrange(0, size, len(workload.types)))}",
+        'page_of_100': lambda: f"?type={entity_type}&limit=100&offset={rng.randrange(0, max(1, size // len(workload.types)))}",
+        'q_filter': lambda: f"?type={entity_type}&q=rpm%3E=990&limit=100",
+        'geo_within': lambda: f"?type={entity_type}&geoproperty=location&georel=within&geometry=Polygon"
+                              f"&coordinates=[[[5.0,45.0],[5.1,45.0],[5.1,45.1],[5.0,45.1],[5.0,45.0]]]&limit=100",
+        'count': lambda: "?count=true&limit=0",
+    }
+
+
+def bench_get(workload, broker, port, sizes, repeat):
+    report = {}
+    loaded = 0
+    for size in sorted(sizes):
+        m = {}
+        with measured(m):
+            for area, entities in workload.by_area(range(loaded, size)).items():
+                actionhandler.batch_post_entities(entities, area, broker, port, 1, 'bench_location', 1)
+        entry = {'load': throughput_report(size - loaded, m['seconds'], m['cpu'])}
+        loaded = size
+        for name, query in get_queries(workload, size).items():
+            latencies = []
+            cpu = 0.0
+            for _ in range(repeat):
+                query_string = query()
+                results = ListSink()
+                with measured(m):
+                    actionhandler.get_entities(query_string, broker, port, core_context, sink=results)
+                latencies.append(m['seconds'])
+                cpu += m['cpu']
+            entry[name] = latency_report(latencies, cpu)
+            entry[name]['results'] = results.count if results.count is not None else len(results.entities)
+        report[str(size)] = entry
+    return report
+
+
+def bench_subscription(workload, broker, port, repeat):
+    entity = workload.entity(0, 'sub')
+    area = workload.area(0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        actionhandler.batch_post_entities([entity], area, broker, port, 1, 'bench_location', 1)
+    received = queue.Queue()
+    handler = actionhandler.notification_handler(core_context)
+
+    def on_message(msg):
+        handler(msg)
+        received.put(time.perf_counter())
+
+    topics = actionhandler.subscription_topics(True, True, True, area, core_context.replace('/', '§'), entity['type'], entity['id'], ['rpm'])
+    session = mqttsession.get_session(broker, port)
+    with contextlib.redirect_stdout(io.StringIO()):
+        handlers = [session.subscribe(topic, 1, on_message) for topic in topics]
+        for subscribed in handlers:
+            session.wait_subscribed(subscribed, mqttsession.default_connect_timeout)
+        # the retained value replayed on subscription is not a notification of the run
+        session.sync()
+    while not received.empty():
+        received.get()
+    latencies = []
+    cpu = 0.0
+    lost = 0
+    for i in range(repeat):
+        m = {}
+        with measured(m):
+            start = time.perf_counter()
+            actionhandler.patch_entity(entity['id'], {'rpm': {'type': 'Property', 'value': i}}, area, broker, port, 1, core_context, 'rpm')
+            try:
+                latencies.append(received.get(timeout=5) - start)
+            except queue.Empty:
+                lost += 1
+        cpu += m['cpu']
+    for subscribed in handlers:
+        session.unsubscribe(subscribed)
+    report = latency_report(latencies, cpu) if latencies else {'operations': 0}
+    report['lost_notifications'] = lost
+    return report
+
+
+def bench_recreate(workload, count):
+    messages = []
+    context = core_context.replace('/', '§')
+    for i in range(count):
+        entity = workload.entity(i)
+        for name, value in entity.items():
+            if name in ('id', 'type', '@context'):
+                continue
+            msg = mqtt.MQTTMessage(topic=f"{workload.area(i)}/entities/{context}/{entity['type']}/LNA/{entity['id']}/{name}".encode('utf-8'))
+            msg.payload = codec.encode(value)
+            messages.append(msg)
+    results = ListSink()
+    m = {}
+    with measured(m):
+        actionhandler.recreate_multiple_entities(messages, limit=count + 1, context_given=core_context, sink=results)
+    report = throughput_report(len(results.entities), m['seconds'], m['cpu'])
+    report['messages'] = len(messages)
+    return report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='End-to-end throughput and latency of ComDeX operations')
+    parser.add_argument('--sizes', default='100,1000', help='entity counts the GET latencies are measured at')
+    parser.add_argument('--attributes', type=int, default=4, help='attributes per entity, besides location')
+    parser.add_argument('--value_bytes', type=int, default=16, help='size of the string attribute values')
+    parser.add_argument('--areas', type=int, default=1, help='number of areas the entities are spread over')
+    parser.add_argument('--types', default='Turbine:3,Pump:1', help='entity type mix, type:weight pairs')
+    parser.add_argument('--repeat', type=int, default=10, help='queries per GET kind and PATCHes for the subscription latency')
+    parser.add_argument('--post_entities', type=int, default=1000, help='entities of the POST throughput runs')
+    parser.add_argument('--broker', default=None, help='host:port of an existing broker (default: start the stand-in broker)')
+    parser.add_argument('--payload_format', default='json', choices=codec.available_formats())
+    parser.add_argument('--reassembly_workers', default='0', help="processes reassembling large GET results, or 'auto'")
+    parser.add_argument('-o', '--output', default=None, help='write the report to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    codec.set_default_format(args.payload_format)
+    if not parallelreassembly.configure(args.reassembly_workers):
+        sys.exit(2)
+    parallelreassembly.start()
+    workload = Workload(args)
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    process = None
+    if args.broker:
+        broker, _, port = args.broker.rpartition(':')
+        port = int(port)
+    else:
+        process, port = start_broker()
+        broker = '127.0.0.1'
+    try:
+        report = {
+            'benchmark': 'comdex_suite',
+            'python': platform.python_version(),
+            'broker': args.broker or 'standin',
+            'workload': {'sizes': sizes, 'attributes': workload.attributes, 'value_bytes': args.value_bytes,
+                         'areas': len(workload.areas), 'types': args.types, 'repeat': args.repeat,
+                         'payload_format': args.payload_format, 'temporal_layout': codec.temporal_layout,
+                         'reassembly_workers': parallelreassembly.workers},
+            'recreate': bench_recreate(workload, max(sizes)),
+            'post': bench_post(workload, broker, port, args.post_entities),
+            'get': bench_get(workload, broker, port, sizes, args.repeat),
+            'subscription': bench_subscription(workload, broker, port, args.repeat),
+        }
+    finally:
+        mqttsession.close_sessions()
+        if process is not None:
+            process.terminate()
+            process.wait()
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
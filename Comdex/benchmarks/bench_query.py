@@ -0,0 +1,67 @@
+# ComDeX q-query microbenchmark
+#
+# Measures the per-entity cost of filtering reassembled entities with a
+# compiled NGSI-LD q expression (ngsildquery.compile_query).
+#
+# Usage:
+#   python3 benchmarks/bench_query.py [-n ENTITIES] [-q QUERY]
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ngsildquery import compile_query
+
+default_query = 'rpm>100;(status=="running"|status=="starting");temperature.unitCode=="CEL";site~=^plant-[0-9]+$'
+
+
+def synthetic_attributes(count, seed=1):
+    rng = random.Random(seed)
+    statuses = ['running', 'starting', 'stopped', 'maintenance']
+    entities = []
+    for i in range(count):
+        entities.append({
+            'rpm': {'type': 'Property', 'value': rng.randint(0, 200)},
+            'status': {'type': 'Property', 'value': rng.choice(statuses)},
+            'temperature': {'type': 'Property', 'value': round(rng.uniform(5, 40), 1),
+                            'unitCode': {'type': 'Property', 'value': 'CEL'}},
+            'site': {'type': 'Property', 'value': f"plant-{i % 20}"},
+        })
+    return entities
+
+
+def run(entities, query):
+    start = time.perf_counter()
+    predicate = compile_query.__wrapped__(query)
+    compile_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matched = sum(1 for attributes in entities if predicate(attributes))
+    filter_seconds = time.perf_counter() - start
+
+    return {
+        'benchmark': 'q_filter',
+        'query': query,
+        'entities': len(entities),
+        'matched': matched,
+        'compile_us': round(compile_seconds * 1e6, 2),
+        'filter_total_ms': round(filter_seconds * 1e3, 2),
+        'per_entity_ns': round(filter_seconds * 1e9 / max(len(entities), 1), 1),
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Per-entity cost of compiled NGSI-LD q filtering')
+    parser.add_argument('-n', '--entities', type=int, default=100000)
+    parser.add_argument('-q', '--query', default=default_query)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(synthetic_attributes(args.entities), args.query), indent=4))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
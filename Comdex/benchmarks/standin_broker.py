@@ -0,0 +1,257 @@
+# ComDeX stand-in MQTT broker
+#
+# Minimal in-process MQTT 3.1.1 broker used by the benchmark suite so that
+# ComDeX operations can be measured without an external Mosquitto instance.
+# It supports what actionhandler.py relies on: CONNECT (credentials are
+# accepted but not checked), retained messages (a zero-length retained
+# publish clears the topic), SUBSCRIBE/UNSUBSCRIBE with '+' and '#'
+# wildcards, QoS 0/1/2 on the inbound side and QoS 0/1 on the outbound side,
+# PINGREQ and DISCONNECT. Retained messages are replayed in topic order right
+# after the SUBACK, the same way Mosquitto walks its retained tree.
+#
+# Run on its own, it serves until interrupted and prints its port first:
+#   python3 benchmarks/standin_broker.py [--port 1883]
+
+import sys
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def topic_matches(sub, topic):
+    sub_levels = sub.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(sub_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+def _encode_length(length):
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        out.append(byte)
+        if length == 0:
+            return bytes(out)
+
+
+def _utf8(data, offset):
+    (length,) = struct.unpack_from('!H', data, offset)
+    offset += 2
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+class _ClientHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.subscriptions = {}
+        self.next_mid = 0
+        self.buffer = b''
+
+    def _read_exact(self, size):
+        while len(self.buffer) < size:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                raise ConnectionError
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def _read_packet(self):
+        header = self._read_exact(1)[0]
+        multiplier, length = 1, 0
+        while True:
+            byte = self._read_exact(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, self._read_exact(length)
+
+    def send(self, packet_type, flags, body):
+        packet = bytes([(packet_type << 4) | flags]) + _encode_length(len(body)) + body
+        with self.send_lock:
+            self.request.sendall(packet)
+
+    def deliver(self, topic, payload, qos, retain):
+        encoded = topic.encode('utf-8')
+        body = struct.pack('!H', len(encoded)) + encoded
+        if qos > 0:
+            qos = 1
+            with self.send_lock:
+                self.next_mid = self.next_mid % 65535 + 1
+                mid = self.next_mid
+            body += struct.pack('!H', mid)
+        self.send(PUBLISH, (qos << 1) | (1 if retain else 0), body + payload)
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            while True:
+                header, body = self._read_packet()
+                packet_type, flags = header >> 4, header & 0x0F
+                if packet_type == CONNECT:
+                    self.send(CONNACK, 0, b'\x00\x00')
+                    broker.add_client(self)
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    retain = flags & 0x01
+                    topic, offset = _utf8(body, 0)
+                    if qos > 0:
+                        (mid,) = struct.unpack_from('!H', body, offset)
+                        offset += 2
+                    broker.publish(topic, body[offset:], qos, retain)
+                    if qos == 1:
+                        self.send(PUBACK, 0, struct.pack('!H', mid))
+                    elif qos == 2:
+                        self.send(PUBREC, 0, struct.pack('!H', mid))
+                elif packet_type == PUBREL:
+                    self.send(PUBCOMP, 0, body[:2])
+                elif packet_type == PUBREC:
+                    self.send(PUBREL, 2, body[:2])
+                elif packet_type == SUBSCRIBE:
+                    (mid,) = struct.unpack_from('!H', body, 0)
+                    offset, granted, filters = 2, [], []
+                    while offset < len(body):
+                        sub, offset = _utf8(body, offset)
+                        qos = body[offset] & 0x03
+                        offset += 1
+                        filters.append((sub, qos))
+                        granted.append(min(qos, 1))
+                    with broker.lock:
+                        for sub, qos in filters:
+                            self.subscriptions[sub] = qos
+                    self.send(SUBACK, 0, struct.pack('!H', mid) + bytes(granted))
+                    for sub, qos in filters:
+                        for topic, payload, retained_qos in broker.retained_matching(sub):
+                            self.deliver(topic, payload, min(qos, retained_qos), True)
+                elif packet_type == UNSUBSCRIBE:
+                    (mid,) = struct.unpack_from('!H', body, 0)
+                    offset = 2
+                    with broker.lock:
+                        while offset < len(body):
+                            sub, offset = _utf8(body, offset)
+                            self.subscriptions.pop(sub, None)
+                    self.send(UNSUBACK, 0, struct.pack('!H', mid))
+                elif packet_type == PINGREQ:
+                    self.send(PINGRESP, 0, b'')
+                elif packet_type == DISCONNECT:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            broker.remove_client(self)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Class: StandInBroker
+# Description: In-process MQTT broker. Use it as a context manager or call start()/stop(); port 0 picks a free port,
+# available afterwards as broker.port.
+# Parameters:
+#   - host (optional): Listening address (default: 127.0.0.1).
+#   - port (optional): Listening port (default: 0, any free port).
+
+class StandInBroker:
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.retained = {}
+        self.server = _Server((host, port), _ClientHandler)
+        self.server.broker = self
+        self.host, self.port = self.server.server_address
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def retained_matching(self, sub):
+        with self.lock:
+            matches = [(topic, payload, qos) for topic, (payload, qos) in self.retained.items()
+                       if topic_matches(sub, topic)]
+        matches.sort(key=lambda item: item[0].split('/'))
+        return matches
+
+    def publish(self, topic, payload, qos, retain):
+        with self.lock:
+            if retain:
+                if payload:
+                    self.retained[topic] = (payload, qos)
+                else:
+                    self.retained.pop(topic, None)
+            targets = []
+            for client in self.clients:
+                granted = [q for sub, q in client.subscriptions.items() if topic_matches(sub, topic)]
+                if granted:
+                    targets.append((client, max(granted)))
+        for client, granted in targets:
+            try:
+                client.deliver(topic, payload, min(qos, granted), False)
+            except OSError:
+                pass
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Stand-in MQTT broker for the ComDeX benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args(argv)
+    broker = StandInBroker(args.host, args.port).start()
+    print(f"port {broker.port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
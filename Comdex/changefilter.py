@@ -0,0 +1,197 @@
+# ComDeX Change Filter
+
+# Telemetry writers re-post mostly identical entity snapshots, and every
+# retained republish of an attribute (with its _timerelsystem_ topics) is
+# fanned out to every subscriber. With the filter enabled (--skip_unchanged),
+# upserts and PATCHes compare each attribute with the last value written to
+# its topic and only publish the ones that changed. Numeric property values
+# may also be held back while they stay within a deadband of the last
+# published value.
+#
+# The last written values come from the resident mirror of the broker when
+# one is running (see mirror.py), otherwise from a fingerprint per attribute
+# topic kept in a small JSON state file shared by the ComDeX processes of the
+# host. Fingerprints expire after max_age seconds, so an unchanged attribute
+# is still republished that often, and a topic cleared by another host is
+# written again within that bound. Null publishes of this host forget the
+# fingerprints of their topics.
+
+import os
+import json
+import time
+import hashlib
+import threading
+import tempfile
+import codec
+import mqttsession
+from mirror import get_mirror
+
+#seconds a fingerprint of the state file is trusted
+default_max_age=60
+default_state_path=os.environ.get('COMDEX_ATTRIBUTE_STATE', os.path.join(os.path.expanduser('~'), '.cache', 'comdex', 'attributes.json'))
+
+
+# Function: fingerprint
+# Description: Fingerprint of an attribute: a digest of its canonical JSON form, without the value of a numeric
+# property, and that numeric value.
+# Parameters:
+#   - value: The attribute object.
+# Returns: A [digest, number] list, number being None when the value is not numeric.
+
+def fingerprint(value):
+    number = None
+    if isinstance(value, dict) and isinstance(value.get('value'), (int, float)) and not isinstance(value.get('value'), bool):
+        number = value['value']
+        value = {k: v for k, v in value.items() if k != 'value'}
+    return [hashlib.blake2b(codec.encode(value, 'json'), digest_size=16).hexdigest(), number]
+
+
+# Class: ChangeFilter
+# Description: Decides which attribute publishes of an upsert or PATCH can be skipped.
+# Parameters:
+#   - path (optional): The state file (default: $COMDEX_ATTRIBUTE_STATE or ~/.cache/comdex/attributes.json).
+#   - max_age (optional): Seconds a fingerprint of the state file is trusted (default: default_max_age).
+
+class ChangeFilter:
+
+    def __init__(self, path=default_state_path, max_age=default_max_age):
+        self.path = path
+        self.max_age = max_age
+        self.enabled = False
+        self.deadbands = {}
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.loaded_mtime = None
+        self.written = {}
+        self.forgotten = set()
+
+    # Function: set_deadbands
+    # Description: Sets the deadbands of numeric values, from "<band>" for every attribute and/or
+    # "<attribute>=<band>,..." per attribute.
+    # Returns: True if the specification is valid, False otherwise.
+    def set_deadbands(self, spec):
+        deadbands = {}
+        for part in filter(None, spec.split(',')):
+            name, sep, band = part.rpartition('=')
+            try:
+                deadbands[name] = float(band)
+            except ValueError:
+                print(f"Invalid deadband: {part}")
+                return False
+            if deadbands[name] < 0:
+                print(f"Invalid deadband: {part}")
+                return False
+        self.deadbands = deadbands
+        return True
+
+    def _key(self, broker, port, topic):
+        return f"{broker}:{port} {topic}"
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self.entries, self.loaded_mtime = {}, None
+            return
+        if mtime == self.loaded_mtime:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        self.loaded_mtime = mtime
+
+    def _last_written(self, broker, port, topic):
+        mirror = get_mirror(broker, port)
+        if mirror is not None:
+            msg = mirror.first_matching(topic)
+            if msg is None:
+                return None
+            try:
+                return fingerprint(codec.unwrap_attribute(codec.decode_message(msg))[0])
+            except ValueError:
+                return None
+        key = self._key(broker, port, topic)
+        entry = self.written.get(key) or self.entries.get(key)
+        if entry is None or time.time() - entry[2] > self.max_age:
+            return None
+        return entry[:2]
+
+    def _within_deadband(self, name, previous, current):
+        if previous[0] != current[0]:
+            return False
+        if previous[1] == current[1]:
+            return True
+        if previous[1] is None or current[1] is None:
+            return False
+        return abs(current[1] - previous[1]) <= self.deadbands.get(name, self.deadbands.get('', 0.0))
+
+    # Function: changed
+    # Description: Tells whether an attribute has to be published, and records it as written if so. The deadband is
+    # measured from the last published value, so a slow drift is published once it exceeds the band.
+    # Parameters:
+    #   - broker, port: The broker written to.
+    #   - topic: The attribute topic ({area}/entities/{context}/{type}/{node}/{id}/{attr}).
+    #   - value: The attribute object.
+    #   - force (optional): Record the attribute without comparing, e.g. for an entity that did not exist (default: False).
+    # Returns: True if the attribute changed (always True when the filter is disabled).
+    def changed(self, broker, port, topic, value, force=False):
+        if not self.enabled:
+            return True
+        current = fingerprint(value)
+        with self.lock:
+            self._load()
+            previous = None if force else self._last_written(broker, port, topic)
+            if previous is not None and self._within_deadband(topic.rsplit('/', 1)[-1], previous, current):
+                return False
+            self.written[self._key(broker, port, topic)] = current + [time.time()]
+            return True
+
+    # Function: forget
+    # Description: Drops the fingerprints of a cleared topic (null retained publish), whatever the broker.
+    # Returns: None
+    def forget(self, topic):
+        with self.lock:
+            if self.written:
+                self.written = {key: entry for key, entry in self.written.items() if key.split(' ', 1)[1] != topic}
+            self.forgotten.add(topic)
+
+    # Function: save
+    # Description: Writes the fingerprints recorded since the last save to the state file, dropping expired ones. Called
+    # once at the end of every write operation.
+    # Returns: None
+    def save(self):
+        with self.lock:
+            if not self.written and not self.forgotten:
+                return
+            if not self.enabled and not os.path.exists(self.path):
+                self.written, self.forgotten = {}, set()
+                return
+            self._load()
+            now = time.time()
+            entries = {key: entry for key, entry in self.entries.items()
+                       if now - entry[2] <= self.max_age and key.split(' ', 1)[1] not in self.forgotten}
+            entries.update(self.written)
+            self.entries, self.written, self.forgotten = entries, {}, set()
+            directory = os.path.dirname(self.path) or '.'
+            try:
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=directory, prefix='.attributes-')
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp, self.path)
+                self.loaded_mtime = os.stat(self.path).st_mtime_ns
+            except OSError as e:
+                print(f"Could not write the attribute state {self.path}: {e}")
+
+
+change_filter = ChangeFilter()
+
+
+def _on_publish(topic, payload, retain):
+    if retain and not payload and '/entities/' in topic:
+        change_filter.forget(topic)
+
+
+mqttsession.publish_observers.append(_on_publish)
@@ -0,0 +1,215 @@
+# ComDeX Payload Codec
+
+# Attribute values, temporal values and subscriptions are stored as retained
+# MQTT payloads. They are written as compact canonical JSON (sorted keys, no
+# whitespace, UTF-8) by default, or as msgpack / CBOR when those libraries are
+# installed and selected (--payload_format). Readers accept every format:
+#
+#   - an MQTT v5 content type (the ContentType property, or a "content-type"
+#     user property) decides when the message carries one;
+#   - otherwise the payload describes itself: CBOR payloads start with the
+#     self-described CBOR tag (d9 d9 f7), msgpack maps and arrays start with a
+#     byte >= 0x80, and everything else is text. Bridged brokers forward only
+#     the payload, so this also holds across federated nodes.
+#
+# Text is decoded with orjson when available. Payloads written by older
+# ComDeX versions (Python reprs such as {'type': 'Property', 'value': 1}) are
+# not JSON and are read with ast.literal_eval, which, unlike quote
+# replacement, keeps values containing apostrophes intact.
+
+import ast
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+content_types = {'json': 'application/json', 'msgpack': 'application/msgpack', 'cbor': 'application/cbor'}
+#RFC 8949 self-described CBOR tag 55799, prefixed to every CBOR payload
+cbor_magic = b'\xd9\xd9\xf7'
+
+#format written by encode when none is given
+default_format = 'json'
+
+
+# Function: available_formats
+# Description: Lists the payload formats usable in this installation.
+# Returns: List of format names.
+
+def available_formats():
+    formats = ['json']
+    if msgpack is not None:
+        formats.append('msgpack')
+    if cbor2 is not None:
+        formats.append('cbor')
+    return formats
+
+
+# Function: set_default_format
+# Description: Selects the format written by encode.
+# Parameters:
+#   - fmt: 'json', 'msgpack' or 'cbor'.
+# Returns: True if the format is available, False otherwise.
+
+def set_default_format(fmt):
+    global default_format
+    if fmt not in available_formats():
+        print(f"Payload format {fmt} is not available, choose one of: {', '.join(available_formats())}")
+        return False
+    default_format = fmt
+    return True
+
+
+# Function: encode
+# Description: Serializes a value into a payload.
+# Parameters:
+#   - value: The value (attribute object, temporal value list, subscription...).
+#   - fmt (optional): 'json', 'msgpack' or 'cbor' (default: default_format).
+# Returns: The payload as bytes.
+
+def encode(value, fmt=None):
+    fmt = fmt or default_format
+    # binary formats are only self-describing for maps and arrays, other values stay JSON
+    if fmt == 'msgpack' and isinstance(value, (dict, list, tuple)):
+        return msgpack.packb(value, use_bin_type=True)
+    if fmt == 'cbor' and isinstance(value, (dict, list, tuple)):
+        return cbor_magic + cbor2.dumps(value, canonical=True)
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _content_type(properties):
+    if properties is None:
+        return None
+    content_type = getattr(properties, 'ContentType', None)
+    if content_type:
+        return content_type
+    for name, value in getattr(properties, 'UserProperty', None) or ():
+        if name.lower() == 'content-type':
+            return value
+    return None
+
+
+# Function: decode
+# Description: Parses a payload of any supported format, including legacy Python repr payloads.
+# Parameters:
+#   - payload: The payload (bytes or str).
+#   - content_type (optional): The MQTT v5 content type of the message, if it carried one.
+# Returns: The decoded value. Raises ValueError if the payload cannot be parsed.
+
+def decode(payload, content_type=None):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if content_type == content_types['msgpack'] or (content_type is None and payload[:1] >= b'\x80' and not payload.startswith(cbor_magic)):
+        if msgpack is None:
+            raise ValueError("msgpack payload received but msgpack is not installed")
+        return msgpack.unpackb(payload, raw=False)
+    if content_type == content_types['cbor'] or (content_type is None and payload.startswith(cbor_magic)):
+        if cbor2 is None:
+            raise ValueError("CBOR payload received but cbor2 is not installed")
+        return cbor2.loads(payload[len(cbor_magic):] if payload.startswith(cbor_magic) else payload)
+    try:
+        if orjson is not None:
+            return orjson.loads(payload)
+        return json.loads(payload)
+    except ValueError:
+        pass
+    # legacy repr: without double quotes and backslashes every apostrophe delimits a string, so swapping them is exact
+    if b'"' not in payload and b'\\' not in payload:
+        try:
+            return json.loads(payload.replace(b"'", b'"'))
+        except ValueError:
+            pass
+    try:
+        return ast.literal_eval(payload.decode('utf-8'))
+    except (SyntaxError, ValueError, UnicodeDecodeError, MemoryError, RecursionError) as e:
+        raise ValueError(f"Undecodable payload: {e}")
+
+
+# Function: decode_message
+# Description: Decodes the payload of a received MQTT message, honouring its content type property (MQTT v5).
+# Parameters:
+#   - msg: The MQTTMessage (or a mirror.MirroredMessage).
+# Returns: The decoded value. Raises ValueError if the payload cannot be parsed.
+
+def decode_message(msg):
+    return decode(msg.payload, message_content_type(msg))
+
+
+# Function: message_content_type
+# Description: The content type a received MQTT message carries (MQTT v5 property or user property).
+# Parameters:
+#   - msg: The MQTTMessage (or a mirror.MirroredMessage).
+# Returns: The content type, None if the message carries none.
+
+def message_content_type(msg):
+    return _content_type(getattr(msg, 'properties', None))
+
+
+# Temporal layout
+#
+# 'topics' (default) stores the createdAt/modifiedAt values of an attribute on
+# two retained topics next to it, <attr>_timerelsystem_CreatedAt and
+# <attr>_timerelsystem_modifiedAt. 'envelope' stores them inside the
+# attribute payload, {"_timerelsystem": {"createdAt": [...], "modifiedAt":
+# [...]}, "attribute": <value>}, which cuts the retained topics (and the
+# messages replayed by every wildcard GET) by three. Readers accept both.
+
+temporal_layouts = ('topics', 'envelope')
+temporal_layout = 'topics'
+envelope_key = '_timerelsystem'
+#names of the temporal values in reassembled entities, as derived from the topic suffixes of the 'topics' layout
+temporal_names = {'createdAt': 'CreatedAt', 'modifiedAt': 'modifiedAt'}
+
+
+# Function: set_temporal_layout
+# Description: Selects how the temporal values of written attributes are stored.
+# Parameters:
+#   - layout: 'topics' or 'envelope'.
+# Returns: True if the layout is known, False otherwise.
+
+def set_temporal_layout(layout):
+    global temporal_layout
+    if layout not in temporal_layouts:
+        print(f"Unknown temporal layout {layout}, choose one of: {', '.join(temporal_layouts)}")
+        return False
+    temporal_layout = layout
+    return True
+
+
+# Function: wrap_attribute
+# Description: Builds the envelope of an attribute and its temporal values.
+# Parameters:
+#   - value: The attribute object.
+#   - created_at / modified_at: The temporal values (lists of timestamps).
+# Returns: The envelope, to be passed to encode.
+
+def wrap_attribute(value, created_at, modified_at):
+    return {envelope_key: {'createdAt': created_at, 'modifiedAt': modified_at}, 'attribute': value}
+
+
+# Function: unwrap_attribute
+# Description: Splits a decoded attribute payload into the attribute and its temporal values.
+# Parameters:
+#   - decoded: The decoded payload.
+# Returns: A (value, temporal) tuple; temporal is a dictionary with createdAt/modifiedAt for envelopes, None otherwise.
+
+def unwrap_attribute(decoded):
+    if isinstance(decoded, dict) and envelope_key in decoded and 'attribute' in decoded:
+        return decoded['attribute'], decoded[envelope_key]
+    return decoded, None
@@ -0,0 +1,515 @@
+# ComDeX Daemon
+
+# A long-running ComDeX service exposing the NGSI-LD REST API over HTTP, on
+# top of the same topic scheme and functions as actionhandler.py. Imports,
+# the broker location file, the pooled MQTT sessions, the provider cache and
+# the optional retained mirror are loaded once and stay warm, so other
+# components can call ComDeX at request rates instead of forking a process
+# per operation.
+#
+# Endpoints (all under /ngsi-ld/v1):
+#   POST   /entities                        create an entity
+#   GET    /entities?type=...&q=...         query entities (same parameters as GET/entities/)
+#   GET    /entities/{id}                   retrieve an entity
+#   PATCH  /entities/{id}/attrs             update attributes
+#   PATCH  /entities/{id}/attrs/{attr}      update one attribute
+#   DELETE /entities/{id}                   delete an entity
+#   DELETE /entities/{id}/attrs/{attr}      delete one attribute
+#   POST   /entityOperations/create|update|upsert|delete
+#   POST   /subscriptions                   create a subscription
+#   GET    /subscriptions                   list the active subscriptions
+#   GET    /subscriptions/{id}              retrieve a subscription
+#   DELETE /subscriptions/{id}              delete a subscription
+#   GET    /temporal/entities?...           temporal query of the recorded history (with --history)
+#   GET    /temporal/entities/{id}          history of an entity (with --history)
+# and GET /metrics, the Prometheus counters of the operations (with --profile, see instrumentation.py) and the staleness
+# metrics of the resident mirror (with --mirror, see mirror.py).
+#
+# A JSON-LD context can be given in a Link header; it selects the context
+# (HLink) of GET, PATCH and DELETE like the -H option of actionhandler.py.
+
+import sys
+import json
+import time
+import getopt
+import asyncio
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import actionhandler
+import codec
+from actionhandler import (read_location_awareness, post_entity, get_entities, patch_entity, delete_entity,
+                           batch_post_entities, batch_delete_entities, create_subscription, validate_subscription,
+                           entity_topic_parts, topic_level_error, query_parameters)
+from mqttsession import get_session
+from mirror import start_mirror, prometheus_text as mirror_metrics
+from providercache import provider_cache, default_watched_ttl
+from sinks import ListSink
+from timeseries import TimeSeriesStore, HistoryRecorder, query_temporal
+from changefilter import change_filter
+import instrumentation
+import parallelreassembly
+
+api_prefix='/ngsi-ld/v1'
+default_http_host='127.0.0.1'
+default_http_port=8080
+default_workers=32
+max_body_size=64*1024*1024
+
+_reasons = {200: 'OK', 201: 'Created', 204: 'No Content', 207: 'Multi-Status', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed', 409: 'Conflict', 411: 'Length Required', 413: 'Payload Too Large',
+            500: 'Internal Server Error'}
+_error_types = {400: 'BadRequestData', 404: 'ResourceNotFound', 405: 'OperationNotSupported', 409: 'AlreadyExists',
+                411: 'BadRequestData', 413: 'BadRequestData', 500: 'InternalError'}
+
+
+# Class: HTTPError
+# Description: Raised by a route to answer with an NGSI-LD error (ProblemDetails) response.
+
+class HTTPError(Exception):
+
+    def __init__(self, status, detail):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+def _problem(status, detail):
+    return {'type': f"https://uri.etsi.org/ngsi-ld/errors/{_error_types.get(status, 'InternalError')}",
+            'title': _reasons.get(status, ''), 'detail': detail}
+
+
+# Function: link_context
+# Description: Extracts the context URL of a Link header (<url>; rel="http://www.w3.org/ns/json-ld#context").
+# Parameters:
+#   - link: The value of the Link header, or None.
+# Returns: The context URL, '' when there is none.
+
+def link_context(link):
+    if not link:
+        return ''
+    url, sep, params = link.partition(';')
+    url = url.strip()
+    if url.startswith('<') and url.endswith('>'):
+        return url[1:-1]
+    return ''
+
+
+# Class: ComDeXService
+# Description: The NGSI-LD operations of one ComDeX node, run on a thread pool over warm pooled MQTT sessions.
+# Parameters:
+#   - broker: The name or IP address of the broker of the node.
+#   - port: The port number of the broker.
+#   - username / password (optional): MQTT credentials.
+#   - qos (optional): The quality of service level for message delivery (default: 0).
+#   - mirror (optional): Keep a resident retained mirror of the broker (default: False).
+#   - workers (optional): Number of operations run at the same time (default: 32).
+#   - history (optional): Directory of an attribute time-series store recording the updates of the broker, served by
+#     GET /temporal/entities (default: None, see timeseries.py).
+#   - provider_ttl (optional): Seconds a provider discovery is reused; the daemon watches the advertisements of the broker
+#     to drop the discoveries they change (default: providercache.default_watched_ttl, 0 disables the cache).
+
+class ComDeXService:
+
+    def __init__(self, broker, port, username=None, password=None, qos=0, mirror=False, workers=default_workers, history=None,
+                 provider_ttl=default_watched_ttl):
+        self.broker = broker
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.qos = qos
+        self.area, self.loc = read_location_awareness(broker, self.port)
+        self.session = get_session(broker, self.port, username, password)
+        self.mirror = start_mirror(broker, self.port, username, password) if mirror else None
+        # the daemon keeps the provider cache up to date with the advertisements of every node, also for the other
+        # ComDeX processes of the host sharing the cache file
+        provider_cache.ttl = provider_ttl
+        if provider_ttl > 0 and not provider_cache.watch(broker, self.port, username, password):
+            print("Could not watch the provider advertisements, the provider cache is disabled")
+            provider_cache.ttl = 0
+        self.history = None
+        if history:
+            self.history = HistoryRecorder(broker, self.port, TimeSeriesStore(history), username=username, password=password).start()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.subscriptions = {}
+        self.subscriptions_lock = threading.Lock()
+
+    async def run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: function(*args, **kwargs))
+
+    # Function: dispatch
+    # Description: Routes a request to its operation.
+    # Parameters:
+    #   - method: The HTTP method.
+    #   - target: The request target (path and query string).
+    #   - headers: Dictionary of the request headers (lower case names).
+    #   - body: The request body (bytes).
+    # Returns: A (status, headers, body) tuple, body being a JSON-serialisable object, a text or None.
+    async def dispatch(self, method, target, headers, body):
+        url = urllib.parse.urlsplit(target)
+        path = url.path.rstrip('/')
+        if path == '/metrics':
+            if method != 'GET':
+                raise HTTPError(405, f"{method} is not supported on {url.path}")
+            mirror_text = mirror_metrics()
+            if not instrumentation.enabled and mirror_text is None:
+                raise HTTPError(404, "Metrics need a daemon started with --profile or --mirror")
+            text = (instrumentation.prometheus_text() if instrumentation.enabled else '') + (mirror_text or '')
+            return 200, {'Content-Type': 'text/plain; version=0.0.4'}, text
+        if not path.startswith(api_prefix):
+            raise HTTPError(404, f"Unknown resource {url.path}")
+        parts = [urllib.parse.unquote(part) for part in path[len(api_prefix):].split('/')[1:]]
+        HLink = link_context(headers.get('link'))
+
+        if parts[:1] == ['entities']:
+            return await self.entities(method, parts[1:], url.query, HLink, body)
+        if parts[:1] == ['entityOperations'] and len(parts) == 2:
+            if method != 'POST':
+                raise HTTPError(405, f"{method} is not supported on {url.path}")
+            return await self.entity_operations(parts[1], HLink, body)
+        if parts[:1] == ['subscriptions']:
+            return await self.subscription(method, parts[1:], body)
+        if parts[:2] == ['temporal', 'entities'] and len(parts) <= 3:
+            if method != 'GET':
+                raise HTTPError(405, f"{method} is not supported on {url.path}")
+            return await self.temporal(parts[2:], url.query, HLink)
+        raise HTTPError(404, f"Unknown resource {url.path}")
+
+    async def entities(self, method, parts, query, HLink, body):
+        if not parts:
+            if method == 'POST':
+                data = _json_body(body, dict)
+                if entity_topic_parts(data) is None:
+                    raise HTTPError(400, "An entity needs a type, an id and an @context")
+                error = topic_level_error(data['id'], [data['type']] + [k for k in data if k not in ('id', 'type', '@context')])
+                if error is not None:
+                    raise HTTPError(400, error)
+                if not await self.run(post_entity, data, self.area, self.broker, self.port, self.qos, self.loc, 0,
+                                      self.session, username=self.username, password=self.password):
+                    raise HTTPError(409, f"Entity {data['id']} already exists")
+                return 201, {'Location': f"{api_prefix}/entities/{urllib.parse.quote(data['id'], safe=':')}"}, None
+            if method == 'GET':
+                results = await self.query(query, HLink)
+                if results.count is not None:
+                    return 200, {'NGSILD-Results-Count': str(results.count)}, results.entities
+                return 200, {}, results.entities
+            raise HTTPError(405, f"{method} is not supported on {api_prefix}/entities")
+
+        entity_id = parts[0]
+        attrs_path = parts[1:2] == ['attrs']
+        attr = parts[2] if attrs_path and len(parts) == 3 else None
+        if len(parts) > 3 or (len(parts) > 1 and not attrs_path):
+            raise HTTPError(404, f"Unknown resource {'/'.join(parts)}")
+
+        if method == 'GET' and len(parts) == 1:
+            entities = (await self.query(urllib.parse.urlencode({'id': entity_id}), HLink)).entities
+            if not entities:
+                raise HTTPError(404, f"Entity {entity_id} not found")
+            return 200, {}, entities[0]
+        if method == 'PATCH' and attrs_path:
+            data = _json_body(body, dict)
+            if attr is not None:
+                data = {attr: data}
+            error = topic_level_error(entity_id, [k for k in data if k not in ('id', 'type', '@context')])
+            if error is not None:
+                raise HTTPError(400, error)
+            if not await self.run(patch_entity, entity_id, data, self.area, self.broker, self.port, self.qos, HLink,
+                                  attr or '', username=self.username, password=self.password):
+                raise HTTPError(404, f"Entity {entity_id} not found")
+            return 204, {}, None
+        if method == 'DELETE' and (len(parts) == 1 or attr is not None):
+            if not await self.run(delete_entity, entity_id, self.area, self.broker, self.port, HLink, attr,
+                                  username=self.username, password=self.password):
+                raise HTTPError(404, f"Entity {entity_id} not found" if attr is None else f"Attribute {attr} of entity {entity_id} not found")
+            return 204, {}, None
+        raise HTTPError(405, f"{method} is not supported on this resource")
+
+    async def query(self, query, HLink):
+        parameters = query_parameters(urllib.parse.parse_qsl(query, keep_blank_values=True))
+        results = ListSink()
+        if await self.run(get_entities, parameters, self.broker, self.port, HLink,
+                          username=self.username, password=self.password, sink=results) is None:
+            raise HTTPError(400, f"Invalid query: {query}")
+        return results
+
+    async def temporal(self, parts, query, HLink):
+        if self.history is None:
+            raise HTTPError(404, "Temporal queries need a daemon started with --history")
+        if parts:
+            query = '&'.join(filter(None, [query, urllib.parse.urlencode({'id': parts[0]})]))
+        results = ListSink()
+        if await self.run(query_temporal, self.history.store, query, HLink, results) is None:
+            raise HTTPError(400, f"Invalid temporal query: {query}")
+        if parts:
+            if not results.entities:
+                raise HTTPError(404, f"No history of entity {parts[0]}")
+            return 200, {}, results.entities[0]
+        return 200, {}, results.entities
+
+    async def entity_operations(self, operation, HLink, body):
+        if operation == 'delete':
+            ids = _json_body(body, list)
+            result = await self.run(batch_delete_entities, ids, self.area, self.broker, self.port, HLink,
+                                    username=self.username, password=self.password)
+            if result['not_found']:
+                missing = set(result['not_found'])
+                return 207, {}, {'success': [str(eid) for eid in ids if str(eid) not in missing],
+                                 'errors': [{'entityId': eid, 'error': _problem(404, f"Entity {eid} not found")} for eid in result['not_found']]}
+            return 204, {}, None
+        if operation not in ('create', 'update', 'upsert'):
+            raise HTTPError(404, f"Unknown entity operation {operation}")
+        entities = _json_body(body, list)
+        bypass = 0 if operation == 'create' else 1
+        stats = await self.run(batch_post_entities, entities, self.area, self.broker, self.port, self.qos, self.loc,
+                               bypass, username=self.username, password=self.password)
+        return 200, {}, stats
+
+    async def subscription(self, method, parts, body):
+        if not parts and method == 'POST':
+            data = _json_body(body, dict)
+            # the checks of create_subscription run before the subscription is acknowledged
+            try:
+                expires, throttling, time_interval, sink = validate_subscription(data)
+            except ValueError as e:
+                raise HTTPError(400, str(e))
+            sid = str(data['id'])
+            stop = threading.Event()
+            with self.subscriptions_lock:
+                if sid in self.subscriptions:
+                    sink.close()
+                    raise HTTPError(409, f"Subscription {sid} already exists")
+                self.subscriptions[sid] = {'subscription': data, 'expiresAt': time.time() + expires, 'stop': stop}
+            # a subscription follows its advertisements until it expires or is deleted, on its own thread
+            threading.Thread(target=self._follow_subscription, args=(sid, data, sink, stop), daemon=True).start()
+            return 201, {'Location': f"{api_prefix}/subscriptions/{urllib.parse.quote(sid, safe=':')}"}, None
+        if method == 'GET':
+            now = time.time()
+            with self.subscriptions_lock:
+                active = {sid: entry['subscription'] for sid, entry in self.subscriptions.items() if entry['expiresAt'] > now}
+            if not parts:
+                return 200, {}, list(active.values())
+            if len(parts) == 1 and parts[0] in active:
+                return 200, {}, active[parts[0]]
+            raise HTTPError(404, f"Subscription {'/'.join(parts)} not found")
+        if method == 'DELETE' and len(parts) == 1:
+            with self.subscriptions_lock:
+                entry = self.subscriptions.pop(parts[0], None)
+            if entry is None or entry['expiresAt'] <= time.time():
+                raise HTTPError(404, f"Subscription {parts[0]} not found")
+            entry['stop'].set()
+            return 204, {}, None
+        raise HTTPError(405, f"{method} is not supported on this resource")
+
+    def _follow_subscription(self, sid, data, sink, stop):
+        try:
+            create_subscription(data, self.area, self.broker, self.port, self.qos,
+                                username=self.username, password=self.password, sink=sink, stop=stop)
+        finally:
+            with self.subscriptions_lock:
+                if self.subscriptions.get(sid, {}).get('stop') is stop:
+                    self.subscriptions.pop(sid, None)
+
+
+def _json_body(body, expected_type):
+    try:
+        data = json.loads(body)
+    except ValueError as e:
+        raise HTTPError(400, f"Invalid JSON body: {e}")
+    if not isinstance(data, expected_type):
+        raise HTTPError(400, f"The body must be a JSON {'object' if expected_type is dict else 'array'}")
+    return data
+
+
+# Function: handle_connection
+# Description: Serves the HTTP/1.1 requests of one client connection (keep-alive supported).
+# Parameters:
+#   - service: The ComDeXService.
+#   - reader, writer: The asyncio streams of the connection.
+# Returns: None
+
+async def handle_connection(service, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, sep, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            try:
+                length = int(headers.get('content-length', 0) or 0)
+                if length > max_body_size:
+                    raise HTTPError(413, f"Body larger than {max_body_size} bytes")
+                if method in ('POST', 'PATCH') and 'content-length' not in headers:
+                    raise HTTPError(411, "Content-Length required")
+                body = await reader.readexactly(length) if length else b''
+                status, response_headers, payload = await service.dispatch(method, target, headers, body)
+            except HTTPError as e:
+                status, response_headers, payload = e.status, {}, _problem(e.status, e.detail)
+                if e.status in (411, 413):
+                    keep_alive = False
+            except asyncio.IncompleteReadError:
+                break
+            except Exception as e:
+                print(f"Error while serving {method} {target}: {e!r}")
+                status, response_headers, payload = 500, {}, _problem(500, str(e))
+
+            if isinstance(payload, str):
+                data = payload.encode('utf-8')
+            else:
+                data = b'' if payload is None else json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            head = [f"HTTP/1.1 {status} {_reasons.get(status, '')}", f"Content-Length: {len(data)}"]
+            if data and 'Content-Type' not in response_headers:
+                head.append("Content-Type: application/problem+json" if status >= 400 else "Content-Type: application/json")
+            head.extend(f"{name}: {value}" for name, value in response_headers.items())
+            if not keep_alive:
+                head.append("Connection: close")
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + data)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+# Function: serve
+# Description: Runs the HTTP front end of a ComDeXService until cancelled.
+# Parameters:
+#   - service: The ComDeXService.
+#   - host (optional): Address to listen on (default: 127.0.0.1).
+#   - http_port (optional): Port to listen on (default: 8080).
+# Returns: None
+
+async def serve(service, host=default_http_host, http_port=default_http_port):
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(service, reader, writer), host, http_port)
+    addresses = ', '.join(f"{address[0]}:{address[1]}" for address in (sock.getsockname() for sock in server.sockets))
+    print(f"ComDeX daemon serving NGSI-LD on http://{addresses}{api_prefix} for broker {service.broker}:{service.port}")
+    async with server:
+        await server.serve_forever()
+
+
+def usage():
+    print("\nUsage:")
+    print("python comdexd.py [options]\n")
+    print("Options:")
+    print("-h, --help                Show this help message and exit")
+    print("-b, --broker_address      Specify the address of the MQTT broker of the ComDeX node")
+    print("-p, --port                Specify the port number of the MQTT broker of the ComDeX node")
+    print("-q, --qos                 Specify the Quality of Service level (0, 1, or 2) of the published messages")
+    print("-A, --singleidadvertisement Specify if single ID advertisement is to be used (use 1 for True), default is false")
+    print("                          or 'summary' for one advertisement per type summarizing its entity ids (see idsummary.py)")
+    print("-N, --username            MQTT username")
+    print("-S, --password            MQTT password")
+    print("--http_host               Address the HTTP front end listens on (default: 127.0.0.1)")
+    print("--http_port               Port the HTTP front end listens on (default: 8080)")
+    print("--mirror                  Keep a resident mirror of the broker's retained store for local lookups (its staleness")
+    print("                          metrics are served at /metrics)")
+    print("--provider_ttl            Seconds a context provider discovery is reused (default: 30, 0 disables); the daemon watches the")
+    print("                          advertisements of the broker and drops the discoveries they change")
+    print("--history                 Record the attribute updates into this time-series directory and serve /temporal/entities")
+    print("--skip_unchanged          Updates, upserts and PATCHes only publish the attributes that changed (see changefilter.py)")
+    print("--deadband                With --skip_unchanged, numeric values within this band of the last published one count as")
+    print("                          unchanged: '<band>' for every attribute and/or '<attribute>=<band>,...'")
+    print("--profile                 Time the phases of every operation and serve them at /metrics: 'metrics' (only there), a JSON")
+    print("                          lines file, '-' (JSON lines on stderr) or 'prometheus:<file>' (see instrumentation.py)")
+    print("--reassembly_workers      Processes rebuilding and filtering the entities of large GET results, or 'auto' for one per CPU")
+    print("                          (default: 0, in-process; started with the daemon, see parallelreassembly.py)")
+    print("--payload_format          Format of the written attribute payloads: 'json' (default), 'msgpack' or 'cbor'")
+    print("--temporal_layout         Where createdAt/modifiedAt of written attributes are stored: 'topics' (default) or 'envelope' (all are read)")
+    print("\nExample:")
+    print("python3 comdexd.py -b localhost -p 1026 --http_port 8080\n")
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hb:p:q:A:N:S:", ["help", "broker_address=", "port=", "qos=", "singleidadvertisement=",
+                                                         "username=", "password=", "http_host=", "http_port=", "mirror", "payload_format=", "temporal_layout=",
+                                                         "history=", "skip_unchanged", "deadband=", "profile=", "reassembly_workers=", "provider_ttl="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    broker = actionhandler.default_broker_address
+    port = actionhandler.default_broker_port
+    qos = 0
+    username = None
+    password = None
+    http_host = default_http_host
+    http_port = default_http_port
+    mirror = False
+    history = None
+    provider_ttl = default_watched_ttl
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage(); sys.exit()
+        elif opt in ("-b", "--broker_address"):
+            broker = arg
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-q", "--qos"):
+            qos = int(arg)
+            if qos < 0 or qos > 2:
+                print("Invalid Mqtt qos"); sys.exit(2)
+        elif opt in ("-A", "--singleidadvertisement"):
+            actionhandler.singleidadvertisement = (arg == "1")
+            actionhandler.summaryadvertisement = (arg == "summary")
+        elif opt in ("-N", "--username"):
+            username = arg
+        elif opt in ("-S", "--password"):
+            password = arg
+        elif opt == "--http_host":
+            http_host = arg
+        elif opt == "--http_port":
+            http_port = int(arg)
+        elif opt == "--mirror":
+            mirror = True
+        elif opt == "--history":
+            history = arg
+        elif opt == "--provider_ttl":
+            provider_ttl = float(arg)
+        elif opt == "--skip_unchanged":
+            change_filter.enabled = True
+        elif opt == "--deadband":
+            if not change_filter.set_deadbands(arg):
+                sys.exit(2)
+        elif opt == "--profile":
+            if not instrumentation.configure(arg):
+                sys.exit(2)
+        elif opt == "--reassembly_workers":
+            if not parallelreassembly.configure(arg):
+                sys.exit(2)
+        elif opt == "--payload_format":
+            if not codec.set_default_format(arg):
+                sys.exit(2)
+        elif opt == "--temporal_layout":
+            if not codec.set_temporal_layout(arg):
+                sys.exit(2)
+
+    # the worker processes are started before the MQTT sessions and their threads
+    parallelreassembly.start()
+    try:
+        service = ComDeXService(broker, port, username, password, qos, mirror, history=history, provider_ttl=provider_ttl)
+    except ConnectionError as e:
+        print(f"Could not connect to the broker: {e}")
+        sys.exit(2)
+    try:
+        asyncio.run(serve(service, http_host, http_port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
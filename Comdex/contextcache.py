@@ -0,0 +1,289 @@
+# ComDeX JSON-LD Context Cache
+
+# Entities reassembled with a non-core @context map their type (and the
+# attribute names of temporal values) through the term definitions of that
+# context. Context documents are resolved through this cache instead of an
+# HTTP fetch per entity: an in-memory LRU in front of an on-disk cache
+# directory shared by every ComDeX process on the host. Expired copies are
+# revalidated with ETag/Last-Modified, and when the context server cannot be
+# reached (plant networks without outbound internet) the last copy is used
+# whatever its age. Contexts can be preloaded, from their URL or from a local
+# file, before a node goes offline:
+#
+#   python3 contextcache.py --preload <url> [<url> ...]
+#   python3 contextcache.py --import <url>=<file>
+
+import os
+import sys
+import json
+import time
+import getopt
+import hashlib
+import threading
+import tempfile
+import collections
+import urllib.request
+import urllib.error
+
+#seconds a cached context is used before it is revalidated with its server
+default_ttl=24*3600
+#seconds a context that could not be fetched (and has no cached copy) is not asked for again
+default_failure_ttl=60
+default_memory_entries=64
+default_fetch_timeout=5
+default_cache_dir=os.environ.get('COMDEX_CONTEXT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'comdex', 'contexts'))
+
+
+# Class: ContextCache
+# Description: Resolves JSON-LD context documents by URL through an in-memory LRU and a cache directory (one JSON file
+# per context, replaced atomically, holding the document and its ETag/Last-Modified validators).
+# Parameters:
+#   - directory (optional): The cache directory (default: $COMDEX_CONTEXT_CACHE or ~/.cache/comdex/contexts).
+#   - ttl (optional): Seconds a cached context is used without revalidation (default: default_ttl).
+#   - memory_entries (optional): Number of contexts kept in memory (default: default_memory_entries).
+
+class ContextCache:
+
+    def __init__(self, directory=default_cache_dir, ttl=default_ttl, memory_entries=default_memory_entries):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        self.terms_memory = {}
+        self.failures = {}
+        self.url_locks = {}
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _read(self, url):
+        try:
+            with open(self._path(url), encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def _write(self, entry):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.context-')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._path(entry['url']))
+        except OSError as e:
+            print(f"Could not write the context cache {self.directory}: {e}")
+
+    def _remember(self, entry):
+        with self.lock:
+            self.memory[entry['url']] = entry
+            self.memory.move_to_end(entry['url'])
+            self.terms_memory.pop(entry['url'], None)
+            while len(self.memory) > self.memory_entries:
+                evicted, _ = self.memory.popitem(last=False)
+                self.terms_memory.pop(evicted, None)
+
+    def _fetch(self, url, cached):
+        request = urllib.request.Request(url, headers={'Accept': 'application/ld+json, application/json'})
+        if cached is not None:
+            if cached.get('etag'):
+                request.add_header('If-None-Match', cached['etag'])
+            if cached.get('last_modified'):
+                request.add_header('If-Modified-Since', cached['last_modified'])
+        try:
+            with urllib.request.urlopen(request, timeout=default_fetch_timeout) as response:
+                document = json.loads(response.read().decode('utf-8'))
+                return {'url': url, 'fetched': time.time(), 'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'), 'document': document}
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                return dict(cached, fetched=time.time())
+            print(f"Could not fetch the context {url}: HTTP {e.code}")
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            print(f"Could not fetch the context {url}: {e}")
+        return None
+
+    # Function: resolve
+    # Description: Returns the JSON-LD document of a context URL, fetching it only when no fresh copy is cached.
+    # Parameters:
+    #   - url: The context URL.
+    # Returns: The parsed document, or None if it is neither cached nor reachable.
+    def resolve(self, url):
+        with self.lock:
+            entry = self.memory.get(url)
+            if entry is not None:
+                self.memory.move_to_end(url)
+            if entry is not None and time.time() - entry['fetched'] <= self.ttl:
+                return entry['document']
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+        # one fetch per context, concurrent resolutions of the same URL wait for it
+        with url_lock:
+            with self.lock:
+                current = self.memory.get(url)
+            if current is not None and time.time() - current['fetched'] <= self.ttl:
+                return current['document']
+            cached = current or self._read(url)
+            if cached is not None and time.time() - cached['fetched'] <= self.ttl:
+                self._remember(cached)
+                return cached['document']
+            with self.lock:
+                failed_at = self.failures.get(url)
+            if cached is None and failed_at is not None and time.time() - failed_at < default_failure_ttl:
+                return None
+            fetched = self._fetch(url, cached)
+            if fetched is None:
+                if cached is None:
+                    with self.lock:
+                        self.failures[url] = time.time()
+                    return None
+                # offline: keep serving the last copy, revalidate again after another ttl
+                fetched = dict(cached, fetched=time.time())
+            else:
+                self._write(fetched)
+            with self.lock:
+                self.failures.pop(url, None)
+            self._remember(fetched)
+            return fetched['document']
+
+    # Function: terms
+    # Description: Returns the term definitions of a context: the "@context" member of its document, with the entries
+    # of an array of contexts merged in order (referenced context URLs are resolved through the cache too).
+    # Parameters:
+    #   - url: The context URL.
+    # Returns: A dictionary mapping terms to their definitions (empty if the context cannot be resolved).
+    def terms(self, url):
+        with self.lock:
+            terms = self.terms_memory.get(url)
+            entry = self.memory.get(url)
+        if terms is not None and entry is not None and time.time() - entry['fetched'] <= self.ttl:
+            return terms
+        document = self.resolve(url)
+        terms = {}
+        self._merge_terms(document.get('@context', {}) if isinstance(document, dict) else {}, terms, {url})
+        with self.lock:
+            if url in self.memory:
+                self.terms_memory[url] = terms
+        return terms
+
+    def _merge_terms(self, context, terms, seen):
+        if isinstance(context, dict):
+            terms.update(context)
+        elif isinstance(context, list):
+            for item in context:
+                self._merge_terms(item, terms, seen)
+        elif isinstance(context, str) and context not in seen:
+            seen.add(context)
+            document = self.resolve(context)
+            if isinstance(document, dict):
+                self._merge_terms(document.get('@context', {}), terms, seen)
+
+    # Function: preload
+    # Description: Fetches contexts into the cache (ignoring the TTL), so they resolve later without network access.
+    # Parameters:
+    #   - urls: List of context URLs.
+    # Returns: The number of contexts cached.
+    def preload(self, urls):
+        loaded = 0
+        for url in urls:
+            fetched = self._fetch(url, self._read(url))
+            if fetched is None:
+                continue
+            self._write(fetched)
+            self._remember(fetched)
+            loaded += 1
+            print(f"Cached {url}")
+        return loaded
+
+    # Function: import_file
+    # Description: Stores a context document read from a local file as the cached copy of a URL, for nodes that never
+    # reach the context server.
+    # Parameters:
+    #   - url: The context URL the document stands for.
+    #   - path: The JSON-LD file.
+    # Returns: True if the file was imported.
+    def import_file(self, url, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                document = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not import the context file {path}: {e}")
+            return False
+        entry = {'url': url, 'fetched': time.time(), 'etag': None, 'last_modified': None, 'document': document}
+        self._write(entry)
+        self._remember(entry)
+        print(f"Cached {url} from {path}")
+        return True
+
+    # Function: clear
+    # Description: Empties the memory and the cache directory.
+    # Returns: None
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.terms_memory.clear()
+            self.failures.clear()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith('.json'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+context_cache = ContextCache()
+
+
+def usage():
+    print("\nUsage:")
+    print("python3 contextcache.py [options]\n")
+    print("Options:")
+    print("-h, --help                Show this help message and exit")
+    print("--preload <url> [...]     Fetch the given @context URLs into the cache")
+    print("--import <url>=<file>     Store a local JSON-LD file as the cached copy of <url> (offline nodes)")
+    print("--clear                   Empty the cache")
+    print("--cache_dir <dir>         Cache directory (default: $COMDEX_CONTEXT_CACHE or ~/.cache/comdex/contexts)")
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "h", ["help", "preload", "import=", "clear", "cache_dir="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    preload = False
+    imports = []
+    clear = False
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt == "--preload":
+            preload = True
+        elif opt == "--import":
+            url, sep, path = arg.rpartition('=')
+            if not sep or not url:
+                print("--import expects <url>=<file>")
+                sys.exit(2)
+            imports.append((url, path))
+        elif opt == "--clear":
+            clear = True
+        elif opt == "--cache_dir":
+            context_cache.directory = arg
+    if clear:
+        context_cache.clear()
+    failed = False
+    for url, path in imports:
+        failed |= not context_cache.import_file(url, path)
+    if preload:
+        failed |= context_cache.preload(args) != len(args)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
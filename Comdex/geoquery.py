@@ -0,0 +1,196 @@
+# ComDeX NGSI-LD Geo-queries
+
+# Builds the query geometry of a GET once, prepares it for repeated
+# predicate evaluation and answers georel conditions for many located
+# entities at a time through an STRtree, so that only the entities whose
+# bounding box can match are tested exactly. Distances for `near` use
+# geodesic (haversine) metres as required by NGSI-LD, not planar degrees.
+# The same index prunes the context providers of a GET: only providers whose
+# advertised coverage can hold a matching entity are queried.
+
+import json
+import math
+import functools
+import shapely.geometry as shape_geo
+from shapely.geometry.base import BaseGeometry
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+from shapely.ops import nearest_points
+
+#mean earth radius in metres
+earth_radius=6371008.8
+metres_per_degree=math.pi*earth_radius/180
+
+geometry_types=("Point", "LineString", "Polygon", "MultiPoint", "MultiLineString", "MultiPolygon")
+
+
+# Class: GeoQuerySyntaxError
+# Description: Raised when georel, geometry or coordinates do not form a valid NGSI-LD geo-query.
+
+class GeoQuerySyntaxError(ValueError):
+    pass
+
+
+# Function: geodesic_distance
+# Description: Great-circle distance between two GeoJSON geometries, measured between their nearest points.
+# Parameters:
+#   - a, b: Shapely geometries with (longitude, latitude) coordinates.
+# Returns:
+#   - The distance in metres.
+
+def geodesic_distance(a, b):
+    if a.intersects(b):
+        return 0.0
+    p, q = nearest_points(a, b)
+    lon1, lat1, lon2, lat2 = map(math.radians, (p.x, p.y, q.x, q.y))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius * math.asin(min(1.0, math.sqrt(h)))
+
+
+# Class: GeoQuery
+# Description: A compiled NGSI-LD geo-query (georel + geometry + coordinates).
+# Parameters:
+#   - georel: Geo-relation, e.g. "within", "intersects" or "near;maxDistance==2000".
+#   - geometry: Geometry type of the query (Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon).
+#   - coordinates: GeoJSON coordinates of the query geometry, as a JSON string.
+
+class GeoQuery:
+
+    def __init__(self, georel, geometry, coordinates):
+        if geometry not in geometry_types:
+            raise GeoQuerySyntaxError(f"Unsupported geometry: {geometry}")
+        try:
+            self.geometry = shape_geo.shape({"type": geometry, "coordinates": json.loads(coordinates.replace(" ", ""))})
+        except (ValueError, TypeError, IndexError) as e:
+            raise GeoQuerySyntaxError(f"Invalid coordinates for {geometry}: {coordinates}") from e
+        self.prepared = prep(self.geometry)
+
+        self.max_distance = None
+        self.min_distance = None
+        if georel.startswith("near;"):
+            self.relation = "near"
+            for condition in georel.split(';')[1:]:
+                name, sep, value = condition.partition("==")
+                try:
+                    distance = float(value)
+                except ValueError:
+                    raise GeoQuerySyntaxError(f"Invalid near condition: {condition}")
+                if not sep or name not in ("maxDistance", "minDistance"):
+                    raise GeoQuerySyntaxError(f"Invalid near condition: {condition}")
+                if name == "maxDistance":
+                    self.max_distance = distance
+                else:
+                    self.min_distance = distance
+        elif georel in ("equals", "within", "intersects", "contains", "disjoint", "overlaps"):
+            self.relation = georel
+        else:
+            raise GeoQuerySyntaxError(f"Unsupported georel: {georel}")
+
+    # Function: matches
+    # Description: Checks the geo-relation between an entity geometry and the query geometry.
+    # Parameters:
+    #   - entity_geometry: Shapely geometry of the entity's geoproperty.
+    # Returns: True if the entity satisfies the geo-query.
+    def matches(self, entity_geometry):
+        relation = self.relation
+        if relation == "within":
+            return self.prepared.contains(entity_geometry)
+        if relation == "intersects":
+            return self.prepared.intersects(entity_geometry)
+        if relation == "contains":
+            return self.prepared.within(entity_geometry)
+        if relation == "disjoint":
+            return self.prepared.disjoint(entity_geometry)
+        if relation == "overlaps":
+            return self.prepared.overlaps(entity_geometry)
+        if relation == "equals":
+            return entity_geometry.equals(self.geometry)
+        distance = geodesic_distance(entity_geometry, self.geometry)
+        if self.max_distance is not None and distance > self.max_distance:
+            return False
+        if self.min_distance is not None and distance < self.min_distance:
+            return False
+        return True
+
+    # Function: search_area
+    # Description: Geometry whose bounding box contains every entity that can match, used to prune index candidates.
+    # Returns: A shapely geometry, or None when the relation cannot be pruned by bounding box (disjoint, minDistance only).
+    def search_area(self):
+        if self.relation == "disjoint":
+            return None
+        if self.relation != "near":
+            return self.geometry
+        if self.max_distance is None:
+            return None
+        minx, miny, maxx, maxy = self.geometry.bounds
+        dlat = self.max_distance / metres_per_degree
+        miny, maxy = max(-90.0, miny - dlat), min(90.0, maxy + dlat)
+        cos_lat = math.cos(math.radians(max(abs(miny), abs(maxy))))
+        if cos_lat < 1e-6:
+            return shape_geo.box(-180.0, miny, 180.0, maxy)
+        dlon = self.max_distance / (metres_per_degree * cos_lat)
+        return shape_geo.box(minx - dlon, miny, maxx + dlon, maxy)
+
+    # Function: filter
+    # Description: Bulk-loads entity geometries into an STRtree and returns the positions of the ones satisfying the query.
+    # Parameters:
+    #   - geometries: List of shapely geometries.
+    # Returns: Sorted list of indexes into geometries.
+    def filter(self, geometries):
+        area = self.search_area()
+        if area is None or not geometries:
+            candidates = range(len(geometries))
+        else:
+            candidates = _tree_hits(geometries, area)
+        return [i for i in candidates if self.matches(geometries[i])]
+
+    # Function: covering
+    # Description: Selects the context providers whose advertised coverage can hold an entity satisfying the query.
+    # Parameters:
+    #   - coverages: List with, per provider, None when its coverage is unknown (always selected), or a list of GeoJSON
+    #     geometries containing every located entity it holds (an empty list when it holds none).
+    # Returns: Sorted list of indexes into coverages.
+    def covering(self, coverages):
+        area = self.search_area()
+        if area is None:
+            return list(range(len(coverages)))
+        selected = set()
+        geometries = []
+        owners = []
+        for i, coverage in enumerate(coverages):
+            if coverage is None:
+                selected.add(i)
+                continue
+            for geometry in coverage:
+                try:
+                    geometries.append(shape_geo.shape(geometry))
+                except (ValueError, TypeError, KeyError, AttributeError, IndexError):
+                    # an unreadable coverage cannot rule the provider out
+                    selected.add(i)
+                    continue
+                owners.append(i)
+        if geometries:
+            selected.update(owners[k] for k in _tree_hits(geometries, area) if geometries[k].intersects(area))
+        return sorted(selected)
+
+
+def _tree_hits(geometries, area):
+    # positions of the geometries whose bounding box intersects the one of area
+    hits = STRtree(geometries).query(area)
+    if len(hits) and isinstance(hits[0], BaseGeometry):
+        # Shapely 1.x returns the geometries themselves instead of their positions
+        position = {id(geometry): i for i, geometry in enumerate(geometries)}
+        hits = [position[id(hit)] for hit in hits]
+    return sorted(int(i) for i in hits)
+
+
+# Function: compile_geo_query
+# Description: Builds (and caches) the GeoQuery of a GET, so its geometry is parsed and prepared only once.
+# Parameters:
+#   - georel, geometry, coordinates: The NGSI-LD geo-query parameters.
+# Returns:
+#   - A GeoQuery. Raises GeoQuerySyntaxError for invalid parameters.
+
+@functools.lru_cache(maxsize=64)
+def compile_geo_query(georel, geometry, coordinates):
+    return GeoQuery(georel, geometry, coordinates)
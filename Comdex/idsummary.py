@@ -0,0 +1,156 @@
+# ComDeX Provider Id Summaries
+
+# With `-A summary` a provider advertises each type it holds with a single
+# retained topic (provider/<broker>/<port>/<area>/<context>/<type>) whose
+# advertisement carries a compact summary of the entity ids under it: a bloom
+# filter, the entity count and the last update time. Discovery replays one
+# advertisement per provider and type instead of one per entity, and a GET by
+# id tests the id against the summaries before contacting a provider.
+#
+# The filter is only ever added to, so an id that was written is never
+# reported missing (no false negatives); an id that was not written is
+# reported present with probability error_rate (the provider is then asked
+# for nothing). Deleted ids stay in the filter until it is rebuilt from the
+# retained entities of the provider, which happens once more ids were deleted
+# than are left, or when the filter is over its capacity. Membership cannot
+# tell whether an id is counted (a false positive, or an id deleted and
+# created again, is in the filter but not counted), so the writers say which
+# ids they created or deleted, from the existence snapshot of the write.
+
+import math
+import base64
+import hashlib
+import datetime
+
+#entities a new filter is sized for, and its false positive rate at that size
+default_capacity=1024
+default_error_rate=0.01
+
+
+# Class: IdSummary
+# Description: Bloom filter of the entity ids of a provider and type, with the number of entities it holds.
+# Parameters:
+#   - capacity (optional): Number of ids the filter is sized for (default: default_capacity).
+#   - error_rate (optional): False positive rate at capacity (default: default_error_rate).
+
+class IdSummary:
+
+    def __init__(self, capacity=default_capacity, error_rate=default_error_rate):
+        self.capacity = max(1, int(capacity))
+        self.bits = max(64, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.bits += -self.bits % 8
+        self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+        self.filter = bytearray(self.bits // 8)
+        self.count = 0
+        self.removed = 0
+        self.modified = None
+
+    # Function: build
+    # Description: Creates a summary holding the given ids, sized for twice their number so it can grow.
+    # Parameters:
+    #   - ids: Iterable of entity ids.
+    # Returns: An IdSummary.
+    @classmethod
+    def build(cls, ids, error_rate=default_error_rate):
+        ids = set(ids)
+        summary = cls(max(default_capacity, 2 * len(ids)), error_rate)
+        summary.add(ids, ids)
+        return summary
+
+    # Function: from_dict
+    # Description: Reads the summary of an advertisement.
+    # Parameters:
+    #   - data: The "ids" member of the advertisement.
+    # Returns: An IdSummary, None when data is missing or unreadable.
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            return None
+        summary = cls.__new__(cls)
+        try:
+            summary.capacity = int(data['capacity'])
+            summary.bits = int(data['bits'])
+            summary.hashes = int(data['hashes'])
+            summary.filter = bytearray(base64.b64decode(data['filter']))
+            summary.count = int(data['count'])
+            summary.removed = int(data.get('removed', 0))
+            summary.modified = data.get('modifiedAt')
+        except (KeyError, TypeError, ValueError):
+            return None
+        if summary.bits <= 0 or summary.hashes <= 0 or len(summary.filter) * 8 != summary.bits:
+            return None
+        return summary
+
+    def to_dict(self):
+        return {'count': self.count, 'removed': self.removed, 'modifiedAt': self.modified, 'capacity': self.capacity,
+                'bits': self.bits, 'hashes': self.hashes, 'filter': base64.b64encode(bytes(self.filter)).decode('ascii')}
+
+    def _positions(self, entity_id):
+        # double hashing over one 128 bit digest, stable across processes and Python versions
+        digest = hashlib.blake2b(str(entity_id).encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, entity_id):
+        return all(self.filter[p >> 3] & (1 << (p & 7)) for p in self._positions(entity_id))
+
+    # Function: add
+    # Description: Adds written ids to the filter, and counts the ones the write created.
+    # Parameters:
+    #   - ids: Iterable of the written entity ids.
+    #   - new (optional): The ids among them that did not exist before the write (default: none, updates only).
+    # Returns: True if the summary changed.
+    def add(self, ids, new=()):
+        new = set(new)
+        changed = False
+        for entity_id in set(ids) | new:
+            if entity_id in self:
+                continue
+            for p in self._positions(entity_id):
+                self.filter[p >> 3] |= 1 << (p & 7)
+            changed = True
+        self.count += len(new)
+        if changed or new:
+            self.touch()
+        return changed or bool(new)
+
+    # Function: remove
+    # Description: Accounts for deleted ids. Their bits stay set until the filter is rebuilt (see stale).
+    # Parameters:
+    #   - ids: Iterable of the ids the delete removed.
+    # Returns: The number of ids accounted for.
+    def remove(self, ids):
+        removed = min(self.count, len(set(ids)))
+        if removed:
+            self.count -= removed
+            self.removed += removed
+            self.touch()
+        return removed
+
+    def touch(self):
+        self.modified = str(datetime.datetime.now())
+
+    # Function: stale
+    # Description: Whether the filter should be rebuilt from the ids the provider holds, because it is over its capacity
+    # (its false positive rate grows) or holds more deleted ids than live ones.
+    # Returns: True or False
+    def stale(self):
+        return self.count > self.capacity or self.removed > max(self.count, default_capacity // 4)
+
+
+# Function: may_hold
+# Description: Tests an entity id against the summaries of a provider.
+# Parameters:
+#   - summaries: None when the provider's ids are unknown, otherwise the list of the "ids" members of its advertisements.
+#   - entity_id: The id looked for.
+# Returns: False only if no summary can hold the id.
+
+def may_hold(summaries, entity_id):
+    if summaries is None:
+        return True
+    for data in summaries:
+        summary = IdSummary.from_dict(data)
+        if summary is None or entity_id in summary:
+            return True
+    return False
@@ -0,0 +1,457 @@
+# ComDeX Instrumentation
+
+# Opt-in timing of the ComDeX operations (--profile). Every top-level call
+# (POST/entities, GET/entities, a batch, ...) is an operation; the phases it
+# goes through are spans, timed inclusively and named by their nesting, e.g.
+# "discovery", "discovery/retained_collection" or
+# "retained_collection/reassembly/filter". A phase entered several times (one
+# publish per attribute, one reassembly per message) is reported with its
+# number of calls and total seconds; phases run by concurrent retrievals add
+# up, so they can exceed the wall time of the operation. Each operation also
+# counts the MQTT messages and payload bytes it received and sent.
+#
+# Finished operations are exported as one JSON line each, and/or added to
+# Prometheus counters: in memory (served by comdexd.py at /metrics) and in a
+# text file in the exposition format (for the node_exporter textfile
+# collector), which accumulates across processes. Disabled, every hook is a
+# no-op.
+#
+# Spans follow the thread that runs the operation. Work handed to other
+# threads (fan-out workers, MQTT callbacks) is attributed with bind/observed.
+
+import os
+import re
+import sys
+import json
+import time
+import datetime
+import functools
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+enabled = False
+#upper bounds in seconds of the buckets of the operation latency histogram
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_local = threading.local()
+_exporters = []
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+def _size(payload):
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    if isinstance(payload, str):
+        return len(payload.encode('utf-8'))
+    return 0 if payload is None else len(str(payload))
+
+
+class _NullOperation:
+
+    def span(self, phase):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def received(self, payload):
+        pass
+
+    def sent(self, payload):
+        pass
+
+
+NULL = _NullOperation()
+
+
+# Class: Operation
+# Description: The spans and message counters of one operation.
+# Parameters:
+#   - name: The operation, e.g. "GET/entities".
+
+class Operation:
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.phases = {}
+        self.counters = {'messages_in': 0, 'bytes_in': 0, 'messages_out': 0, 'bytes_out': 0}
+        self.lock = threading.Lock()
+
+    def span(self, phase):
+        return _Span(self, phase)
+
+    def record(self, path, seconds):
+        with self.lock:
+            entry = self.phases.get(path)
+            if entry is None:
+                entry = self.phases[path] = [0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+
+    def received(self, payload):
+        with self.lock:
+            self.counters['messages_in'] += 1
+            self.counters['bytes_in'] += _size(payload)
+
+    def sent(self, payload):
+        with self.lock:
+            self.counters['messages_out'] += 1
+            self.counters['bytes_out'] += _size(payload)
+
+    def to_dict(self):
+        with self.lock:
+            return dict({'operation': self.name,
+                         'start': datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat().replace('+00:00', 'Z'),
+                         'seconds': self.seconds,
+                         'phases': {path: {'calls': calls, 'seconds': seconds} for path, (calls, seconds) in sorted(self.phases.items())}},
+                        **self.counters)
+
+    # Function: samples
+    # Description: The Prometheus counter increments of the operation.
+    # Returns: A dictionary {(metric, labels): increment}, labels being a tuple of (name, value) pairs.
+    def samples(self):
+        operation = (('operation', self.name),)
+        samples = {('comdex_operations_total', operation): 1, ('comdex_operation_seconds_sum', operation): self.seconds,
+                   ('comdex_operation_seconds_count', operation): 1}
+        for bound in latency_buckets + (float('inf'),):
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            samples[('comdex_operation_seconds_bucket', operation + (('le', le),))] = 1 if self.seconds <= bound else 0
+        with self.lock:
+            for path, (calls, seconds) in self.phases.items():
+                labels = operation + (('phase', path),)
+                samples[('comdex_phase_calls_total', labels)] = calls
+                samples[('comdex_phase_seconds_total', labels)] = seconds
+            for direction in ('in', 'out'):
+                labels = operation + (('direction', direction),)
+                samples[('comdex_messages_total', labels)] = self.counters['messages_' + direction]
+                samples[('comdex_bytes_total', labels)] = self.counters['bytes_' + direction]
+        return samples
+
+
+class _Span:
+    __slots__ = ('operation', 'phase', 'parent', 'path', 'start')
+
+    def __init__(self, operation, phase):
+        self.operation = operation
+        self.phase = phase
+
+    def __enter__(self):
+        self.parent = getattr(_local, 'path', '')
+        self.path = f"{self.parent}/{self.phase}" if self.parent else self.phase
+        _local.path = self.path
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.operation.record(self.path, time.perf_counter() - self.start)
+        _local.path = self.parent
+        return False
+
+
+class _OperationScope:
+
+    def __init__(self, name):
+        self.operation = Operation(name)
+
+    def __enter__(self):
+        _local.operation, _local.path = self.operation, ''
+        return self.operation
+
+    def __exit__(self, *exc):
+        _local.operation, _local.path = None, ''
+        self.operation.seconds = time.perf_counter() - self.operation.start
+        export(self.operation)
+        return False
+
+
+# Function: current
+# Description: The operation run by the calling thread.
+# Returns: An Operation, or NULL (whose methods do nothing) when disabled or outside an operation.
+
+def current():
+    return getattr(_local, 'operation', None) or NULL
+
+
+# Function: operation
+# Description: Context manager running an operation. Inside another operation (e.g. delete_entity calling
+# bulk_delete_entities, or a CLI command) the outer operation goes on.
+# Parameters:
+#   - name: The operation, e.g. "GET/entities".
+# Returns: The context manager.
+
+def operation(name):
+    if not enabled or getattr(_local, 'operation', None) is not None:
+        return NULL
+    return _OperationScope(name)
+
+
+# Function: span
+# Description: Context manager timing a phase of the current operation.
+# Parameters:
+#   - phase: The phase, e.g. "discovery".
+# Returns: The context manager.
+
+def span(phase):
+    return current().span(phase)
+
+
+# Function: instrumented
+# Description: Decorator running every call of a function as an operation.
+# Parameters:
+#   - name: The operation, or a function of the call arguments returning it.
+# Returns: The decorator.
+
+def instrumented(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with operation(name(*args, **kwargs) if callable(name) else name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Function: timed
+# Description: Decorator timing every call of a function as a phase of the current operation.
+# Parameters:
+#   - phase: The phase.
+# Returns: The decorator.
+
+def timed(phase):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with current().span(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Function: bind
+# Description: Makes a function handed to another thread run inside the current operation and phase.
+# Parameters:
+#   - function: The function.
+# Returns: The function to hand over (the function itself outside an operation).
+
+def bind(function):
+    op = getattr(_local, 'operation', None)
+    if op is None:
+        return function
+    path = getattr(_local, 'path', '')
+
+    def bound(*args, **kwargs):
+        saved = getattr(_local, 'operation', None), getattr(_local, 'path', '')
+        _local.operation, _local.path = op, path
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.operation, _local.path = saved
+    return bound
+
+
+# Function: observed
+# Description: Like bind, for an MQTT message callback whose messages are also counted as received.
+# Parameters:
+#   - callback: Function called with each message.
+# Returns: The callback to hand over.
+
+def observed(callback):
+    op = getattr(_local, 'operation', None)
+    if op is None:
+        return callback
+    bound = bind(callback)
+
+    def counting(msg):
+        op.received(msg.payload)
+        return bound(msg)
+    return counting
+
+
+# Function: sent
+# Description: Counts a message published by the current operation (see mqttsession.Session.publish).
+# Returns: None
+
+def sent(payload):
+    op = getattr(_local, 'operation', None)
+    if op is not None:
+        op.sent(payload)
+
+
+# Class: JSONLinesExporter
+# Description: Writes every operation as one JSON line.
+# Parameters:
+#   - path: The file the lines are appended to, '-' for standard error (standard output carries GET results).
+
+class JSONLinesExporter:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, op):
+        line = json.dumps(op.to_dict(), separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.path == '-':
+                sys.stderr.write(line)
+                sys.stderr.flush()
+                return
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"Could not write the profile {self.path}: {e}")
+
+
+_sample_re = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+_label_re = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+
+# Function: parse_prometheus
+# Description: Reads samples back from Prometheus text written by render_prometheus.
+# Parameters:
+#   - text: The exposition text.
+# Returns: A dictionary {(metric, labels): value}.
+
+def parse_prometheus(text):
+    samples = {}
+    for line in text.splitlines():
+        match = _sample_re.match(line.strip())
+        if line.startswith('#') or match is None:
+            continue
+        name, labels, value = match.groups()
+        try:
+            samples[(name, tuple((k, _unescape(v)) for k, v in _label_re.findall(labels or '')))] = float(value)
+        except ValueError:
+            continue
+    return samples
+
+
+# Function: render_prometheus
+# Description: Renders samples in the Prometheus text exposition format.
+# Parameters:
+#   - samples: A dictionary {(metric, labels): value}.
+#   - gauges (optional): The metrics that are gauges (the others are counters, or the operation latency histogram).
+# Returns: The text.
+
+def render_prometheus(samples, gauges=()):
+    families = {}
+    for (name, labels), value in samples.items():
+        family = re.sub(r'_(bucket|sum|count)$', '', name) if name.startswith('comdex_operation_seconds') else name
+        families.setdefault(family, []).append((name, labels, value))
+    lines = []
+    for family in sorted(families):
+        kind = 'gauge' if family in gauges else 'histogram' if family == 'comdex_operation_seconds' else 'counter'
+        lines.append(f"# TYPE {family} {kind}")
+        for name, labels, value in sorted(families[family], key=_sample_order):
+            text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+            lines.append(f"{name}{{{text}}} {value:.9g}" if text else f"{name} {value:.9g}")
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _sample_order(sample):
+    name, labels, value = sample
+    # histogram buckets in increasing bounds, +Inf last
+    le = dict(labels).get('le')
+    return name, tuple(label for label in labels if label[0] != 'le'), float(le) if le is not None else 0.0
+
+
+def _accumulate(totals, samples):
+    for key, value in samples.items():
+        totals[key] = totals.get(key, 0) + value
+
+
+# Class: PrometheusFileExporter
+# Description: Adds every operation to the counters of a Prometheus text file, shared by all the ComDeX processes
+# writing it (a lock file serializes them; the file is replaced atomically).
+# Parameters:
+#   - path: The .prom file.
+
+class PrometheusFileExporter:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, op):
+        directory = os.path.dirname(self.path) or '.'
+        with self.lock:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                with open(self.path + '.lock', 'a') as lock:
+                    if fcntl is not None:
+                        fcntl.flock(lock, fcntl.LOCK_EX)
+                    try:
+                        with open(self.path, encoding='utf-8') as f:
+                            totals = parse_prometheus(f.read())
+                    except OSError:
+                        totals = {}
+                    _accumulate(totals, op.samples())
+                    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.comdex-metrics-')
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        f.write(render_prometheus(totals))
+                    os.chmod(tmp, 0o644)
+                    os.replace(tmp, self.path)
+            except OSError as e:
+                print(f"Could not write the metrics file {self.path}: {e}")
+
+
+# Function: export
+# Description: Adds a finished operation to the in-memory counters and hands it to the exporters.
+# Returns: None
+
+def export(op):
+    with _totals_lock:
+        _accumulate(_totals, op.samples())
+    for exporter in _exporters:
+        exporter.export(op)
+
+
+# Function: prometheus_text
+# Description: The counters of the operations of this process, in the Prometheus text exposition format.
+# Returns: The text.
+
+def prometheus_text():
+    with _totals_lock:
+        return render_prometheus(dict(_totals))
+
+
+# Function: configure
+# Description: Enables the instrumentation, exporting to a target: 'metrics' (in-memory counters only), a JSON lines file
+# (or 'jsonl:<file>'), '-' for JSON lines on standard error, or 'prometheus:<file>'.
+# Parameters:
+#   - target: The target.
+# Returns: True, False if the target is empty.
+
+def configure(target):
+    global enabled
+    if target in ('', 'jsonl:', 'prometheus:'):
+        print("--profile needs a target: metrics, a JSON lines file, '-' or prometheus:<file>")
+        return False
+    if target.startswith('prometheus:'):
+        _exporters.append(PrometheusFileExporter(target[len('prometheus:'):]))
+    elif target != 'metrics':
+        _exporters.append(JSONLinesExporter(target[len('jsonl:'):] if target.startswith('jsonl:') else target))
+    enabled = True
+    return True
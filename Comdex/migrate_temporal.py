@@ -0,0 +1,191 @@
+# ComDeX Temporal Layout Migration
+
+# Rewrites the retained entity data of a broker from one temporal layout to
+# the other (see codec.py):
+#
+#   - to 'envelope': every attribute and its <attr>_timerelsystem_CreatedAt /
+#     <attr>_timerelsystem_modifiedAt topics become one envelope on the
+#     attribute topic, and the two temporal topics are cleared;
+#   - to 'topics': every envelope is split back into the plain attribute and
+#     its two temporal topics.
+#
+# The retained snapshot is read once, the rewrites are pipelined through a
+# PublishWindow. Payloads keep the format they are re-encoded with
+# (--payload_format). Readers understand both layouts, so the migration can
+# run while the node is serving.
+#
+#   python3 migrate_temporal.py -b localhost -p 1026 --to envelope [--area plant1] [--dry_run]
+
+import sys
+import time
+import getopt
+import mqttsession
+import codec
+
+temporal_suffixes = {'_timerelsystem_CreatedAt': 'createdAt', '_timerelsystem_modifiedAt': 'modifiedAt'}
+
+
+def _split(topic):
+    # returns (attribute topic, temporal name or None)
+    for suffix, name in temporal_suffixes.items():
+        if topic.endswith(suffix):
+            return topic[:-len(suffix)], name
+    return topic, None
+
+
+# Function: migrate_temporal_layout
+# Description: Rewrites the retained entities of a broker into a temporal layout.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - target: 'envelope' or 'topics'.
+#   - area (optional): Only migrate this area (default: '+', every area).
+#   - username / password (optional): MQTT credentials.
+#   - dry_run (optional): Only count what would be rewritten.
+#   - inflight (optional): Maximum number of unacknowledged publishes.
+# Returns: A dictionary with the numbers of attributes rewritten, already in the target layout and of orphan temporal
+# topics cleared, or None if the target is unknown or the snapshot could not be read.
+
+def migrate_temporal_layout(broker, port, target, area='+', username=None, password=None, dry_run=False, inflight=None):
+    if target not in codec.temporal_layouts:
+        print(f"Unknown temporal layout {target}, choose one of: {', '.join(codec.temporal_layouts)}")
+        return None
+    start = time.monotonic()
+    session = mqttsession.get_session(broker, port, username, password)
+    attributes = {}
+
+    def on_message(msg):
+        if msg.retain and msg.payload:
+            base, name = _split(msg.topic)
+            attributes.setdefault(base, {})[name] = msg.payload
+
+    if not session.collect_retained([f"{area}/entities/#"], 1, on_message):
+        print("The retained snapshot could not be read completely, nothing was migrated")
+        return None
+
+    window = mqttsession.PublishWindow(session, inflight or mqttsession.default_inflight_window)
+    rewritten = unchanged = orphans = undecodable = 0
+    for base, parts in attributes.items():
+        if None not in parts:
+            # temporal topics left behind by a deleted attribute
+            orphans += 1
+            if not dry_run:
+                for suffix, name in temporal_suffixes.items():
+                    if name in parts:
+                        window.publish(base + suffix, '', qos=1, retain=True)
+            continue
+        try:
+            value, temporal = codec.unwrap_attribute(codec.decode(parts[None]))
+            legacy = {name: codec.decode(payload) for name, payload in parts.items() if name is not None}
+        except ValueError as e:
+            print(f"Skipping {base}: {e}")
+            undecodable += 1
+            continue
+        if target == 'envelope':
+            if temporal is not None and not legacy:
+                unchanged += 1
+                continue
+            temporal = temporal or {}
+            created = temporal.get('createdAt', legacy.get('createdAt'))
+            modified = temporal.get('modifiedAt', legacy.get('modifiedAt'))
+            rewritten += 1
+            if dry_run:
+                continue
+            window.publish(base, codec.encode(codec.wrap_attribute(value, created, modified)), qos=1, retain=True)
+            for suffix, name in temporal_suffixes.items():
+                if name in legacy:
+                    window.publish(base + suffix, '', qos=1, retain=True)
+        else:
+            if temporal is None:
+                unchanged += 1
+                continue
+            rewritten += 1
+            if dry_run:
+                continue
+            window.publish(base, codec.encode(value), qos=1, retain=True)
+            for suffix, name in temporal_suffixes.items():
+                if temporal.get(name) is not None:
+                    window.publish(base + suffix, codec.encode(temporal[name]), qos=1, retain=True)
+
+    failed = window.flush()
+    elapsed = time.monotonic() - start
+    if failed:
+        print(f"Warning: {failed} publishes were not acknowledged by the broker")
+    print(f"{'Would rewrite' if dry_run else 'Rewrote'} {rewritten} attributes to the '{target}' layout, {unchanged} already in it, "
+          f"{orphans} orphan temporal topics{'' if dry_run else ' cleared'}, {undecodable} undecodable, in {elapsed:.2f}s")
+    return {'rewritten': rewritten, 'unchanged': unchanged, 'orphans': orphans, 'undecodable': undecodable,
+            'failed_publishes': failed, 'seconds': elapsed}
+
+
+def usage():
+    print("\nUsage:")
+    print("python3 migrate_temporal.py [options]\n")
+    print("Options:")
+    print("-h, --help                Show this help message and exit")
+    print("-b, --broker_address      Specify the address of the MQTT broker of the ComDeX node")
+    print("-p, --port                Specify the port number of the MQTT broker of the ComDeX node")
+    print("-N, --username            MQTT username")
+    print("-S, --password            MQTT password")
+    print("--to                      Target temporal layout: 'envelope' or 'topics'")
+    print("--area                    Only migrate the entities of this area (default: all areas)")
+    print("--payload_format          Format of the rewritten payloads: 'json' (default), 'msgpack' or 'cbor'")
+    print("--inflight                Maximum number of unacknowledged publishes (default: 100)")
+    print("--dry_run                 Only report what would be rewritten")
+    print("\nExample:")
+    print("python3 migrate_temporal.py -b localhost -p 1026 --to envelope\n")
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hb:p:N:S:", ["help", "broker_address=", "port=", "username=", "password=", "to=",
+                                                      "area=", "payload_format=", "inflight=", "dry_run"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    broker = 'localhost'
+    port = 1026
+    username = None
+    password = None
+    target = None
+    area = '+'
+    inflight = None
+    dry_run = False
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage(); sys.exit()
+        elif opt in ("-b", "--broker_address"):
+            broker = arg
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-N", "--username"):
+            username = arg
+        elif opt in ("-S", "--password"):
+            password = arg
+        elif opt == "--to":
+            target = arg
+        elif opt == "--area":
+            area = arg
+        elif opt == "--payload_format":
+            if not codec.set_default_format(arg):
+                sys.exit(2)
+        elif opt == "--inflight":
+            inflight = int(arg)
+        elif opt == "--dry_run":
+            dry_run = True
+    if target is None:
+        print("Missing --to envelope|topics")
+        usage()
+        sys.exit(2)
+
+    try:
+        result = migrate_temporal_layout(broker, port, target, area, username, password, dry_run, inflight)
+    except ConnectionError as e:
+        print(f"Could not connect to the broker: {e}")
+        sys.exit(2)
+    if result is None:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
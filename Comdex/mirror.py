@@ -0,0 +1,412 @@
+# ComDeX Retained Topic Mirror
+
+# Keeps an in-memory copy of a broker's retained store through one
+# long-lived `#` subscription, organised as a trie over the topic levels
+# (area/entities/context/type/node/id/attr and provider/broker/port/area/
+# context/type[/id]). Existence checks, GETs and provider discovery are then
+# answered by walking the trie in-process instead of subscribing to a
+# wildcard and waiting for the broker to replay it.
+#
+# An empty retained payload deletes the topic from the mirror. A broker
+# forwards a retained publish to the subscribers already connected as a plain
+# (retain=0) message, so live messages cannot tell retained publishes from
+# notifications and telemetry: they are only mirrored on topics that are
+# already retained or that follow the entity/provider topic scheme. After a
+# reconnect the broker replays the whole retained store again; topics that
+# are not replayed were deleted while the mirror was offline and are swept.
+
+import time
+import threading
+import collections
+import mqttsession
+import instrumentation
+
+#topics that are never mirrored: sync markers of the sessions and the broker's own statistics
+ignored_prefixes=(mqttsession.sync_topic_prefix + '/', '$')
+
+
+# Function: is_retained_scheme
+# Description: Whether a topic follows the scheme of the retained topics ComDeX writes:
+# area/entities/context/type/node/id/attr or provider/broker/port/area/context/type[/id].
+# Returns: True or False.
+
+def is_retained_scheme(topic):
+    levels = topic.split('/')
+    if levels[0] == 'provider':
+        return len(levels) in (6, 7)
+    return len(levels) == 7 and levels[1] == 'entities'
+
+
+# Class: MirroredMessage
+# Description: A retained message served from the mirror. It has the topic, payload and retain attributes of a paho
+# MQTTMessage, so the entity recreation functions accept both.
+
+MirroredMessage = collections.namedtuple('MirroredMessage', ['topic', 'payload', 'retain'])
+
+
+class _Node:
+    __slots__ = ('children', 'payload', 'updated', 'generation')
+
+    def __init__(self):
+        self.children = {}
+        self.payload = None
+        self.updated = 0.0
+        self.generation = 0
+
+
+# Class: TopicTrie
+# Description: Retained payloads indexed by topic level. Wildcard filters are answered by walking only the matching
+# branches; matches come out depth first, so the attributes of an entity are contiguous like in a broker replay.
+
+class TopicTrie:
+
+    def __init__(self):
+        self.root = _Node()
+        self.size = 0
+
+    # Function: set
+    # Description: Stores the payload of a topic (an empty payload deletes it).
+    # Returns: None
+    def set(self, topic, payload, generation=0, now=None):
+        if not payload:
+            self.delete(topic)
+            return
+        node = self.root
+        for level in topic.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _Node()
+            node = child
+        if node.payload is None:
+            self.size += 1
+        node.payload = payload
+        node.updated = time.time() if now is None else now
+        node.generation = generation
+
+    # Function: contains
+    # Description: Whether a topic is stored.
+    # Returns: True or False.
+    def contains(self, topic):
+        node = self.root
+        for level in topic.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return False
+        return node.payload is not None
+
+    # Function: delete
+    # Description: Removes a topic and prunes the branches left empty.
+    # Returns: True if the topic was present.
+    def delete(self, topic):
+        path = [self.root]
+        levels = topic.split('/')
+        for level in levels:
+            child = path[-1].children.get(level)
+            if child is None:
+                return False
+            path.append(child)
+        if path[-1].payload is None:
+            return False
+        path[-1].payload = None
+        self.size -= 1
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.children or node.payload is not None:
+                break
+            del path[i - 1].children[levels[i - 1]]
+        return True
+
+    # Function: match
+    # Description: Yields the (topic, node) pairs of the stored topics matching an MQTT topic filter.
+    def match(self, topic_filter):
+        levels = topic_filter.split('/')
+        stack = [(self.root, 0, [])]
+        while stack:
+            node, depth, path = stack.pop()
+            if depth == len(levels):
+                if node.payload is not None:
+                    yield '/'.join(path), node
+                continue
+            level = levels[depth]
+            if level == '#':
+                # 'a/#' also matches 'a' itself
+                if node.payload is not None and depth > 0:
+                    yield '/'.join(path), node
+                yield from self._descendants(node, path)
+            elif level == '+':
+                for name, child in reversed(list(node.children.items())):
+                    stack.append((child, depth + 1, path + [name]))
+            else:
+                child = node.children.get(level)
+                if child is not None:
+                    stack.append((child, depth + 1, path + [level]))
+
+    def _descendants(self, node, path):
+        stack = [(child, path + [name]) for name, child in reversed(list(node.children.items()))]
+        while stack:
+            node, path = stack.pop()
+            if node.payload is not None:
+                yield '/'.join(path), node
+            stack.extend((child, path + [name]) for name, child in reversed(list(node.children.items())))
+
+    # Function: sweep
+    # Description: Deletes the topics last written before a generation.
+    # Returns: The number of deleted topics.
+    def sweep(self, generation):
+        stale = [topic for topic, node in self._descendants(self.root, []) if node.generation < generation]
+        for topic in stale:
+            self.delete(topic)
+        return len(stale)
+
+
+# Class: Mirror
+# Description: A resident mirror of the retained store of one broker, kept up to date by a dedicated MQTT connection
+# (a separate connection, so the `#` subscription does not overlap the wildcard subscriptions of the pooled session).
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - username / password (optional): MQTT credentials.
+
+class Mirror:
+
+    def __init__(self, broker, port, username=None, password=None):
+        self.broker = broker
+        self.port = int(port)
+        self.trie = TopicTrie()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.generation = 0
+        self.last_message = None
+        self.last_synced = None
+        self.disconnected_since = None
+        self.messages = 0
+        self.deletions = 0
+        self.resyncs = 0
+        self.swept = 0
+        self.snapshot_seconds = None
+        self.session = mqttsession.Session(broker, port, username, password)
+        self.handler = None
+
+    # Function: start
+    # Description: Connects, subscribes to `#` and blocks until the initial retained snapshot is loaded.
+    # Parameters:
+    #   - timeout (optional): Maximum time to wait for the snapshot in seconds.
+    # Returns: True if the snapshot was loaded in time. Raises ConnectionError if the broker cannot be reached.
+    def start(self, timeout=mqttsession.default_collect_timeout):
+        self.session.connect()
+        self.session.disconnect_callbacks.append(self._on_disconnect)
+        self.session.connect_callbacks.append(self._on_reconnect)
+        with self.lock:
+            self.generation += 1
+        self.handler = self.session.subscribe('#', 1, self._on_message)
+        self.session.wait_subscribed(self.handler, mqttsession.default_connect_timeout)
+        return self._resync(self.generation, timeout)
+
+    def _on_message(self, msg):
+        topic = msg.topic
+        if topic.startswith(ignored_prefixes):
+            return
+        now = time.time()
+        with self.lock:
+            self.messages += 1
+            self.last_message = now
+            if msg.payload:
+                # retained replays are stored as they come; live messages only update retained topics
+                if msg.retain or is_retained_scheme(topic) or self.trie.contains(topic):
+                    self.trie.set(topic, msg.payload, self.generation, now)
+            elif self.trie.delete(topic):
+                self.deletions += 1
+
+    # Function: apply_local_publish
+    # Description: Applies a retained publish of this process right away, so its own writes are visible to its next
+    # lookup without waiting for the broker to echo them back.
+    # Returns: None
+    def apply_local_publish(self, topic, payload, retain):
+        if not retain or topic.startswith(ignored_prefixes):
+            return
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        with self.lock:
+            if payload:
+                self.trie.set(topic, bytes(payload), self.generation)
+            elif self.trie.delete(topic):
+                self.deletions += 1
+
+    def _on_disconnect(self, session):
+        with self.lock:
+            self.ready.clear()
+            self.disconnected_since = time.time()
+
+    def _on_reconnect(self, session):
+        # the replay is delivered by this (network) thread after the callback returns, so every replayed
+        # topic is stamped with the new generation; the wait for its end runs in another thread
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            self.resyncs += 1
+        threading.Thread(target=self._resync, args=(generation,), daemon=True).start()
+
+    def _resync(self, generation, timeout=mqttsession.default_collect_timeout):
+        start = time.monotonic()
+        # the sync marker arrives after the retained replay; brokers that drop it complete on an idle gap
+        deadline = start + timeout
+        while not self.session.sync(mqttsession.default_sentinel_grace):
+            idle = time.time() - (self.last_message or 0)
+            if idle >= mqttsession.default_sentinel_grace or time.monotonic() >= deadline:
+                break
+        if time.monotonic() >= deadline:
+            return False
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.swept += self.trie.sweep(generation)
+            self.snapshot_seconds = time.monotonic() - start
+            self.last_synced = time.time()
+            self.disconnected_since = None
+            self.ready.set()
+        return True
+
+    # Function: is_current
+    # Description: Whether lookups reflect the broker: connected and with a complete snapshot.
+    # Returns: True or False.
+    def is_current(self):
+        return self.ready.is_set() and self.session.connected.is_set()
+
+    # Function: messages_matching
+    # Description: Looks up the retained messages matching topic filters, in place of a broker replay.
+    # Parameters:
+    #   - topics: List of MQTT topic filters.
+    # Returns: List of MirroredMessage.
+    def messages_matching(self, topics):
+        with self.lock:
+            result = []
+            seen = set()
+            for topic_filter in topics:
+                for topic, node in self.trie.match(topic_filter):
+                    if topic not in seen:
+                        seen.add(topic)
+                        result.append(MirroredMessage(topic, node.payload, 1))
+            return result
+
+    # Function: first_matching
+    # Description: Looks up one retained message matching a topic filter (existence checks).
+    # Returns: A MirroredMessage, or None.
+    def first_matching(self, topic_filter):
+        with self.lock:
+            for topic, node in self.trie.match(topic_filter):
+                return MirroredMessage(topic, node.payload, 1)
+        return None
+
+    # Function: stats
+    # Description: Size and staleness metrics of the mirror.
+    # Returns: A dictionary.
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return {
+                'broker': f"{self.broker}:{self.port}",
+                'current': self.is_current(),
+                'topics': self.trie.size,
+                'messages': self.messages,
+                'deletions': self.deletions,
+                'resyncs': self.resyncs,
+                'swept_after_resync': self.swept,
+                'snapshot_seconds': self.snapshot_seconds,
+                'seconds_since_last_message': None if self.last_message is None else now - self.last_message,
+                'seconds_since_sync': None if self.last_synced is None else now - self.last_synced,
+                'seconds_disconnected': None if self.disconnected_since is None else now - self.disconnected_since,
+            }
+
+    def close(self):
+        self.ready.clear()
+        self.session.close()
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+# Function: start_mirror
+# Description: Starts (once) the mirror of a broker; later ComDeX lookups against that broker are answered from it.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - username / password (optional): MQTT credentials.
+# Returns: The Mirror. Raises ConnectionError if the broker cannot be reached.
+
+def start_mirror(broker, port, username=None, password=None):
+    key = (broker, int(port))
+    with _mirrors_lock:
+        mirror = _mirrors.get(key)
+        if mirror is not None:
+            return mirror
+        mirror = _mirrors[key] = Mirror(broker, port, username, password)
+    try:
+        mirror.start()
+        mqttsession.get_session(broker, port, username, password).publish_observers.append(mirror.apply_local_publish)
+    except ConnectionError:
+        with _mirrors_lock:
+            _mirrors.pop(key, None)
+        mirror.close()
+        raise
+    return mirror
+
+
+# Function: get_mirror
+# Description: Returns the mirror of a broker if one is running and current.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+# Returns: A Mirror, or None when lookups have to go to the broker.
+
+def get_mirror(broker, port):
+    if not _mirrors:
+        return None
+    mirror = _mirrors.get((broker, int(port)))
+    if mirror is None or not mirror.is_current():
+        return None
+    return mirror
+
+
+#Prometheus metrics of the mirror stats, and whether they are gauges
+_metrics = (('current', 'comdex_mirror_current', True), ('topics', 'comdex_mirror_topics', True),
+            ('messages', 'comdex_mirror_messages_total', False), ('deletions', 'comdex_mirror_deletions_total', False),
+            ('resyncs', 'comdex_mirror_resyncs_total', False), ('swept_after_resync', 'comdex_mirror_swept_topics_total', False),
+            ('snapshot_seconds', 'comdex_mirror_snapshot_seconds', True),
+            ('seconds_since_last_message', 'comdex_mirror_seconds_since_last_message', True),
+            ('seconds_since_sync', 'comdex_mirror_seconds_since_sync', True),
+            ('seconds_disconnected', 'comdex_mirror_seconds_disconnected', True))
+
+
+# Function: prometheus_text
+# Description: The stats of the running mirrors in the Prometheus text exposition format, one series per broker.
+# Unknown values (no snapshot yet) are left out; a connected mirror has been disconnected for 0 seconds.
+# Returns: The text, None when no mirror runs.
+
+def prometheus_text():
+    with _mirrors_lock:
+        mirrors = list(_mirrors.values())
+    if not mirrors:
+        return None
+    samples = {}
+    for mirror in mirrors:
+        stats = mirror.stats()
+        if stats['seconds_disconnected'] is None:
+            stats['seconds_disconnected'] = 0
+        labels = (('broker', stats['broker']),)
+        for key, name, gauge in _metrics:
+            if stats[key] is not None:
+                samples[(name, labels)] = float(stats[key])
+    return instrumentation.render_prometheus(samples, gauges={name for key, name, gauge in _metrics if gauge})
+
+
+# Function: stop_mirrors
+# Description: Stops every running mirror.
+# Returns: None
+
+def stop_mirrors():
+    with _mirrors_lock:
+        mirrors = list(_mirrors.values())
+        _mirrors.clear()
+    for mirror in mirrors:
+        mirror.close()
@@ -0,0 +1,591 @@
+# ComDeX MQTT Session Pool
+
+# Keeps one authenticated, auto-reconnecting MQTT connection per
+# (broker, port, username, password) so that repeated ComDeX operations
+# (existence checks, GETs, batch POSTs, retained scans) reuse a single
+# TCP+CONNECT handshake instead of paying it on every call.
+
+import os
+import socket
+import threading
+import time
+import itertools
+import collections
+import selectors
+import atexit
+import uuid
+import paho.mqtt.client as mqtt
+import instrumentation
+
+#default values for connection handling
+default_keepalive=60
+default_connect_timeout=5
+default_min_backoff=1
+default_max_backoff=32
+
+#default values for retained snapshot completion
+#quiet window: the snapshot is complete once no retained message arrived for this long
+default_quiet_window=0.25
+#idle fallback used while waiting for the sync marker (brokers whose ACL drop the marker still complete)
+default_sentinel_grace=1.0
+#hard upper bound of a retained collection
+default_collect_timeout=30
+sync_topic_prefix='comdex_sync'
+
+#observers called with (topic, payload, retain) before every publish of every session
+publish_observers=[]
+
+#default number of unacknowledged QoS 1/2 publishes kept in flight by a PublishWindow
+default_inflight_window=100
+
+
+# Class: Session
+# Description: A single MQTT connection shared by every ComDeX operation that targets the same broker with the same credentials.
+# Incoming messages are dispatched to the handlers whose topic filter matches, so several operations can use the
+# connection at the same time. Subscriptions are reference counted and restored after a reconnect.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - username (optional): MQTT username.
+#   - password (optional): MQTT password.
+#   - keepalive (optional): MQTT keepalive interval in seconds.
+#   - min_backoff / max_backoff (optional): Bounds (seconds) of the exponential reconnect backoff.
+#   - network_loop (optional): A NetworkLoop driving the connection, instead of a network thread of its own.
+
+class Session:
+
+    def __init__(self, broker, port, username=None, password=None, keepalive=default_keepalive,
+                 min_backoff=default_min_backoff, max_backoff=default_max_backoff, network_loop=None):
+        self.broker = broker
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.RLock()
+        self.handlers = {}
+        self.filter_refs = {}
+        self.handler_ids = itertools.count(1)
+        self.connected = threading.Event()
+        self.acks = threading.Condition()
+        self.handler_mids = {}
+        self.acked_mids = set()
+        self.sync_id = uuid.uuid4().hex
+        self.sync_counter = itertools.count(1)
+        self.sync_events = {}
+        self.sync_handler = None
+        self.sync_lock = threading.Lock()
+        self.connack_rc = None
+        self.started = False
+        self.closed = False
+        self.connect_lock = threading.Lock()
+        self.max_inflight = 20
+        self.connect_callbacks = []
+        self.disconnect_callbacks = []
+        self.publish_observers = []
+        self.network_loop = network_loop
+
+        self.client = mqtt.Client(clean_session=True)
+        if username and password:
+            self.client.username_pw_set(username, password)
+        self.client.reconnect_delay_set(min_delay=min_backoff, max_delay=max_backoff)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.on_subscribe = self._on_subscribe
+
+    # Function: connect
+    # Description: Connects to the broker, retrying with exponential backoff, and waits for the CONNACK.
+    # Parameters:
+    #   - attempts (optional): Number of connection attempts before giving up.
+    #   - timeout (optional): Seconds to wait for the CONNACK of each attempt.
+    # Returns: The session itself. Raises ConnectionError if the broker refuses or cannot be reached.
+    def connect(self, attempts=3, timeout=default_connect_timeout):
+        if self.network_loop is not None:
+            self.network_loop.attach(self)
+        try:
+            with instrumentation.span('connect'):
+                return self._connect(attempts, timeout)
+        except ConnectionError:
+            if self.network_loop is not None:
+                self.network_loop.detach(self)
+            raise
+
+    def _connect(self, attempts, timeout):
+        delay = self.min_backoff
+        last_error = None
+        for attempt in range(attempts):
+            try:
+                self.client.connect(self.broker, self.port, keepalive=self.keepalive)
+                if self.network_loop is None:
+                    self.client.loop_start()
+            except (OSError, ValueError) as e:
+                last_error = e
+            else:
+                if self.connected.wait(timeout):
+                    self.started = True
+                    return self
+                self.client.loop_stop()
+                if self.connack_rc == 5:
+                    raise ConnectionError("MQTT authentication failed with result code 5 (Not authorized)")
+                last_error = ConnectionError(f"MQTT connection failed with code {self.connack_rc}")
+            if attempt + 1 < attempts:
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+        raise ConnectionError(f"Could not connect to {self.broker}:{self.port}: {last_error}")
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self.connack_rc = rc
+        if rc != 0:
+            print(f"Connection to {self.broker}:{self.port} failed with return code {rc}")
+            return
+        # small request/response packets (SUBSCRIBE, sync markers, acks) must not wait for Nagle's delayed ACK
+        sock = client.socket()
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        # clean sessions lose their subscriptions on every reconnect, restore them
+        with self.lock:
+            filters = list(self.filter_refs.items())
+            handler_filters = {handler_id: entry[0] for handler_id, entry in self.handlers.items()}
+        for topic_filter, (count, qos) in filters:
+            result, mid = client.subscribe(topic_filter, qos)
+            if result != mqtt.MQTT_ERR_SUCCESS:
+                continue
+            # handlers subscribed while the connection was down wait for the SUBACK of this subscription
+            with self.acks:
+                for handler_id, handler_mid in self.handler_mids.items():
+                    if handler_mid is None and handler_filters.get(handler_id) == topic_filter:
+                        self.handler_mids[handler_id] = mid
+                self.acks.notify_all()
+        self.connected.set()
+        for callback in list(self.connect_callbacks):
+            callback(self)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        if rc != 0 and not self.closed:
+            print(f"Lost connection to {self.broker}:{self.port}, reconnecting...")
+        for callback in list(self.disconnect_callbacks):
+            callback(self)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        with self.acks:
+            self.acked_mids.add(mid)
+            self.acks.notify_all()
+
+    def _on_message(self, client, userdata, msg):
+        with self.lock:
+            handlers = list(self.handlers.values())
+        for topic_filter, callback in handlers:
+            if mqtt.topic_matches_sub(topic_filter, msg.topic):
+                callback(msg)
+
+    # Function: subscribe
+    # Description: Registers a message handler for a topic filter and subscribes to it on the broker
+    # (the broker subscription is shared by all handlers of the same filter).
+    # Parameters:
+    #   - topic_filter: MQTT topic filter (wildcards allowed).
+    #   - qos: The quality of service level of the subscription.
+    #   - callback: Function called with every matching MQTTMessage.
+    # Returns: A handler id to be passed to unsubscribe.
+    def subscribe(self, topic_filter, qos, callback):
+        with self.lock:
+            handler_id = next(self.handler_ids)
+            self.handlers[handler_id] = (topic_filter, callback)
+            count, granted = self.filter_refs.get(topic_filter, (0, qos))
+            self.filter_refs[topic_filter] = (count + 1, max(granted, qos))
+        # None: not sent yet, the subscription restored on the next connection acknowledges it (see _on_connect)
+        with self.acks:
+            self.handler_mids[handler_id] = None
+        # resubscribing makes the broker replay the retained messages for the new handler
+        result, mid = self.client.subscribe(topic_filter, qos)
+        with self.acks:
+            if result == mqtt.MQTT_ERR_SUCCESS:
+                self.handler_mids[handler_id] = mid
+            elif result != mqtt.MQTT_ERR_NO_CONN:
+                # refused by the client, no SUBACK will ever come
+                print(f"Could not subscribe to {topic_filter} on {self.broker}:{self.port}: {mqtt.error_string(result)}")
+                self.handler_mids[handler_id] = False
+            self.acks.notify_all()
+        return handler_id
+
+    # Function: wait_subscribed
+    # Description: Blocks until the broker acknowledged (SUBACK) the subscription of a handler. A subscription made while
+    # the connection is down is acknowledged once it is restored on reconnect.
+    # Parameters:
+    #   - handler_id: Id returned by subscribe.
+    #   - timeout: Maximum time to wait in seconds.
+    # Returns: True if the subscription was acknowledged in time, False otherwise (at once if the client refused it).
+    def wait_subscribed(self, handler_id, timeout):
+        def settled():
+            mid = self.handler_mids.get(handler_id)
+            return mid is False or (mid is not None and mid in self.acked_mids)
+
+        with self.acks:
+            return self.acks.wait_for(settled, timeout) and self.handler_mids.get(handler_id) is not False
+
+    # Function: unsubscribe
+    # Description: Removes a handler, and unsubscribes its topic filter once no other handler uses it.
+    # Parameters:
+    #   - handler_id: Id returned by subscribe.
+    # Returns: None
+    def unsubscribe(self, handler_id):
+        with self.acks:
+            self.acked_mids.discard(self.handler_mids.pop(handler_id, None))
+        with self.lock:
+            entry = self.handlers.pop(handler_id, None)
+            if entry is None:
+                return
+            topic_filter = entry[0]
+            count, qos = self.filter_refs[topic_filter]
+            if count > 1:
+                self.filter_refs[topic_filter] = (count - 1, qos)
+                return
+            del self.filter_refs[topic_filter]
+        self.client.unsubscribe(topic_filter)
+
+    def _on_sync(self, msg):
+        notify = self.sync_events.pop(msg.topic, None)
+        if notify is not None:
+            notify()
+
+    # Function: collect_retained
+    # Description: Subscribes to topic filters and blocks (on a condition variable, without spinning) until the broker has
+    # finished replaying their retained messages. Completion is detected with a sync marker: once every subscription is
+    # acknowledged a message is published to a private topic of this session, and since the broker delivers to a client in
+    # order, its arrival means the retained burst before it is over. An idle-gap detector (no retained message for `quiet`
+    # seconds) covers brokers that do not forward the marker.
+    # Parameters:
+    #   - topics: List of topic filters to subscribe to.
+    #   - qos: The quality of service level of the subscriptions.
+    #   - callback: Function called with every matching message. If it returns True the collection stops early.
+    #   - quiet (optional): Idle window in seconds after which the snapshot is considered complete.
+    #   - timeout (optional): Hard upper bound of the whole collection in seconds.
+    #   - sentinel (optional): Use the sync marker (default: True), otherwise rely on the idle window only.
+    # Returns: True if the snapshot completed, False if the collection timed out.
+    def collect_retained(self, topics, qos, callback, quiet=None, timeout=None, sentinel=True):
+        quiet = default_quiet_window if quiet is None else quiet
+        timeout = default_collect_timeout if timeout is None else timeout
+        done = threading.Condition()
+        state = {'last': time.monotonic(), 'stop': False, 'synced': False}
+
+        def on_message(msg):
+            stop = callback(msg)
+            with done:
+                if msg.retain:
+                    state['last'] = time.monotonic()
+                if stop:
+                    state['stop'] = True
+                done.notify()
+
+        def on_synced():
+            with done:
+                state['synced'] = True
+                done.notify()
+
+        deadline = time.monotonic() + timeout
+        handlers = [self.subscribe(topic, qos, on_message) for topic in topics]
+        try:
+            for handler in handlers:
+                if not self.wait_subscribed(handler, max(0, deadline - time.monotonic())):
+                    return False
+            window = quiet
+            if sentinel:
+                window = max(quiet, default_sentinel_grace)
+                self._publish_sync(on_synced, qos)
+            with done:
+                state['last'] = time.monotonic()
+                while True:
+                    now = time.monotonic()
+                    if state['stop'] or state['synced']:
+                        return True
+                    if now - state['last'] >= window:
+                        return True
+                    if now >= deadline:
+                        return False
+                    done.wait(min(deadline, state['last'] + window) - now)
+        finally:
+            for handler in handlers:
+                self.unsubscribe(handler)
+
+    def _publish_sync(self, notify, qos):
+        with self.sync_lock:
+            if self.sync_handler is None:
+                self.sync_handler = self.subscribe(f"{sync_topic_prefix}/{self.sync_id}/+", 1, self._on_sync)
+                self.wait_subscribed(self.sync_handler, default_connect_timeout)
+        topic = f"{sync_topic_prefix}/{self.sync_id}/{next(self.sync_counter)}"
+        self.sync_events[topic] = notify
+        self.client.publish(topic, b'', qos=max(qos, 1), retain=False)
+
+    # Function: sync
+    # Description: Blocks until every message the broker sent to this session before the call has been delivered, by
+    # waiting for a sync marker to make the round trip (the broker delivers to a client in order).
+    # Parameters:
+    #   - timeout (optional): Maximum time to wait in seconds.
+    # Returns: True if the marker arrived in time, False otherwise.
+    def sync(self, timeout=default_collect_timeout):
+        arrived = threading.Event()
+        self._publish_sync(arrived.set, 1)
+        return arrived.wait(timeout)
+
+    # Function: publish
+    # Description: Publishes a message over the shared connection (same signature as paho's Client.publish). Publish
+    # observers (e.g. a retained mirror, see mirror.py) see the message before it is sent.
+    # Returns: The paho MQTTMessageInfo of the publish.
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        for observer in publish_observers + self.publish_observers:
+            observer(topic, payload, retain)
+        instrumentation.sent(payload)
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def close(self):
+        self.closed = True
+        self.client.disconnect()
+        if self.network_loop is not None:
+            self.network_loop.detach(self)
+        else:
+            self.client.loop_stop()
+
+
+# Class: NetworkLoop
+# Description: Drives the network I/O of many sessions from a single thread with a selector, instead of one paho
+# network thread per connection. Sessions created with network_loop=<loop> register their sockets here through paho's
+# external event loop callbacks; the loop also sends the keepalives and reconnects dropped connections with exponential
+# backoff. Message callbacks of all its sessions run on the loop thread, so they must not block.
+
+class NetworkLoop:
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.calls = collections.deque()
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.closed = False
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+        self.thread = threading.Thread(target=self._run, name='comdex-network-loop', daemon=True)
+        self.thread.start()
+
+    def _call_soon(self, function):
+        # selector changes are made on the loop thread only
+        self.calls.append(function)
+        try:
+            self.wakeup_w.send(b'x')
+        except (BlockingIOError, OSError):
+            pass
+
+    # Function: attach
+    # Description: Hands the network I/O of a session to the loop (called by Session.connect before connecting).
+    # Returns: None
+    def attach(self, session):
+        client = session.client
+        client.on_socket_open = lambda c, userdata, sock: self._call_soon(lambda: self._register(session, sock))
+        client.on_socket_close = lambda c, userdata, sock: self._call_soon(lambda: self._unregister(sock))
+        client.on_socket_register_write = lambda c, userdata, sock: self._call_soon(lambda: self._watch_write(sock, True))
+        client.on_socket_unregister_write = lambda c, userdata, sock: self._call_soon(lambda: self._watch_write(sock, False))
+        with self.lock:
+            self.sessions.setdefault(session, {'retry_at': None, 'delay': session.min_backoff, 'reconnecting': False})
+
+    # Function: detach
+    # Description: Stops driving a session (called by Session.close).
+    # Returns: None
+    def detach(self, session):
+        with self.lock:
+            self.sessions.pop(session, None)
+
+    def _register(self, session, sock):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if session.client.want_write() else 0)
+        try:
+            self.selector.register(sock, events, session)
+        except KeyError:
+            self.selector.modify(sock, events, session)
+        except ValueError:
+            pass
+
+    def _unregister(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _watch_write(self, sock, enabled):
+        try:
+            key = self.selector.get_key(sock)
+        except (KeyError, ValueError):
+            return
+        try:
+            self.selector.modify(sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if enabled else 0), key.data)
+        except OSError:
+            # closed before the queued change ran, its unregistration follows
+            self._unregister(sock)
+
+    def _run(self):
+        next_misc = 0.0
+        while not self.closed:
+            for key, mask in self.selector.select(timeout=1.0):
+                if key.data is None:
+                    try:
+                        while self.wakeup_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                client = key.data.client
+                if mask & selectors.EVENT_READ:
+                    client.loop_read(max_packets=100)
+                if mask & selectors.EVENT_WRITE:
+                    client.loop_write()
+            while self.calls:
+                self.calls.popleft()()
+            now = time.monotonic()
+            if now >= next_misc:
+                next_misc = now + 1.0
+                self._maintain(now)
+
+    def _maintain(self, now):
+        with self.lock:
+            sessions = list(self.sessions.items())
+        for session, state in sessions:
+            if session.client.socket() is not None:
+                session.client.loop_misc()
+                if session.connected.is_set():
+                    state['delay'] = session.min_backoff
+                continue
+            if session.closed or not session.started or state['reconnecting']:
+                continue
+            if state['retry_at'] is None:
+                state['retry_at'] = now + state['delay']
+            elif now >= state['retry_at']:
+                state['reconnecting'] = True
+                threading.Thread(target=self._reconnect, args=(session, state), daemon=True).start()
+
+    def _reconnect(self, session, state):
+        # the TCP connect blocks, so it runs off the loop thread
+        try:
+            session.client.reconnect()
+        except (OSError, ValueError):
+            state['delay'] = min(state['delay'] * 2, session.max_backoff)
+        state['retry_at'] = None
+        state['reconnecting'] = False
+
+    def close(self):
+        self.closed = True
+        self._call_soon(lambda: None)
+
+
+# Class: PublishWindow
+# Description: Pipelines a stream of publishes over a session. Up to `size` QoS 1/2 publishes are left unacknowledged at a
+# time, so throughput is bound by the broker's acknowledgement rate instead of one round trip per message, while memory
+# stays bounded: once the window is full the oldest publish is waited for before the next one is queued.
+# Parameters:
+#   - session: The Session to publish over.
+#   - size (optional): Maximum number of unacknowledged publishes (default: default_inflight_window).
+#   - timeout (optional): Seconds to wait for a single acknowledgement before giving up.
+
+class PublishWindow:
+
+    def __init__(self, session, size=default_inflight_window, timeout=default_collect_timeout):
+        self.session = session
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.pending = collections.deque()
+        self.published = 0
+        self.failed = 0
+        # paho queues whatever exceeds its own in-flight limit (20 by default), raise it to the window
+        with session.lock:
+            if session.max_inflight < self.size:
+                session.max_inflight = self.size
+                session.client.max_inflight_messages_set(self.size)
+
+    # Function: publish
+    # Description: Queues a publish, waiting for the oldest unacknowledged one when the window is full.
+    # Returns: None
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        info = self.session.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and info.rc != mqtt.MQTT_ERR_NO_CONN:
+            self.failed += 1
+            return
+        self.pending.append(info)
+        while len(self.pending) >= self.size:
+            self._wait_oldest()
+
+    def _wait_oldest(self):
+        info = self.pending.popleft()
+        try:
+            info.wait_for_publish(self.timeout)
+        except (RuntimeError, ValueError):
+            pass
+        if info.is_published():
+            self.published += 1
+        else:
+            self.failed += 1
+
+    # Function: flush
+    # Description: Waits until every queued publish is acknowledged (QoS 1/2) or written to the socket (QoS 0).
+    # Returns: The number of publishes that could not be delivered.
+    def flush(self):
+        while self.pending:
+            self._wait_oldest()
+        return self.failed
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+# Function: get_session
+# Description: Returns the pooled, connected session for a (broker, port, credentials) combination, creating it on first use.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - username (optional): MQTT username.
+#   - password (optional): MQTT password.
+# Returns: A connected Session. Raises ConnectionError if the broker cannot be reached.
+
+def get_session(broker, port, username=None, password=None):
+    key = (broker, int(port), username, password)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = Session(broker, port, username, password)
+    # connect outside of the pool lock so that sessions to different brokers are opened in parallel
+    with session.connect_lock:
+        if not session.started:
+            try:
+                session.connect()
+            except ConnectionError:
+                with _sessions_lock:
+                    _sessions.pop(key, None)
+                raise
+    return session
+
+
+# Function: close_sessions
+# Description: Disconnects and forgets every pooled session.
+# Returns: None
+
+def close_sessions():
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+def _forget_sessions_after_fork():
+    # a forked child must not share the parent's sockets and network threads
+    global _sessions_lock
+    _sessions_lock = threading.Lock()
+    _sessions.clear()
+
+
+atexit.register(close_sessions)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_sessions_after_fork)
@@ -0,0 +1,127 @@
+# ComDeX Subscription Multiplexer
+
+# Advertisement-driven subscriptions follow every context provider that
+# advertises matching data. Instead of a process (with its own MQTT client)
+# per provider, one multiplexer owns the connections to all providers of a
+# subscriber, drives them from a single network loop thread
+# (mqttsession.NetworkLoop) and routes incoming attribute messages to the
+# subscription handlers. Following a new provider is a subscribe call on a
+# shared connection, withdrawing one is an unsubscribe call.
+
+import threading
+import mqttsession
+
+
+# Class: SubscriptionMultiplexer
+# Description: Routes the subscriptions of many consumers over one connection per provider broker, all driven by one
+# network loop. A route is a named set of topic filters on one provider (e.g. one advertisement of one subscription);
+# connections are opened with the first route to a provider and closed with the last one.
+# Parameters:
+#   - network_loop (optional): The NetworkLoop driving the connections (default: a new one).
+
+class SubscriptionMultiplexer:
+
+    def __init__(self, network_loop=None):
+        self.network_loop = network_loop or mqttsession.NetworkLoop()
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.session_locks = {}
+        self.routes = {}
+
+    def _session(self, key):
+        # one connect at a time per provider, without holding the multiplexer lock while connecting
+        with self.lock:
+            session_lock = self.session_locks.setdefault(key, threading.Lock())
+        with session_lock:
+            with self.lock:
+                session = self.sessions.get(key)
+            if session is None:
+                broker, port, username, password = key
+                session = mqttsession.Session(broker, port, username, password, network_loop=self.network_loop).connect()
+                with self.lock:
+                    self.sessions[key] = session
+            return session
+
+    # Function: add
+    # Description: Subscribes a route to topic filters of a provider broker.
+    # Parameters:
+    #   - route: A hashable name of the route, used to remove it.
+    #   - broker: The name or IP address of the provider broker.
+    #   - port: The port number of the provider broker.
+    #   - topics: List of topic filters.
+    #   - qos: The quality of service level of the subscriptions.
+    #   - callback: Function called with every matching message (on the network loop thread, it must not block).
+    #   - username / password (optional): MQTT credentials of the provider broker.
+    # Returns: True if the route was added, False if it already exists. Raises ConnectionError if the broker cannot be reached.
+    def add(self, route, broker, port, topics, qos, callback, username=None, password=None):
+        key = (broker, int(port), username, password)
+        with self.lock:
+            if route in self.routes:
+                return False
+            self.routes[route] = (key, [])
+        try:
+            session = self._session(key)
+        except ConnectionError:
+            with self.lock:
+                self.routes.pop(route, None)
+            raise
+        handlers = [session.subscribe(topic, qos, callback) for topic in topics]
+        with self.lock:
+            if route in self.routes:
+                self.routes[route] = (key, handlers)
+                return True
+        # removed while connecting
+        for handler in handlers:
+            session.unsubscribe(handler)
+        return False
+
+    # Function: remove
+    # Description: Unsubscribes a route, and closes its provider connection once no route uses it.
+    # Parameters:
+    #   - route: The name given to add.
+    # Returns: True if the route existed.
+    def remove(self, route):
+        with self.lock:
+            entry = self.routes.pop(route, None)
+            if entry is None:
+                return False
+            key, handlers = entry
+            session = self.sessions.get(key)
+            unused = not any(other_key == key for other_key, other_handlers in self.routes.values())
+            if unused:
+                self.sessions.pop(key, None)
+        if session is not None:
+            for handler in handlers:
+                session.unsubscribe(handler)
+            if unused:
+                session.close()
+        return True
+
+    # Function: stats
+    # Description: Number of provider connections and routes.
+    # Returns: A dictionary.
+    def stats(self):
+        with self.lock:
+            return {'connections': len(self.sessions), 'routes': len(self.routes)}
+
+    def close(self):
+        with self.lock:
+            routes = list(self.routes)
+        for route in routes:
+            self.remove(route)
+
+
+_multiplexer = None
+_multiplexer_lock = threading.Lock()
+
+
+# Function: get_multiplexer
+# Description: Returns the multiplexer shared by all the subscriptions of this process, creating it on first use.
+# Returns: A SubscriptionMultiplexer.
+
+def get_multiplexer():
+    global _multiplexer
+    with _multiplexer_lock:
+        if _multiplexer is None:
+            _multiplexer = SubscriptionMultiplexer()
+        return _multiplexer
@@ -0,0 +1,289 @@
+# ComDeX NGSI-LD Query Language
+
+# Parses an NGSI-LD `q` expression (ETSI GS CIM 009, clause 4.9) once into a
+# tree of predicate closures that are evaluated directly against the
+# attributes of a reassembled entity, instead of re-splitting the query for
+# every message and running the combined result through eval().
+#
+# Supported grammar:
+#   - logical operators ';' (AND) and '|' (OR), AND binding tighter than OR
+#   - parentheses for grouping
+#   - comparison operators ==, !=, >, >=, <, <=
+#   - value lists (a==1,2,3) and ranges (a==1..10, a!=1..10)
+#   - pattern operators ~= and !~= (regular expressions; an unquoted pattern
+#     keeps the ';', '|' and ')' inside its own groups, escapes and classes)
+#   - bare attribute terms, true when the attribute exists
+#   - dotted attribute paths (a.b targets the sub-attribute b of a) and
+#     bracketed paths into structured values (a[b][c])
+#   - values: numbers, "quoted strings", true/false, and unquoted tokens
+#     (dates, URIs, legacy unquoted strings)
+
+import re
+import operator
+import functools
+
+
+# Class: QuerySyntaxError
+# Description: Raised when a q expression does not follow the NGSI-LD query grammar.
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+_comparison_operators = ('!~=', '~=', '==', '!=', '>=', '<=', '>', '<')
+_missing = object()
+
+
+def _attribute_value(attribute):
+    # Properties carry a value, Relationships an object, LanguageProperties a languageMap
+    if isinstance(attribute, dict):
+        for member in ('value', 'object', 'languageMap'):
+            if member in attribute:
+                return attribute[member]
+    return attribute
+
+
+def _compile_path(path):
+    parts = re.findall(r'\[([^\]]*)\]|([^.\[\]]+)', path)
+    if not parts or not parts[0][1]:
+        raise QuerySyntaxError(f"Invalid attribute path: {path!r}")
+    attr_name = parts[0][1]
+    steps = [(bool(bracket), bracket or name) for bracket, name in parts[1:]]
+
+    def resolve(attributes):
+        current = attributes.get(attr_name, _missing)
+        if current is _missing:
+            return _missing
+        for is_member, name in steps:
+            if not is_member and isinstance(current, dict) and isinstance(current.get(name), dict):
+                # a.b: sub-attribute b of attribute a
+                current = current[name]
+                continue
+            value = _attribute_value(current)
+            if not isinstance(value, dict) or name not in value:
+                return _missing
+            current = value[name]
+        return _attribute_value(current)
+
+    return resolve
+
+
+def _parse_scalar(token):
+    token = token.strip()
+    if len(token) >= 2 and token[0] == '"' and token[-1] == '"':
+        return token[1:-1].replace('\\"', '"')
+    if token == 'true':
+        return True
+    if token == 'false':
+        return False
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token)
+    except ValueError:
+        return token
+
+
+def _split_outside_quotes(text, separator):
+    parts, current, quoted, i = [], [], False, 0
+    while i < len(text):
+        if text[i] == '"' and (i == 0 or text[i - 1] != '\\'):
+            quoted = not quoted
+        if not quoted and text.startswith(separator, i):
+            parts.append(''.join(current))
+            current = []
+            i += len(separator)
+            continue
+        current.append(text[i])
+        i += 1
+    parts.append(''.join(current))
+    return parts
+
+
+_operator_functions = {'==': operator.eq, '>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+
+def _compare(left, compare, right):
+    try:
+        return compare(left, right)
+    except TypeError:
+        # e.g. a number compared with a string never matches
+        return False
+
+
+def _coerce(value, operand):
+    # numbers stored as strings (or the reverse) still compare numerically
+    if isinstance(operand, (int, float)) and not isinstance(operand, bool) and isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    if isinstance(operand, str) and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+
+def _compile_term(path, op, raw_value):
+    resolve = _compile_path(path)
+
+    if op is None:
+        return lambda attributes: resolve(attributes) is not _missing
+
+    if op in ('~=', '!~='):
+        try:
+            pattern = re.compile(_parse_scalar(raw_value) if raw_value.strip().startswith('"') else raw_value.strip())
+        except re.error as e:
+            raise QuerySyntaxError(f"Invalid pattern in {path}{op}{raw_value}: {e}")
+        negate = op == '!~='
+
+        def match_pattern(attributes):
+            value = resolve(attributes)
+            if value is _missing:
+                return False
+            values = value if isinstance(value, list) else [value]
+            found = any(isinstance(v, str) and pattern.search(v) for v in values)
+            return found != negate
+
+        return match_pattern
+
+    alternatives = _split_outside_quotes(raw_value, ',')
+    range_bounds = _split_outside_quotes(raw_value, '..') if len(alternatives) == 1 else [raw_value]
+    negate = op == '!='
+    if negate:
+        op = '=='
+
+    if op == '==' and len(range_bounds) == 2:
+        low, high = _parse_scalar(range_bounds[0]), _parse_scalar(range_bounds[1])
+
+        def test_one(value):
+            return _compare(_coerce(value, low), operator.ge, low) and _compare(_coerce(value, high), operator.le, high)
+    elif op == '==' and len(alternatives) > 1:
+        options = [_parse_scalar(alternative) for alternative in alternatives]
+
+        def test_one(value):
+            return any(_compare(_coerce(value, option), operator.eq, option) for option in options)
+    else:
+        if len(alternatives) > 1 or len(range_bounds) > 1:
+            raise QuerySyntaxError(f"Value lists and ranges are only allowed with == and !=: {path}{op}{raw_value}")
+        operand = _parse_scalar(raw_value)
+        compare = _operator_functions[op]
+
+        def test_one(value):
+            return _compare(_coerce(value, operand), compare, operand)
+
+    def match(attributes):
+        value = resolve(attributes)
+        if value is _missing:
+            return False
+        if isinstance(value, list):
+            found = any(test_one(v) for v in value)
+        else:
+            found = test_one(value)
+        return found != negate
+
+    return match
+
+
+# nested closures short-circuit without the generator overhead of all()/any()
+def _both(left, right):
+    return lambda attributes: left(attributes) and right(attributes)
+
+
+def _either(left, right):
+    return lambda attributes: left(attributes) or right(attributes)
+
+
+class _Parser:
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def peek(self):
+        while self.pos < len(self.text) and self.text[self.pos] == ' ':
+            self.pos += 1
+        return self.text[self.pos] if self.pos < len(self.text) else ''
+
+    def parse(self):
+        predicate = self.parse_or()
+        if self.peek() != '':
+            raise QuerySyntaxError(f"Unexpected {self.text[self.pos:]!r} in query {self.text!r}")
+        return predicate
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == '|':
+            self.pos += 1
+            terms.append(self.parse_and())
+        return functools.reduce(_either, terms)
+
+    def parse_and(self):
+        terms = [self.parse_factor()]
+        while self.peek() == ';':
+            self.pos += 1
+            terms.append(self.parse_factor())
+        return functools.reduce(_both, terms)
+
+    def parse_factor(self):
+        if self.peek() == '(':
+            self.pos += 1
+            predicate = self.parse_or()
+            if self.peek() != ')':
+                raise QuerySyntaxError(f"Missing ')' in query {self.text!r}")
+            self.pos += 1
+            return predicate
+        return self.parse_term()
+
+    def parse_term(self):
+        start = self.pos
+        while self.pos < len(self.text) and self.text[self.pos] not in '=!<>~;|()':
+            self.pos += 1
+        path = self.text[start:self.pos].strip()
+        if not path:
+            raise QuerySyntaxError(f"Missing attribute at position {start} of query {self.text!r}")
+        op = next((candidate for candidate in _comparison_operators if self.text.startswith(candidate, self.pos)), None)
+        if op is None:
+            return _compile_term(path, None, None)
+        self.pos += len(op)
+        # an unquoted pattern runs to the next ';', '|' or ')' outside its own groups, escapes and character classes
+        pattern = op in ('~=', '!~=')
+        start, quoted, depth, in_class = self.pos, False, 0, False
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char == '"' and self.text[self.pos - 1] != '\\':
+                quoted = not quoted
+            elif quoted:
+                pass
+            elif pattern and char == '\\':
+                self.pos += 1
+            elif pattern and in_class:
+                in_class = char != ']'
+            elif pattern and char == '[':
+                in_class = True
+            elif pattern and char == '(':
+                depth += 1
+            elif pattern and char == ')' and depth:
+                depth -= 1
+            elif char in ';|)' and not depth:
+                break
+            self.pos += 1
+        raw_value = self.text[start:self.pos]
+        if not raw_value.strip():
+            raise QuerySyntaxError(f"Missing value after {path}{op} in query {self.text!r}")
+        return _compile_term(path, op, raw_value)
+
+
+# Function: compile_query
+# Description: Compiles an NGSI-LD q expression into a predicate. Compiled queries are cached, so a GET parses its
+# query once no matter how many entities it filters.
+# Parameters:
+#   - query: The q expression, e.g. 'brandName=="Mercedes";(speed>50|isParked==true)'.
+# Returns:
+#   - A function taking the attributes of an entity ({attribute name: NGSI-LD attribute}) and returning True when the entity matches.
+#     Raises QuerySyntaxError for malformed queries.
+
+@functools.lru_cache(maxsize=256)
+def compile_query(query):
+    return _Parser(query).parse()
@@ -0,0 +1,167 @@
+# ComDeX Subscription Notifications
+
+# A subscription receives one MQTT message per attribute (and per temporal
+# topic) of every updated entity. The dispatcher below turns them into NGSI-LD
+# notifications:
+#
+#   - the attribute messages of an entity are coalesced for a short window
+#     (--coalesce_window, 50 ms by default), so an update of a 30-attribute
+#     entity becomes one entity in one notification instead of 30 documents;
+#   - 'throttling' (seconds) is the minimum time between two notifications of
+#     the subscription, updates arriving meanwhile are merged into the next one;
+#   - 'timeInterval' (seconds) replaces change notifications with a periodic
+#     notification of the last known state of every entity seen;
+#   - notifications are handed to a sink (sinks.py) from the dispatcher thread,
+#     never from the MQTT network loop.
+
+import time
+import uuid
+import datetime
+import threading
+
+#seconds the attribute messages of an entity are coalesced
+default_coalesce_window = 0.05
+
+
+def _entity_key(topic):
+    # {area}/entities/{context}/{type}/{node}/{id}/{attr}
+    return topic.rsplit('/', 1)[0]
+
+
+# Class: NotificationDispatcher
+# Description: Coalesces the attribute messages of a subscription per entity and delivers them as NGSI-LD notifications.
+# Parameters:
+#   - sink: Sink receiving the notifications (see sinks.py).
+#   - subscription_id: Id of the subscription, reported in every notification.
+#   - build_entity: Function building an entity from (its attribute messages, context_given), None if it does not match.
+#   - window (optional): Coalescing window in seconds (default: default_coalesce_window).
+#   - throttling (optional): Minimum seconds between two notifications (default: 0).
+#   - time_interval (optional): Seconds between periodic notifications, 0 for change notifications (default: 0).
+
+class NotificationDispatcher:
+
+    def __init__(self, sink, subscription_id, build_entity, window=None, throttling=0, time_interval=0):
+        self.sink = sink
+        self.subscription_id = subscription_id
+        self.build_entity = build_entity
+        self.window = default_coalesce_window if window is None else window
+        self.throttling = throttling or 0
+        self.time_interval = time_interval or 0
+        self.condition = threading.Condition()
+        # entity key -> [first message time, context_given, {attribute topic: message}]
+        self.pending = {}
+        self.latest = {}
+        self.last_sent = 0.0
+        self.started = time.monotonic()
+        self.closed = False
+        self.received = 0
+        self.notifications = 0
+        self.entities = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # Function: handler
+    # Description: Returns the MQTT message callback of one context provider of the subscription.
+    # Parameters:
+    #   - context_given: Context of the provider topics, as passed to recreate_single_entity.
+    # Returns: A function taking a received message.
+    def handler(self, context_given):
+
+        def on_message(msg):
+            if not msg.payload:
+                print("\n Message on topic:" + msg.topic + ", was deleted")
+                return
+            if msg.topic.endswith("_CreatedAt") or msg.topic.endswith("_modifiedAt"):
+                # temporal topics are not notified
+                return
+            key = _entity_key(msg.topic)
+            with self.condition:
+                self.received += 1
+                entries = self.latest if self.time_interval else self.pending
+                entry = entries.get(key)
+                if entry is None:
+                    entry = entries[key] = [time.monotonic(), context_given, {}]
+                entry[2][msg.topic] = msg
+                if not self.time_interval and len(self.pending) == 1 and len(entry[2]) == 1:
+                    self.condition.notify()
+
+        return on_message
+
+    def _due(self, now):
+        # returns (time of the next notification or None, keys to notify at that time)
+        if self.time_interval:
+            due = max(self.last_sent, self.started) + self.time_interval
+            return due, list(self.latest)
+        if not self.pending:
+            return None, []
+        first = min(entry[0] for entry in self.pending.values())
+        due = max(first + self.window, self.last_sent + self.throttling)
+        return due, [key for key, entry in self.pending.items() if entry[0] + self.window <= max(now, due)]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    due, keys = self._due(now)
+                    if self.closed:
+                        # deliver what was received before the subscription ended
+                        keys = [] if self.time_interval else list(self.pending)
+                        break
+                    if due is not None and due <= now and keys:
+                        break
+                    if due is not None and due <= now and self.time_interval:
+                        self.last_sent = now
+                        continue
+                    self.condition.wait(None if due is None else max(0.001, due - now))
+                if self.time_interval:
+                    batch = [(entry[1], list(entry[2].values())) for entry in (self.latest[key] for key in keys)]
+                else:
+                    batch = [(entry[1], list(entry[2].values())) for entry in (self.pending.pop(key) for key in keys)]
+                self.last_sent = now
+                closed = self.closed
+            if batch:
+                self._notify(batch)
+            if closed:
+                return
+
+    def _notify(self, batch):
+        data = []
+        for context_given, messages in batch:
+            try:
+                entity = self.build_entity(messages, context_given)
+            except ValueError as e:
+                print(f"Skipping a notification of {messages[0].topic}: {e}")
+                continue
+            if entity is not None:
+                data.append(entity)
+        if not data:
+            return
+        notification = {'id': f"urn:ngsi-ld:Notification:{uuid.uuid4()}", 'type': 'Notification',
+                        'subscriptionId': self.subscription_id,
+                        'notifiedAt': datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z'),
+                        'data': data}
+        try:
+            self.sink.emit(notification)
+        except Exception as e:
+            print(f"Notification sink of {self.subscription_id} failed: {e}")
+            return
+        self.notifications += 1
+        self.entities += len(data)
+
+    # Function: stats
+    # Description: Returns the numbers of attribute messages received, notifications and entities delivered.
+    def stats(self):
+        with self.condition:
+            return {'received': self.received, 'notifications': self.notifications, 'entities': self.entities,
+                    'pending': len(self.pending)}
+
+    # Function: close
+    # Description: Delivers the pending updates, stops the dispatcher and closes its sink.
+    # Returns: None
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.sink.close()
@@ -0,0 +1,390 @@
+# ComDeX -> Orion-LD Persistence Bridge
+
+# Follows the ComDeX advertisements of the configured areas and types (like a
+# subscription, over the subscription multiplexer) and writes every entity
+# update into Orion-LD with batch upserts
+# (/ngsi-ld/v1/entityOperations/upsert?options=update), so Orion-LD and
+# Mintaka (TimescaleDB) keep the history of what flows through ComDeX.
+#
+#   - updates are buffered and flushed when --batch entities are buffered or
+#     the oldest one is --flush_interval seconds old; queued updates of an
+#     entity touching different attributes are merged into one;
+#   - upserts are sent by --connections sender threads, each over its own
+#     keep-alive connection; entities are assigned to senders by id, so the
+#     updates of an entity are written in order;
+#   - failed upserts (connection errors, 429, 5xx) are retried with backoff,
+#     ahead of newer updates, from a bounded queue: beyond --retry_capacity
+#     queued entities the oldest batches are dropped and counted.
+#
+#   python3 orionbridge.py -b localhost -p 1026 --orion http://orion-host:1026 --types Turbine,Pump --areas plant1
+
+import sys
+import json
+import time
+import zlib
+import getopt
+import threading
+import collections
+import http.client
+import urllib.parse
+import codec
+from actionhandler import subscribe_for_advertisement_notification, notification_entity
+from notifications import NotificationDispatcher
+
+upsert_path = '/ngsi-ld/v1/entityOperations/upsert?options=update'
+default_batch = 500
+default_flush_interval = 0.5
+default_connections = 4
+default_retry_capacity = 50000
+default_max_retries = 8
+default_timeout = 10
+retryable_statuses = (408, 429, 500, 502, 503, 504)
+entity_keys = ('id', 'type', '@context')
+
+
+class _Sender:
+
+    def __init__(self, writer, index):
+        self.writer = writer
+        self.index = index
+        self.chunks = collections.deque()
+        self.queued = 0
+        self.not_before = 0.0
+        self.attempts = 0
+        self.connection = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def add(self, entity):
+        # called with the writer condition held; an update of an entity already in the last batch is merged into it
+        # when their attributes differ, otherwise it starts a new batch, so every value is written and in order
+        if self.chunks and entity['id'] in self.chunks[-1][1]:
+            queued = self.chunks[-1][0][self.chunks[-1][1][entity['id']]]
+            if not any(name in queued for name in entity if name not in entity_keys):
+                queued.update(entity)
+                self.writer.merged += 1
+                return
+        if not self.chunks or len(self.chunks[-1][0]) >= self.writer.batch or entity['id'] in self.chunks[-1][1]:
+            self.chunks.append(([], {}))
+        self.chunks[-1][1][entity['id']] = len(self.chunks[-1][0])
+        self.chunks[-1][0].append(entity)
+        self.queued += 1
+
+    def _run(self):
+        writer = self.writer
+        while True:
+            with writer.condition:
+                while True:
+                    now = time.monotonic()
+                    if self.chunks and now >= self.not_before:
+                        break
+                    if writer.closing and (not self.chunks or now >= writer.close_deadline):
+                        self._close()
+                        return
+                    writer.condition.wait(max(0.001, self.not_before - now) if self.chunks else None)
+                entities, ids = self.chunks.popleft()
+                self.queued -= len(entities)
+            outcome = self._post(entities)
+            with writer.condition:
+                if outcome == 'retry' and self.attempts < writer.max_retries and not writer.closing:
+                    # retried ahead of newer updates, after a backoff
+                    self.attempts += 1
+                    self.not_before = time.monotonic() + min(30, 0.5 * 2 ** (self.attempts - 1))
+                    self.chunks.appendleft((entities, ids))
+                    self.queued += len(entities)
+                    writer.retried += len(entities)
+                else:
+                    self.attempts = 0
+                    if outcome == 'retry':
+                        writer.dropped += len(entities)
+                writer.condition.notify_all()
+
+    def _post(self, entities):
+        writer = self.writer
+        body = json.dumps(entities, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        try:
+            if self.connection is None:
+                self.connection = writer.connection_class(writer.url.hostname, writer.url.port, timeout=writer.timeout)
+            self.connection.request('POST', writer.path, body=body, headers=writer.headers)
+            response = self.connection.getresponse()
+            answer = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self._close()
+            with writer.condition:
+                writer.last_error = str(e)
+            return 'retry'
+        with writer.condition:
+            writer.requests += 1
+            if response.status in retryable_statuses:
+                writer.last_error = f"HTTP {response.status} {response.reason}"
+                return 'retry'
+            if response.status == 207:
+                # partial success: the rejected entities are reported, they are data errors and are not retried
+                try:
+                    errors = len(json.loads(answer).get('errors', []))
+                except (ValueError, AttributeError):
+                    errors = 0
+                writer.upserted += len(entities) - errors
+                writer.rejected += errors
+            elif response.status < 300:
+                writer.upserted += len(entities)
+            else:
+                writer.rejected += len(entities)
+                writer.last_error = f"HTTP {response.status} {answer[:200].decode('utf-8', 'replace')}"
+        return 'done'
+
+    def _close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+# Class: OrionUpsertWriter
+# Description: Sink (see sinks.py) writing the entities of notifications into Orion-LD with batch upserts, flushed by
+# size or age, sent over a pool of keep-alive connections and retried from a bounded queue.
+# Parameters:
+#   - base_url: The Orion-LD URL, e.g. http://localhost:1026.
+#   - tenant (optional): NGSILD-Tenant of the entities.
+#   - batch (optional): Maximum number of entities per upsert, also the size that triggers a flush (default: 500).
+#   - flush_interval (optional): Maximum age in seconds of a buffered update (default: 0.5).
+#   - connections (optional): Number of sender threads and connections (default: 4).
+#   - retry_capacity (optional): Maximum number of entities queued for (re)sending (default: 50000).
+#   - max_retries (optional): Attempts of a failing batch before it is dropped (default: 8).
+#   - timeout (optional): Socket timeout of an upsert in seconds (default: 10).
+
+class OrionUpsertWriter:
+
+    def __init__(self, base_url, tenant=None, batch=default_batch, flush_interval=default_flush_interval,
+                 connections=default_connections, retry_capacity=default_retry_capacity, max_retries=default_max_retries,
+                 timeout=default_timeout):
+        self.url = urllib.parse.urlsplit(base_url)
+        if self.url.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported Orion-LD URL {base_url}")
+        self.connection_class = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+        self.path = self.url.path.rstrip('/') + upsert_path
+        self.headers = {'Content-Type': 'application/ld+json'}
+        if tenant:
+            self.headers['NGSILD-Tenant'] = tenant
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.retry_capacity = retry_capacity
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.buffer = []
+        self.buffered_since = None
+        self.closing = False
+        self.close_deadline = None
+        self.received = self.merged = self.upserted = self.rejected = self.retried = self.dropped = self.requests = 0
+        self.last_error = None
+        self.senders = [_Sender(self, i) for i in range(max(1, connections))]
+        for sender in self.senders:
+            sender.thread.start()
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def emit(self, notification):
+        entities = [_persistable(entity) for entity in notification.get('data', [])]
+        with self.condition:
+            if not self.buffer:
+                self.buffered_since = time.monotonic()
+            self.buffer.extend(entities)
+            self.received += len(entities)
+            if len(self.buffer) >= self.batch:
+                self.condition.notify_all()
+
+    def set_count(self, count):
+        pass
+
+    def _flush_loop(self):
+        with self.condition:
+            while True:
+                while not self.closing and (not self.buffer or (len(self.buffer) < self.batch and
+                                                                time.monotonic() - self.buffered_since < self.flush_interval)):
+                    self.condition.wait(None if not self.buffer else max(0.001, self.buffered_since + self.flush_interval - time.monotonic()))
+                buffer, self.buffer = self.buffer, []
+                for entity in buffer:
+                    self.senders[zlib.crc32(entity['id'].encode('utf-8')) % len(self.senders)].add(entity)
+                self._bound()
+                self.condition.notify_all()
+                if self.closing:
+                    return
+
+    def _bound(self):
+        # the oldest queued batches are dropped once the queue is over capacity
+        while sum(sender.queued for sender in self.senders) > self.retry_capacity:
+            sender = max(self.senders, key=lambda s: s.queued)
+            entities, ids = sender.chunks.popleft()
+            sender.queued -= len(entities)
+            self.dropped += len(entities)
+
+    # Function: stats
+    # Description: Returns the counters of the writer: entities received, merged into a queued update of the same entity,
+    # upserted, rejected by Orion-LD, retried and dropped, upsert requests sent, entities buffered or queued, and the last error.
+    def stats(self):
+        with self.condition:
+            return {'received': self.received, 'merged': self.merged, 'upserted': self.upserted, 'rejected': self.rejected, 'retried': self.retried,
+                    'dropped': self.dropped, 'requests': self.requests,
+                    'queued': len(self.buffer) + sum(sender.queued for sender in self.senders), 'last_error': self.last_error}
+
+    # Function: close
+    # Description: Flushes the buffer and waits for the queued upserts to be sent.
+    # Parameters:
+    #   - timeout (optional): Maximum seconds to wait for the queue to drain (default: 30).
+    # Returns: None
+    def close(self, timeout=30):
+        with self.condition:
+            self.closing = True
+            self.close_deadline = time.monotonic() + timeout
+            self.condition.notify_all()
+        self.flusher.join()
+        for sender in self.senders:
+            sender.thread.join()
+
+
+def _persistable(entity):
+    # the ComDeX names of the temporal values are not NGSI-LD sub-attributes
+    temporal = set(codec.temporal_names.values())
+    return {name: ({k: v for k, v in value.items() if k not in temporal} if isinstance(value, dict) else value)
+            for name, value in entity.items()}
+
+
+# Function: run_bridge
+# Description: Follows the ComDeX advertisements of the given areas and types and writes the entity updates into Orion-LD
+# until the bridge expires (or is interrupted).
+# Parameters:
+#   - broker: The name or IP address of the local ComDeX broker.
+#   - port: The port number of the broker.
+#   - writer: The OrionUpsertWriter.
+#   - areas (optional): List of areas (default: ['+'], every area).
+#   - types (optional): List of entity types (default: ['+'], every type).
+#   - HLink (optional): Context of the entities (default: any context).
+#   - qos (optional): QoS of the subscriptions (default: 1).
+#   - window (optional): Seconds the attribute messages of an entity are coalesced (default: notifications.default_coalesce_window).
+#   - expires (optional): Seconds the bridge runs (default: None, until interrupted).
+#   - stats_interval (optional): Seconds between two statistics lines on stdout (default: 10, 0 disables them).
+# Returns: The final statistics of the writer.
+
+def run_bridge(broker, port, writer, areas=None, types=None, HLink='', qos=1, window=None, expires=None, username=None,
+               password=None, stats_interval=10):
+    context = HLink.replace('/', '§') if HLink else '+'
+    check_top = [f"provider/+/+/{area}/{context}/{typee}" for area in (areas or ['+']) for typee in (types or ['+'])]
+    dispatcher = NotificationDispatcher(writer, 'urn:ngsi-ld:Subscription:comdex-orion-bridge', notification_entity, window)
+    stop = threading.Event()
+
+    def report():
+        while not stop.wait(stats_interval):
+            print(json.dumps(dict(writer.stats(), **{'notifications': dispatcher.stats()['notifications']})))
+
+    if stats_interval:
+        threading.Thread(target=report, daemon=True).start()
+    try:
+        subscribe_for_advertisement_notification(broker, port, check_top, expires, qos, True, False, False, '', '',
+                                                 username=username, password=password, dispatcher=dispatcher)
+    finally:
+        stop.set()
+        dispatcher.close()
+    return writer.stats()
+
+
+def usage():
+    print("\nUsage:")
+    print("python3 orionbridge.py [options]\n")
+    print("Options:")
+    print("-h, --help                Show this help message and exit")
+    print("-b, --broker_address      Specify the address of the MQTT broker of the ComDeX node")
+    print("-p, --port                Specify the port number of the MQTT broker of the ComDeX node")
+    print("-N, --username            MQTT username")
+    print("-S, --password            MQTT password")
+    print("-H, --HLink               Context of the persisted entities (default: any context)")
+    print("--orion                   Orion-LD URL (default: http://localhost:1026)")
+    print("--tenant                  NGSILD-Tenant of the persisted entities")
+    print("--areas                   Comma separated areas to persist (default: all)")
+    print("--types                   Comma separated entity types to persist (default: all)")
+    print("--batch                   Entities per upsert, and buffer size that triggers a flush (default: 500)")
+    print("--flush_interval          Maximum seconds an update stays buffered (default: 0.5)")
+    print("--connections             Parallel upsert connections (default: 4)")
+    print("--retry_capacity          Maximum entities queued for (re)sending before the oldest are dropped (default: 50000)")
+    print("--coalesce_window         Seconds the attribute updates of an entity are merged (default: 0.05, 0 keeps every value)")
+    print("--expires                 Seconds the bridge runs (default: until interrupted)")
+    print("--stats_interval          Seconds between two statistics lines (default: 10, 0 disables them)")
+    print("\nExample:")
+    print("python3 orionbridge.py -b localhost -p 1026 --orion http://orion-host:1026 --types Turbine --areas plant1\n")
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hb:p:N:S:H:", ["help", "broker_address=", "port=", "username=", "password=", "HLink=",
+                                                        "orion=", "tenant=", "areas=", "types=", "batch=", "flush_interval=",
+                                                        "connections=", "retry_capacity=", "coalesce_window=", "expires=",
+                                                        "stats_interval="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    broker = 'localhost'
+    port = 1026
+    username = None
+    password = None
+    HLink = ''
+    orion = 'http://localhost:1026'
+    tenant = None
+    areas = None
+    types = None
+    batch = default_batch
+    flush_interval = default_flush_interval
+    connections = default_connections
+    retry_capacity = default_retry_capacity
+    window = None
+    expires = None
+    stats_interval = 10
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage(); sys.exit()
+        elif opt in ("-b", "--broker_address"):
+            broker = arg
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-N", "--username"):
+            username = arg
+        elif opt in ("-S", "--password"):
+            password = arg
+        elif opt in ("-H", "--HLink"):
+            HLink = arg
+        elif opt == "--orion":
+            orion = arg
+        elif opt == "--tenant":
+            tenant = arg
+        elif opt == "--areas":
+            areas = arg.split(',')
+        elif opt == "--types":
+            types = arg.split(',')
+        elif opt == "--batch":
+            batch = int(arg)
+        elif opt == "--flush_interval":
+            flush_interval = float(arg)
+        elif opt == "--connections":
+            connections = int(arg)
+        elif opt == "--retry_capacity":
+            retry_capacity = int(arg)
+        elif opt == "--coalesce_window":
+            window = float(arg)
+        elif opt == "--expires":
+            expires = float(arg)
+        elif opt == "--stats_interval":
+            stats_interval = float(arg)
+
+    try:
+        writer = OrionUpsertWriter(orion, tenant, batch, flush_interval, connections, retry_capacity)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+    try:
+        stats = run_bridge(broker, port, writer, areas, types, HLink, 1, window, expires, username, password, stats_interval)
+    except ConnectionError as e:
+        print(f"Could not connect to the broker: {e}")
+        sys.exit(2)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,213 @@
+# ComDeX Parallel Reassembly
+
+# Rebuilding entities from a large retained snapshot is CPU bound: payload
+# decoding, the q filter and the geo predicates of every entity run in the
+# reassembling process, under one GIL. With --reassembly_workers the entities
+# of a snapshot (or of each batch of a streamed GET) are sharded by a hash of
+# their id across a pool of worker processes, which run the usual
+# recreate_multiple_entities on their shard. The payload bytes are copied once
+# into a shared memory block per batch; the workers only receive the topics
+# and the offsets of their messages, instead of pickled MQTTMessage objects.
+# The shards come back sorted by id and are merged, so the entities of a batch
+# are delivered in id order.
+#
+# The workers are started with forkserver (spawn where it is unavailable),
+# never fork: the pooled MQTT sessions run network threads. Batches smaller
+# than min_messages are reassembled in-process, where the round trip to the
+# pool would cost more than it saves.
+
+import os
+import zlib
+import heapq
+import threading
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import codec
+
+#worker processes (0: reassemble in-process)
+workers = 0
+#batches of fewer messages are reassembled in-process
+min_messages = 5000
+#entities a streamed GET hands to the pool at once
+batch_entities = 2000
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_Properties = collections.namedtuple('_Properties', ['ContentType'])
+_Message = collections.namedtuple('_Message', ['topic', 'payload', 'retain', 'properties'])
+
+
+# Function: configure
+# Description: Sets the number of worker processes.
+# Parameters:
+#   - value: A number of processes, 'auto' for one per CPU, or 0 to reassemble in-process.
+# Returns: True if the value is valid, False otherwise.
+
+def configure(value):
+    global workers
+    if value == 'auto':
+        workers = os.cpu_count() or 1
+        return True
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+    if count < 0:
+        print(f"Invalid number of reassembly workers: {value}")
+        return False
+    workers = count
+    return True
+
+
+def _init_worker():
+    global workers
+    # a worker reassembles its shards itself
+    workers = 0
+
+
+def _warm_up():
+    import actionhandler
+    return os.getpid()
+
+
+# Function: start
+# Description: Starts the worker processes, and has them import ComDeX, so the first large GET does not pay for it.
+# Returns: The pool, None if the reassembly runs in-process.
+
+def start():
+    global _pool
+    if workers <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker)
+            for future in [_pool.submit(_warm_up) for _ in range(workers)]:
+                future.result()
+    return _pool
+
+
+# Function: _reassemble_shard
+# Description: Runs in a worker: rebuilds the entities of one shard from the shared payload block.
+# Parameters:
+#   - name: Name of the shared memory block.
+#   - entries: List of (topic, offset, length, content_type) tuples, one per message.
+#   - options: The filter arguments of recreate_multiple_entities (query, topics, timee, georel, geometry, coordinates,
+#     geoproperty, context_given).
+# Returns: The entities that passed the filters, sorted by id.
+
+def _reassemble_shard(name, entries, options):
+    from actionhandler import recreate_multiple_entities
+    from sinks import ListSink
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        buffer = block.buf
+        messagez = [_Message(topic, bytes(buffer[offset:offset + length]), 1,
+                             None if content_type is None else _Properties(content_type))
+                    for topic, offset, length, content_type in entries]
+        del buffer
+    finally:
+        block.close()
+    entities = recreate_multiple_entities(messagez, options[0], options[1], options[2], float('inf'), *options[3:], sink=ListSink())
+    entities.sort(key=_entity_id)
+    return entities
+
+
+def _entity_id(entity):
+    return entity['id']
+
+
+# Class: Reassembly
+# Description: A batch of messages being reassembled by the pool (or already reassembled in-process).
+
+class Reassembly:
+
+    def __init__(self, futures=(), block=None, entities=None):
+        self.futures = list(futures)
+        self.block = block
+        self.entities = entities
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    # Function: result
+    # Description: Waits for the shards and merges them.
+    # Returns: The entities of the batch that passed the filters, in id order.
+    def result(self):
+        if self.entities is None:
+            try:
+                self.entities = list(heapq.merge(*[future.result() for future in self.futures], key=_entity_id))
+            finally:
+                self._release()
+        return self.entities
+
+    # Function: cancel
+    # Description: Drops the batch, e.g. once the limit of the GET was reached.
+    # Returns: None
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+        for future in self.futures:
+            if not future.cancelled():
+                future.exception()
+        self._release()
+
+    def _release(self):
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+
+# Function: submit
+# Description: Hands a batch of messages to the pool, sharded by entity id. Small batches (or all of them without
+# workers) are reassembled right away in the calling process.
+# Parameters:
+#   - messagez: The retained attribute messages.
+#   - query, topics, timee, georel, geometry, coordinates, geoproperty, context_given: As in recreate_multiple_entities.
+# Returns: A Reassembly.
+
+def submit(messagez, query='', topics='', timee='', georel='', geometry='', coordinates='', geoproperty='', context_given=''):
+    options = (query, topics, timee, georel, geometry, coordinates, geoproperty, context_given)
+    if workers <= 0 or len(messagez) < min_messages:
+        from actionhandler import recreate_multiple_entities
+        from sinks import ListSink
+        entities = recreate_multiple_entities(messagez, query, topics, timee, float('inf'), georel, geometry, coordinates,
+                                              geoproperty, context_given, sink=ListSink())
+        entities.sort(key=_entity_id)
+        return Reassembly(entities=entities)
+    pool = start()
+    shards = [[] for _ in range(workers)]
+    payloads = []
+    offset = 0
+    for msg in messagez:
+        payload = msg.payload
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        entity_id = msg.topic.split('/')[-2]
+        shards[zlib.crc32(entity_id.encode('utf-8')) % workers].append((msg.topic, offset, len(payload), codec.message_content_type(msg)))
+        payloads.append(payload)
+        offset += len(payload)
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    try:
+        block.buf[:offset] = b''.join(payloads)
+        del payloads
+        futures = [pool.submit(_reassemble_shard, block.name, entries, options) for entries in shards if entries]
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    return Reassembly(futures, block)
+
+
+# Function: recreate
+# Description: Reassembles a snapshot with the pool and waits for it.
+# Parameters: As in submit.
+# Returns: The entities that passed the filters, in id order.
+
+def recreate(messagez, *args, **kwargs):
+    return submit(messagez, *args, **kwargs).result()
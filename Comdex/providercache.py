@@ -0,0 +1,281 @@
+# ComDeX Context Provider Cache
+
+# GET/entities first discovers which context providers advertise the
+# requested area/context/type under provider/+/+/... before querying them.
+# The discovered providers are kept in a small JSON file shared by every
+# ComDeX command and process on the host, so repeated queries skip the
+# discovery round trip until the entry expires (TTL) or an advertisement
+# matching it is published or cleared (empty retained payload) by ComDeX.
+#
+# Advertisements changed by other nodes reach this host through the broker
+# bridges, not through a ComDeX publish. They only invalidate the cache while
+# a process of the host watches provider/# on the broker (comdexd.py does,
+# and keeps entries for default_watched_ttl); otherwise a new or removed
+# remote provider can go unnoticed until the entry expires. Without a watcher
+# entries therefore only live default_ttl seconds: enough for the bursts of
+# commands of a script to share one discovery, short enough for a remote
+# change to be seen within seconds. --provider_ttl 0 disables the cache.
+#
+# The writers have the opposite need: before extending its own advertisement
+# a POST must know the advertisement as the broker holds it. An
+# AdvertisementView keeps the advertisements of one provider broker current
+# over the pooled session (see advertise_provider), so only writes that change
+# an advertisement read it back from the broker.
+
+import os
+import json
+import time
+import threading
+import tempfile
+import collections
+import paho.mqtt.client as mqtt
+import mqttsession
+
+#seconds a discovery result is reused without a watcher, 0 disables the cache
+default_ttl=5
+#ttl of a process watching the advertisements of its broker (see ProviderCache.watch)
+default_watched_ttl=30
+default_cache_path=os.environ.get('COMDEX_PROVIDER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'comdex', 'providers.json'))
+
+
+# Class: ProviderCache
+# Description: TTL cache of provider discovery results, persisted to a JSON file. Entries are keyed by the broker asked
+# and the advertisement topic filters used; the file is re-read when another process changed it and replaced
+# atomically on every change.
+# Parameters:
+#   - path (optional): The cache file (default: $COMDEX_PROVIDER_CACHE or ~/.cache/comdex/providers.json).
+#   - ttl (optional): Seconds an entry stays valid (default: default_ttl).
+
+class ProviderCache:
+
+    def __init__(self, path=default_cache_path, ttl=default_ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.loaded_mtime = None
+
+    def _key(self, broker, port, topic_filters):
+        return f"{broker}:{port} " + '|'.join(sorted(topic_filters))
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self.entries, self.loaded_mtime = {}, None
+            return
+        if mtime == self.loaded_mtime:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        self.loaded_mtime = mtime
+
+    def _save(self):
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.providers-')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+            self.loaded_mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            print(f"Could not write the provider cache {self.path}: {e}")
+
+    # Function: lookup
+    # Description: Returns the cached providers of a discovery, if still valid.
+    # Parameters:
+    #   - broker, port: The broker the discovery is made against.
+    #   - topic_filters: The advertisement topic filters of the discovery.
+    # Returns: A list of (address, port, area) tuples, or None on a miss.
+    def lookup(self, broker, port, topic_filters):
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            self._load()
+            entry = self.entries.get(self._key(broker, port, topic_filters))
+        if entry is None or time.time() - entry['fetched'] > self.ttl:
+            return None
+        return [tuple(provider) for provider in entry['providers']]
+
+    # Function: store
+    # Description: Records the result of a discovery.
+    # Returns: None
+    def store(self, broker, port, topic_filters, providers):
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        with self.lock:
+            self._load()
+            # expired entries are dropped whenever the file is rewritten
+            self.entries = {key: entry for key, entry in self.entries.items() if now - entry['fetched'] <= self.ttl}
+            self.entries[self._key(broker, port, topic_filters)] = {
+                'filters': list(topic_filters), 'fetched': now, 'providers': [list(provider) for provider in providers]}
+            self._save()
+
+    # Function: invalidate
+    # Description: Drops the entries whose advertisement filters match an advertisement topic that was published or cleared.
+    # Parameters:
+    #   - topic: The advertisement topic, e.g. provider/<broker>/<port>/<area>/<context>/<type>.
+    # Returns: None
+    def invalidate(self, topic):
+        with self.lock:
+            self._load()
+            stale = [key for key, entry in self.entries.items()
+                     if any(mqtt.topic_matches_sub(topic_filter, topic) for topic_filter in entry['filters'])]
+            if not stale:
+                return
+            for key in stale:
+                del self.entries[key]
+            self._save()
+
+    # Function: watch
+    # Description: Subscribes to the advertisements of a broker for the lifetime of the process, and drops the matching
+    # entries whenever an advertisement is added, changed or cleared, by whichever node. The retained replays (on
+    # subscription and after a reconnect) are not changes; the whole cache is dropped on a reconnect instead, since
+    # changes made while disconnected were missed.
+    # Parameters:
+    #   - broker, port: The broker whose advertisements are watched (the one discoveries are made against).
+    #   - username, password (optional): MQTT credentials.
+    # Returns: True if the subscription was acknowledged, False otherwise.
+    def watch(self, broker, port, username=None, password=None):
+        session = mqttsession.get_session(broker, port, username, password)
+
+        def on_advertisement(msg):
+            if not msg.retain:
+                self.invalidate(msg.topic)
+
+        session.connect_callbacks.append(lambda session: self.clear())
+        handler = session.subscribe('provider/#', 1, on_advertisement)
+        return session.wait_subscribed(handler, mqttsession.default_connect_timeout)
+
+    # Function: clear
+    # Description: Empties the cache.
+    # Returns: None
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self._save()
+
+
+provider_cache = ProviderCache()
+
+#seconds an own advertisement publish is taken as the current advertisement while its echo has not arrived
+default_echo_timeout=10
+
+
+# Class: AdvertisementView
+# Description: The per-type advertisements of a provider broker (provider/<broker>/<port>/<area>/<context>/<type>), as
+# its pooled session last saw them. A subscription replays them once, then delivers every change, by this process or
+# by any other writer. The publishes of this process (see publish_observers) are taken as current from the moment they
+# are sent: until the broker echoes them back, older messages of their topic do not replace them. The view is emptied
+# when the session reconnects (changes were missed), and replayed again on its next use.
+# Parameters:
+#   - broker, port: The provider broker.
+#   - username, password (optional): MQTT credentials.
+
+class AdvertisementView:
+
+    def __init__(self, broker, port, username=None, password=None):
+        self.session = mqttsession.get_session(broker, port, username, password)
+        self.topic_filter = f"provider/{broker}/{port}/+/+/+"
+        self.lock = threading.Lock()
+        self.adverts = {}
+        self.sent = {}
+        self.current = False
+        self.generation = 0
+        self.session.connect_callbacks.append(lambda session: self.reset())
+        self.handler = self.session.subscribe(self.topic_filter, 1, self._on_message)
+
+    def _on_message(self, msg):
+        with self.lock:
+            sent = self.sent.get(msg.topic)
+            if sent and sent[0][0] == msg.payload:
+                # the echo of an own publish
+                sent.popleft()
+            self.adverts[msg.topic] = msg.payload
+
+    # Function: sending
+    # Description: Records a publish of this process on an advertisement topic (an empty payload clears it).
+    # Returns: None
+    def sending(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        with self.lock:
+            self.sent.setdefault(topic, collections.deque()).append((payload or b'', time.monotonic()))
+
+    # Function: get
+    # Description: Returns the current advertisement of a topic, replaying the view first if needed.
+    # Parameters:
+    #   - topic: The advertisement topic.
+    #   - timeout (optional): Seconds to wait for the replay.
+    # Returns: A (known, payload) tuple: known is False when the topic is not in the view (e.g. a per-id advertisement)
+    # or the view could not be replayed, payload is None when there is no advertisement.
+    def get(self, topic, timeout=mqttsession.default_connect_timeout):
+        if not mqtt.topic_matches_sub(self.topic_filter, topic):
+            return False, None
+        with self.lock:
+            current, generation = self.current, self.generation
+        if not current:
+            # the retained replay of the subscription is complete once a sync marker sent after its SUBACK came back
+            if not (self.session.wait_subscribed(self.handler, timeout) and self.session.sync(timeout)):
+                return False, None
+            with self.lock:
+                if self.generation != generation:
+                    return False, None
+                self.current = True
+        with self.lock:
+            sent = self.sent.get(topic)
+            # a publish whose echo never came (lost, or refused by the broker) stops hiding the messages of its topic
+            while sent and time.monotonic() - sent[0][1] > default_echo_timeout:
+                sent.popleft()
+            payload = sent[-1][0] if sent else self.adverts.get(topic)
+        return True, payload or None
+
+    # Function: reset
+    # Description: Empties the view, e.g. after a reconnect or a failed publish; it is replayed on its next use.
+    # Returns: None
+    def reset(self):
+        with self.lock:
+            self.adverts.clear()
+            self.sent.clear()
+            self.current = False
+            self.generation += 1
+
+
+_views = {}
+_views_lock = threading.Lock()
+
+
+# Function: advertisement_view
+# Description: Returns the AdvertisementView of a provider broker, created on first use.
+# Parameters:
+#   - broker, port: The provider broker.
+#   - username, password (optional): MQTT credentials.
+# Returns: The AdvertisementView.
+
+def advertisement_view(broker, port, username=None, password=None):
+    key = (broker, str(port), username, password)
+    session = mqttsession.get_session(broker, port, username, password)
+    with _views_lock:
+        view = _views.get(key)
+        # a closed session is replaced in the pool, and its view with it
+        if view is None or view.session is not session:
+            view = _views[key] = AdvertisementView(broker, port, username, password)
+        return view
+
+
+def _on_publish(topic, payload, retain):
+    if retain and topic.startswith('provider/'):
+        provider_cache.invalidate(topic)
+        levels = topic.split('/')
+        with _views_lock:
+            views = [view for key, view in _views.items() if key[:2] == tuple(levels[1:3])]
+        for view in views:
+            view.sending(topic, payload)
+
+
+mqttsession.publish_observers.append(_on_publish)
@@ -0,0 +1,347 @@
+# ComDeX Entity Sinks
+
+# Destinations for the entities recreated by ComDeX. GET hands every entity
+# to a sink as soon as it is complete, so results can be streamed to a
+# callback, to NDJSON on stdout or to a file without holding the whole
+# result set in memory. Subscriptions hand their NGSI-LD notifications to the
+# same sinks, or to an HTTP webhook / Orion-LD broker (WebhookSink,
+# OrionLDSink), which batch them over one keep-alive connection.
+
+import sys
+import json
+import queue
+import bisect
+import threading
+import http.client
+import urllib.parse
+
+
+# Class: PrettyPrintSink
+# Description: Prints every entity as indented JSON to stdout (the historical ComDeX output).
+
+class PrettyPrintSink:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def emit(self, entity):
+        json_data = json.dumps(entity, indent=4, ensure_ascii=False)
+        with self.lock:
+            print(json_data)
+
+    def set_count(self, count):
+        pass
+
+    def close(self):
+        pass
+
+
+# Class: NDJSONSink
+# Description: Writes one compact JSON document per line.
+# Parameters:
+#   - target (optional): A file path, an open text stream, or None for stdout.
+#   - flush (optional): Flush after every entity so consumers see results immediately (default: True).
+
+class NDJSONSink:
+
+    def __init__(self, target=None, flush=True):
+        self.lock = threading.Lock()
+        self.owned = isinstance(target, str)
+        if target is None:
+            self.stream = sys.stdout
+        elif self.owned:
+            self.stream = open(target, 'a', encoding='utf-8')
+        else:
+            self.stream = target
+        self.flush = flush
+
+    def emit(self, entity):
+        line = json.dumps(entity, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.stream.write(line)
+            if self.flush:
+                self.stream.flush()
+
+    def set_count(self, count):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.stream.flush()
+            if self.owned:
+                self.stream.close()
+
+
+# Class: CallbackSink
+# Description: Calls a Python function with every entity.
+# Parameters:
+#   - callback: Function taking the entity (a dict).
+
+class CallbackSink:
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, entity):
+        self.callback(entity)
+
+    def set_count(self, count):
+        pass
+
+    def close(self):
+        pass
+
+
+# Class: ListSink
+# Description: Collects the entities in memory (used by the Python API to return GET results).
+
+class ListSink:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entities = []
+        self.count = None
+
+    def emit(self, entity):
+        with self.lock:
+            self.entities.append(entity)
+
+    def set_count(self, count):
+        self.count = count
+
+    def close(self):
+        pass
+
+
+# Class: PageSink
+# Description: Counts the distinct entities it receives and keeps the ones of one page of the result ordered by entity
+# id: only the offset + limit lowest ids are held at any time, so a paged GET runs in memory bounded by the page.
+# Parameters:
+#   - offset: Number of entities skipped before the page.
+#   - limit: Number of entities of the page.
+
+class PageSink:
+
+    def __init__(self, offset, limit):
+        self.offset = offset
+        self.keep = offset + limit
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.ids = []
+        self.entities = {}
+
+    @property
+    def count(self):
+        return len(self.seen)
+
+    def emit(self, entity):
+        id = entity.get('id')
+        with self.lock:
+            if id in self.seen:
+                return
+            self.seen.add(id)
+            if len(self.ids) >= self.keep and (not self.ids or id > self.ids[-1]):
+                return
+            bisect.insort(self.ids, id)
+            self.entities[id] = entity
+            if len(self.ids) > self.keep:
+                del self.entities[self.ids.pop()]
+
+    # Function: page
+    # Description: Returns the entities of the page, ordered by id.
+    def page(self):
+        with self.lock:
+            return [self.entities[id] for id in self.ids[self.offset:]]
+
+    def close(self):
+        pass
+
+
+# Class: WebhookSink
+# Description: POSTs NGSI-LD notifications to an HTTP endpoint from a background thread, over one keep-alive connection.
+# Notifications queued while a request is in flight are sent together: those of the same subscription are merged into
+# one notification (the latest version of each entity), so a burst costs one request instead of one per notification.
+# Parameters:
+#   - url: The endpoint (http:// or https://).
+#   - headers (optional): Extra request headers.
+#   - max_batch (optional): Maximum number of queued notifications merged into one request (default: 100).
+#   - timeout (optional): Socket timeout of a request in seconds (default: 10).
+
+class WebhookSink:
+
+    content_type = 'application/json'
+
+    def __init__(self, url, headers=None, max_batch=100, timeout=10):
+        self.url = urllib.parse.urlsplit(url)
+        if self.url.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported notification endpoint {url}")
+        self.path = (self.url.path or '/') + (f"?{self.url.query}" if self.url.query else '')
+        self.headers = dict(headers or {})
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.connection = None
+        self.queue = queue.Queue()
+        self.sent = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def emit(self, notification):
+        self.queue.put(notification)
+
+    def set_count(self, count):
+        pass
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+        return connection_class(self.url.hostname, self.url.port, timeout=self.timeout)
+
+    def _run(self):
+        closing = False
+        while not closing:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                closing = True
+                batch = [notification for notification in batch if notification is not None]
+            for path, body in self._requests(batch):
+                self._post(path, body)
+        if self.connection is not None:
+            self.connection.close()
+
+    def _requests(self, batch):
+        merged = {}
+        for notification in batch:
+            subscription = notification.get('subscriptionId')
+            if subscription not in merged:
+                merged[subscription] = dict(notification, data={})
+            for entity in notification.get('data', []):
+                merged[subscription]['data'][entity.get('id')] = entity
+        for notification in merged.values():
+            notification['data'] = list(notification['data'].values())
+            yield self.path, notification
+
+    def _post(self, path, body):
+        payload = json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        headers = dict(self.headers, **{'Content-Type': self.content_type})
+        # a keep-alive connection closed by the server is only noticed on use, so one retry on a fresh connection
+        for attempt in (1, 2):
+            try:
+                if self.connection is None:
+                    self.connection = self._connect()
+                self.connection.request('POST', path, body=payload, headers=headers)
+                response = self.connection.getresponse()
+                response.read()
+                if response.status >= 300:
+                    print(f"Notification endpoint {self.url.geturl()} answered {response.status} {response.reason}")
+                    self.failed += 1
+                else:
+                    self.sent += 1
+                return
+            except (OSError, http.client.HTTPException) as e:
+                if self.connection is not None:
+                    self.connection.close()
+                self.connection = None
+                if attempt == 2:
+                    print(f"Could not notify {self.url.geturl()}: {e}")
+                    self.failed += 1
+
+
+# Class: OrionLDSink
+# Description: Writes the entities of notifications into an NGSI-LD broker (e.g. Orion-LD) with batch upserts
+# (entityOperations/upsert?options=update, so attributes missing from a coalesced notification are kept).
+# Parameters:
+#   - base_url: The broker URL, e.g. http://orion:1026.
+#   - tenant (optional): NGSILD-Tenant of the entities.
+#   - max_batch, timeout (optional): As in WebhookSink.
+
+class OrionLDSink(WebhookSink):
+
+    content_type = 'application/ld+json'
+
+    def __init__(self, base_url, tenant=None, max_batch=100, timeout=10):
+        WebhookSink.__init__(self, base_url.rstrip('/') + '/ngsi-ld/v1/entityOperations/upsert?options=update',
+                             {'NGSILD-Tenant': tenant} if tenant else None, max_batch, timeout)
+
+    def _requests(self, batch):
+        entities = {}
+        for notification in batch:
+            for entity in notification.get('data', []):
+                entities[entity.get('id')] = entity
+        if entities:
+            yield self.path, list(entities.values())
+
+
+# Function: make_sink
+# Description: Builds a sink from its command line description.
+# Parameters:
+#   - spec: "pretty" (indented JSON on stdout), "ndjson" (NDJSON on stdout), an http(s):// webhook URL,
+#     "orionld:<broker url>" or the path of an NDJSON file.
+# Returns: The sink.
+
+def make_sink(spec):
+    if spec in ('', 'pretty'):
+        return PrettyPrintSink()
+    if spec == 'ndjson':
+        return NDJSONSink()
+    if spec.startswith(('http://', 'https://')):
+        return WebhookSink(spec)
+    if spec.startswith('orionld:'):
+        return OrionLDSink(spec[len('orionld:'):])
+    return NDJSONSink(spec)
+
+
+# Function: make_endpoint_sink
+# Description: Builds the sink of a subscription from its notification.endpoint.uri. Unlike make_sink it never opens a
+# local file: the uri comes from the subscription, i.e. from any client of the daemon.
+# Parameters:
+#   - uri: An http(s):// webhook URL or "orionld:<broker url>".
+# Returns: The sink. Raises ValueError for any other uri.
+
+def make_endpoint_sink(uri):
+    if not isinstance(uri, str) or not uri.startswith(('http://', 'https://', 'orionld:')):
+        raise ValueError(f"Unsupported notification endpoint {uri!r}, expected an http(s):// or orionld: uri")
+    return make_sink(uri)
+
+
+# Class: DeduplicatingSink
+# Description: Merges the entities of concurrent retrievals (e.g. several context providers) into one sink: each entity id
+# is forwarded once, at most `limit` entities are forwarded, and nothing is forwarded after close.
+# Parameters:
+#   - sink: The sink receiving the merged entities.
+#   - limit (optional): Maximum number of entities to forward (default: no limit).
+
+class DeduplicatingSink:
+
+    def __init__(self, sink, limit=None):
+        self.sink = sink
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.full = threading.Event()
+        self.closed = False
+
+    @property
+    def delivered(self):
+        return len(self.seen)
+
+    def emit(self, entity):
+        with self.lock:
+            if self.closed or self.full.is_set() or entity.get('id') in self.seen:
+                return
+            self.seen.add(entity.get('id'))
+            self.sink.emit(entity)
+            if self.limit is not None and len(self.seen) >= self.limit:
+                self.full.set()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
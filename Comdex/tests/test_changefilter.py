@@ -0,0 +1,71 @@
+# Tests of the change filter (--skip_unchanged, see changefilter.py) against the stand-in broker of the benchmarks.
+#
+# Run from the Comdex directory:
+#   python3 -m unittest discover -s tests
+
+import os
+import io
+import sys
+import tempfile
+import contextlib
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+
+state = tempfile.mkdtemp(prefix='comdex-test-')
+os.environ['COMDEX_PROVIDER_CACHE'] = os.path.join(state, 'providers.json')
+os.environ['COMDEX_ATTRIBUTE_STATE'] = os.path.join(state, 'attributes.json')
+
+import actionhandler
+import mqttsession
+from changefilter import change_filter
+from standin_broker import StandInBroker
+
+core_context = "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld"
+
+
+class SkipUnchangedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.published = []
+        mqttsession.publish_observers.append(self.observe)
+        change_filter.enabled = True
+
+    def tearDown(self):
+        change_filter.enabled = False
+        mqttsession.publish_observers.remove(self.observe)
+        mqttsession.close_sessions()
+        self.broker.stop()
+
+    def observe(self, topic, payload, retain):
+        if '/entities/' in topic:
+            self.published.append(topic)
+
+    def post(self, entity, bypass_existence_check):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return actionhandler.post_entity(entity, 'test', '127.0.0.1', self.broker.port, 1, 'loc', bypass_existence_check)
+
+    def test_identical_update_publishes_nothing(self):
+        entity = {"id": "urn:ngsi-ld:Turbine:1", "type": "Turbine", "@context": core_context,
+                  "rpm": {"type": "Property", "value": 100}, "status": {"type": "Property", "value": "ok"}}
+        self.assertTrue(self.post(entity, 0))
+        self.assertTrue(self.published)
+        self.published.clear()
+        self.assertTrue(self.post(entity, 1))
+        self.assertEqual(self.published, [])
+
+    def test_changed_attribute_is_published(self):
+        entity = {"id": "urn:ngsi-ld:Turbine:2", "type": "Turbine", "@context": core_context,
+                  "rpm": {"type": "Property", "value": 100}, "status": {"type": "Property", "value": "ok"}}
+        self.assertTrue(self.post(entity, 0))
+        self.published.clear()
+        self.assertTrue(self.post(dict(entity, rpm={"type": "Property", "value": 101}), 1))
+        self.assertTrue(self.published)
+        self.assertTrue(all(topic.split('/')[-1].startswith('rpm') for topic in self.published))
+
+
+if __name__ == '__main__':
+    unittest.main()
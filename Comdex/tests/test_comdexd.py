@@ -0,0 +1,118 @@
+# Tests of the REST routes of the daemon (comdexd.py), dispatched directly against the stand-in broker of the benchmarks.
+#
+# Run from the Comdex directory:
+#   python3 -m unittest discover -s tests
+
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import threading
+import contextlib
+import unittest
+import urllib.parse
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+
+state = tempfile.mkdtemp(prefix='comdex-test-')
+os.environ['COMDEX_PROVIDER_CACHE'] = os.path.join(state, 'providers.json')
+os.environ['COMDEX_ATTRIBUTE_STATE'] = os.path.join(state, 'attributes.json')
+
+import mqttsession
+from comdexd import ComDeXService, HTTPError
+from standin_broker import StandInBroker
+
+core_context = "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld"
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        # the operations and the subscription threads log to stdout
+        self.output = contextlib.redirect_stdout(io.StringIO())
+        self.output.__enter__()
+        # the daemon reads (and creates) broker_location_awareness.txt in the working directory
+        self.cwd = os.getcwd()
+        os.chdir(state)
+        self.service = ComDeXService('127.0.0.1', self.broker.port, provider_ttl=0)
+
+    def tearDown(self):
+        self.service.executor.shutdown()
+        mqttsession.close_sessions()
+        self.broker.stop()
+        os.chdir(self.cwd)
+        self.output.__exit__(None, None, None)
+
+    # Returns the status of the request and its body, or the status of the HTTPError it raised
+    def request(self, method, target, body=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        try:
+            status, headers, result = asyncio.run(self.service.dispatch(method, '/ngsi-ld/v1' + target, {}, payload))
+        except HTTPError as e:
+            return e.status, e.detail
+        return status, result
+
+    def entity(self, eid, **attributes):
+        return dict({"id": eid, "type": "Turbine", "@context": core_context}, **attributes)
+
+    def test_delete_missing_attribute(self):
+        self.assertEqual(self.request('POST', '/entities', self.entity('urn:ngsi-ld:Turbine:1', rpm={"type": "Property", "value": 1}))[0], 201)
+        self.assertEqual(self.request('DELETE', '/entities/urn:ngsi-ld:Turbine:1/attrs/status')[0], 404)
+        self.assertEqual(self.request('DELETE', '/entities/urn:ngsi-ld:Turbine:9/attrs/rpm')[0], 404)
+        self.assertEqual(self.request('DELETE', '/entities/urn:ngsi-ld:Turbine:1/attrs/rpm')[0], 204)
+        self.assertEqual(self.request('DELETE', '/entities/urn:ngsi-ld:Turbine:1/attrs/rpm')[0], 404)
+
+    def test_query_values_are_not_split(self):
+        eid = 'urn:ngsi-ld:Turbine:a&b=c,d'
+        self.assertEqual(self.request('POST', '/entities', self.entity(eid, rpm={"type": "Property", "value": 1}))[0], 201)
+        self.assertEqual(self.request('POST', '/entities', self.entity('urn:ngsi-ld:Turbine:a', rpm={"type": "Property", "value": 2}))[0], 201)
+        status, entity = self.request('GET', '/entities/' + urllib.parse.quote(eid, safe=':'))
+        self.assertEqual((status, entity['id']), (200, eid))
+        status, entities = self.request('GET', '/entities?' + urllib.parse.urlencode({'id': eid, 'attrs': 'rpm'}))
+        self.assertEqual([entity['id'] for entity in entities], [eid])
+
+    def test_topic_levels_are_rejected(self):
+        for eid in ('urn:ngsi-ld:Turbine:1/rpm', 'urn:ngsi-ld:Turbine:+', 'urn:ngsi-ld:Turbine:#'):
+            self.assertEqual(self.request('POST', '/entities', self.entity(eid))[0], 400, eid)
+        self.assertEqual(self.request('POST', '/entities', dict(self.entity('urn:ngsi-ld:Turbine:2'), type='Wind/Turbine'))[0], 400)
+        self.assertEqual(self.request('POST', '/entities', self.entity('urn:ngsi-ld:Turbine:2', **{'a/b': 1}))[0], 400)
+        self.assertEqual(self.request('POST', '/entities', self.entity('urn:ngsi-ld:Turbine:2', rpm={"type": "Property", "value": 1}))[0], 201)
+        self.assertEqual(self.request('PATCH', '/entities/urn:ngsi-ld:Turbine:2/attrs', {'rpm#': {"type": "Property", "value": 2}})[0], 400)
+        self.assertEqual(self.request('PATCH', '/entities/urn:ngsi-ld:Turbine:%2B/attrs', {'rpm': {"type": "Property", "value": 2}})[0], 400)
+
+    def subscription(self, sid, **members):
+        return dict({"id": sid, "type": "Subscription", "entities": [{"type": "Turbine"}], "@context": core_context}, **members)
+
+    def test_invalid_subscriptions_are_rejected(self):
+        for data in (self.subscription('urn:S:1', throttling=5, timeInterval=5),
+                     self.subscription('urn:S:2', throttling='often'),
+                     self.subscription('urn:S:3', entities=[]),
+                     self.subscription('urn:S:4', notification={'endpoint': {'uri': 'urn:ngsi-ld:Endpoint:1'}}),
+                     self.subscription('urn:S:5', notification={'endpoint': {'uri': 'mqtt://broker:1883/notify'}}),
+                     {"id": "urn:S:6", "type": "Subscription", "watchedAttributes": []}):
+            self.assertEqual(self.request('POST', '/subscriptions', data)[0], 400, data['id'])
+        self.assertEqual(self.request('GET', '/subscriptions'), (200, []))
+        self.assertFalse(os.path.exists('urn:ngsi-ld:Endpoint:1'))
+
+    def test_delete_subscription(self):
+        self.assertEqual(self.request('POST', '/subscriptions', self.subscription('urn:S:7'))[0], 201)
+        self.assertEqual(self.request('POST', '/subscriptions', self.subscription('urn:S:7'))[0], 409)
+        self.assertEqual(self.request('GET', '/subscriptions/urn:S:7')[0], 200)
+        followers = [thread for thread in threading.enumerate() if thread.name.endswith('(_follow_subscription)')]
+        self.assertTrue(followers)
+        self.assertEqual(self.request('DELETE', '/subscriptions/urn:S:7')[0], 204)
+        self.assertEqual(self.request('GET', '/subscriptions/urn:S:7')[0], 404)
+        self.assertEqual(self.request('DELETE', '/subscriptions/urn:S:7')[0], 404)
+        for thread in followers:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+# Tests of the entity operations (POST, PATCH, DELETE of actionhandler.py) against the stand-in broker of the benchmarks.
+#
+# Run from the Comdex directory:
+#   python3 -m unittest discover -s tests
+
+import os
+import io
+import sys
+import time
+import tempfile
+import threading
+import contextlib
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+
+state = tempfile.mkdtemp(prefix='comdex-test-')
+os.environ['COMDEX_PROVIDER_CACHE'] = os.path.join(state, 'providers.json')
+os.environ['COMDEX_ATTRIBUTE_STATE'] = os.path.join(state, 'attributes.json')
+
+import actionhandler
+import mqttsession
+from standin_broker import StandInBroker
+
+core_context = "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld"
+
+
+class EntityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.published = []
+        mqttsession.publish_observers.append(self.observe)
+
+    def tearDown(self):
+        mqttsession.publish_observers.remove(self.observe)
+        mqttsession.close_sessions()
+        self.broker.stop()
+
+    def observe(self, topic, payload, retain):
+        if '/entities/' in topic:
+            self.published.append(topic)
+
+    def post(self, entity):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return actionhandler.post_entity(entity, 'test', '127.0.0.1', self.broker.port, 1, 'loc', 0)
+
+    def test_concurrent_patches_keep_their_type(self):
+        for n, kind in enumerate(('Turbine', 'Pump')):
+            self.assertTrue(self.post({"id": f"urn:ngsi-ld:{kind}:{n}", "type": kind, "@context": core_context,
+                                       "rpm": {"type": "Property", "value": 0}}))
+        self.published.clear()
+
+        def patch(n, kind):
+            for value in range(20):
+                actionhandler.patch_entity(f"urn:ngsi-ld:{kind}:{n}", {"rpm": {"type": "Property", "value": value + 1}},
+                                           'test', '127.0.0.1', self.broker.port, 1)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            threads = [threading.Thread(target=patch, args=(n, kind)) for n, kind in enumerate(('Turbine', 'Pump'))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(self.published), 80)
+        for topic in self.published:
+            kind = topic.split('/')[-2].split(':')[2]
+            self.assertEqual(topic.split('/')[-4], kind)
+
+
+class AdvertisementTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.reads = []
+        self.collect_retained = actionhandler.collect_retained
+
+        def counting_collect_retained(broker, port, topics, *args, **kwargs):
+            self.reads.extend(topic for topic in topics if topic.startswith('provider/'))
+            return self.collect_retained(broker, port, topics, *args, **kwargs)
+
+        actionhandler.collect_retained = counting_collect_retained
+
+    def tearDown(self):
+        actionhandler.collect_retained = self.collect_retained
+        actionhandler.advertisement_timeout = 10
+        mqttsession.close_sessions()
+        self.broker.stop()
+
+    def post(self, n, coordinates=None):
+        entity = {"id": f"urn:ngsi-ld:Turbine:{n}", "type": "Turbine", "@context": core_context,
+                  "rpm": {"type": "Property", "value": n}}
+        if coordinates is not None:
+            entity['location'] = {"type": "GeoProperty", "value": {"type": "Point", "coordinates": coordinates}}
+        with contextlib.redirect_stdout(io.StringIO()):
+            return actionhandler.post_entity(entity, 'test', '127.0.0.1', self.broker.port, 1, 'loc', 0)
+
+    def advertisements(self):
+        adverts = {}
+        self.collect_retained('127.0.0.1', self.broker.port, ['provider/#'], 1,
+                              lambda msg: adverts.update({msg.topic: actionhandler.parse_advertisement(msg.payload)}))
+        return adverts
+
+    def test_unchanged_advertisement_is_not_read(self):
+        self.assertTrue(self.post(1, [1, 1]))
+        self.reads.clear()
+        self.assertTrue(self.post(2))
+        self.assertEqual(self.reads, [])
+        # a write extending the box reads its publish back
+        self.assertTrue(self.post(3, [2, 2]))
+        self.assertEqual(len(self.reads), 1)
+        self.assertEqual([advert['bbox'] for advert in self.advertisements().values()], [[1, 1, 2, 2]])
+
+    def test_cleared_advertisement_is_published_again(self):
+        self.assertTrue(self.post(1))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(actionhandler.delete_entity("urn:ngsi-ld:Turbine:1", 'test', '127.0.0.1', self.broker.port))
+        self.assertEqual(self.advertisements(), {})
+        self.assertTrue(self.post(2))
+        self.assertEqual(len(self.advertisements()), 1)
+
+    def test_lost_connection_does_not_hang(self):
+        self.assertTrue(self.post(1, [1, 1]))
+        actionhandler.advertisement_timeout = 0.5
+        session = mqttsession.get_session('127.0.0.1', self.broker.port)
+        self.broker.stop()
+        started = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(actionhandler.advertise_provider(session, '127.0.0.1', self.broker.port,
+                                                              next(iter(actionhandler.advertisement_view('127.0.0.1', self.broker.port).adverts)),
+                                                              'loc', ['now'], [5, 5, 5, 5]))
+        self.assertLess(time.monotonic() - started, 5)
+        self.broker = StandInBroker().start()
+
+    def test_invalid_entity_is_rejected(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(actionhandler.post_entity({"id": "urn:ngsi-ld:Turbine:1"}, 'test', '127.0.0.1', self.broker.port, 1, 'loc', 0))
+
+
+class SummaryAdvertisementTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        actionhandler.summaryadvertisement = True
+
+    def tearDown(self):
+        actionhandler.summaryadvertisement = False
+        mqttsession.close_sessions()
+        self.broker.stop()
+
+    def summary_count(self):
+        adverts = []
+        actionhandler.collect_retained('127.0.0.1', self.broker.port, ['provider/#'], 1,
+                                       lambda msg: adverts.append(actionhandler.parse_advertisement(msg.payload)))
+        self.assertEqual(len(adverts), 1)
+        return adverts[0]['ids']['count']
+
+    def test_count_follows_creations_and_deletions(self):
+        entities = [{"id": f"urn:ngsi-ld:Turbine:{n}", "type": "Turbine", "@context": core_context,
+                     "rpm": {"type": "Property", "value": n}} for n in range(3)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for entity in entities[:2]:
+                actionhandler.post_entity(entity, 'test', '127.0.0.1', self.broker.port, 1, 'loc', 0)
+            self.assertEqual(self.summary_count(), 2)
+            actionhandler.delete_entity(entities[0]['id'], 'test', '127.0.0.1', self.broker.port)
+            self.assertEqual(self.summary_count(), 1)
+            actionhandler.post_entity(entities[0], 'test', '127.0.0.1', self.broker.port, 1, 'loc', 0)
+            self.assertEqual(self.summary_count(), 2)
+            # an upsert counts the entities it creates, not the ones it updates
+            actionhandler.batch_post_entities(entities, 'test', '127.0.0.1', self.broker.port, 1, 'loc', 1)
+            self.assertEqual(self.summary_count(), 3)
+            actionhandler.post_entity(entities[1], 'test', '127.0.0.1', self.broker.port, 1, 'loc', 1)
+            self.assertEqual(self.summary_count(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# Tests of the provider id summaries (idsummary.py).
+#
+# Run from the Comdex directory:
+#   python3 -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from idsummary import IdSummary, may_hold
+
+
+class IdSummaryTest(unittest.TestCase):
+
+    def test_membership(self):
+        summary = IdSummary.build(f"urn:ngsi-ld:Turbine:{n}" for n in range(500))
+        self.assertEqual(summary.count, 500)
+        self.assertTrue(all(f"urn:ngsi-ld:Turbine:{n}" in summary for n in range(500)))
+        false_positives = sum(f"urn:ngsi-ld:Pump:{n}" in summary for n in range(10000))
+        self.assertLess(false_positives, 200)
+
+    def test_recreated_id_is_counted(self):
+        summary = IdSummary.build(['a', 'b'])
+        self.assertEqual(summary.remove(['a']), 1)
+        self.assertEqual((summary.count, summary.removed), (1, 1))
+        self.assertTrue(summary.add(['a'], new=['a']))
+        self.assertEqual(summary.count, 2)
+
+    def test_false_positive_is_counted(self):
+        summary = IdSummary(capacity=4, error_rate=0.5)
+        summary.add(['a', 'b', 'c', 'd'], new=['a', 'b', 'c', 'd'])
+        false_positive = next(f"x{n}" for n in range(100000) if f"x{n}" in summary)
+        self.assertTrue(summary.add([false_positive], new=[false_positive]))
+        self.assertEqual(summary.count, 5)
+
+    def test_updates_are_not_counted(self):
+        summary = IdSummary.build(['a', 'b'])
+        modified = summary.modified
+        self.assertFalse(summary.add(['a', 'b']))
+        self.assertEqual((summary.count, summary.modified), (2, modified))
+        self.assertTrue(summary.add(['c']))
+        self.assertEqual(summary.count, 2)
+        self.assertIn('c', summary)
+
+    def test_stale(self):
+        summary = IdSummary.build([str(n) for n in range(600)])
+        self.assertFalse(summary.stale())
+        summary.remove([str(n) for n in range(400)])
+        self.assertTrue(summary.stale())
+        summary = IdSummary(capacity=2)
+        summary.add(['a', 'b', 'c'], new=['a', 'b', 'c'])
+        self.assertTrue(summary.stale())
+
+    def test_advertisement_round_trip(self):
+        summary = IdSummary.build(['a', 'b'])
+        summary.remove(['b'])
+        copy = IdSummary.from_dict(summary.to_dict())
+        self.assertEqual(copy.to_dict(), summary.to_dict())
+        self.assertIsNone(IdSummary.from_dict({'count': 1}))
+        self.assertIsNone(IdSummary.from_dict(dict(summary.to_dict(), bits=8)))
+        self.assertTrue(may_hold(None, 'z'))
+        self.assertTrue(may_hold([summary.to_dict()], 'a'))
+        self.assertTrue(may_hold([{'unreadable': True}], 'z'))
+        self.assertFalse(may_hold([IdSummary.build(['a']).to_dict()], 'urn:ngsi-ld:Turbine:404'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# Tests of the resident retained mirror (see mirror.py) against the stand-in broker of the benchmarks.
+#
+# Run from the Comdex directory:
+#   python3 -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+
+import mirror
+import mqttsession
+import instrumentation
+from standin_broker import StandInBroker
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+
+    def tearDown(self):
+        mirror.stop_mirrors()
+        mqttsession.close_sessions()
+        self.broker.stop()
+
+    def test_no_mirror_no_metrics(self):
+        self.assertIsNone(mirror.prometheus_text())
+
+    def test_staleness_metrics(self):
+        session = mqttsession.get_session('127.0.0.1', self.broker.port)
+        session.publish('a/entities/ctx/T/LNA/urn:1/rpm', b'{"type":"Property","value":1}', qos=1, retain=True).wait_for_publish()
+        mirror.start_mirror('127.0.0.1', self.broker.port)
+        samples = instrumentation.parse_prometheus(mirror.prometheus_text())
+        labels = (('broker', f"127.0.0.1:{self.broker.port}"),)
+        self.assertEqual(samples[('comdex_mirror_current', labels)], 1)
+        self.assertEqual(samples[('comdex_mirror_topics', labels)], 1)
+        self.assertEqual(samples[('comdex_mirror_seconds_disconnected', labels)], 0)
+        self.assertIn('# TYPE comdex_mirror_resyncs_total counter', mirror.prometheus_text())
+
+
+class LiveMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+
+    def tearDown(self):
+        mirror.stop_mirrors()
+        mqttsession.close_sessions()
+        self.broker.stop()
+
+    def test_only_retained_topics_are_mirrored(self):
+        # another node: the publish observers of this process do not see its writes
+        session = mqttsession.Session('127.0.0.1', self.broker.port)
+        session.connect()
+        self.addCleanup(session.close)
+        session.publish('a/other/status', b'up', qos=1, retain=True).wait_for_publish()
+        resident = mirror.start_mirror('127.0.0.1', self.broker.port)
+        publishes = [('a/Subscriptions/ctx/T/urn:1/rpm', b'{"value":2}', False),
+                     ('sensors/t1', b'21.5', False),
+                     ('a/entities/ctx/T/LNA/urn:1/rpm', b'{"type":"Property","value":1}', True),
+                     ('provider/127.0.0.1/1883/a/ctx/T', b'{"ids":1}', True),
+                     ('a/other/status', b'down', True)]
+        for topic, payload, retain in publishes:
+            session.publish(topic, payload, qos=1, retain=retain).wait_for_publish()
+        self.assertTrue(session.sync(5))
+        self.assertTrue(resident.session.sync(5))
+        stored = {message.topic: message.payload for message in resident.messages_matching(['#'])}
+        self.assertEqual(stored, {'a/entities/ctx/T/LNA/urn:1/rpm': b'{"type":"Property","value":1}',
+                                  'provider/127.0.0.1/1883/a/ctx/T': b'{"ids":1}', 'a/other/status': b'down'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# Tests of the pooled MQTT sessions (see mqttsession.py) against the stand-in broker of the benchmarks.
+#
+# Run from the Comdex directory:
+#   python3 -m unittest discover -s tests
+
+import os
+import io
+import sys
+import time
+import contextlib
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+
+import mqttsession
+from standin_broker import StandInBroker
+
+
+class SubscribeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.session = mqttsession.Session('127.0.0.1', self.broker.port, min_backoff=0.1, max_backoff=0.2)
+        self.session.connect()
+
+    def tearDown(self):
+        self.session.close()
+        self.broker.stop()
+
+    def test_subscription_acknowledged(self):
+        handler = self.session.subscribe('a/#', 1, lambda msg: None)
+        self.assertTrue(self.session.wait_subscribed(handler, 5))
+
+    def test_subscription_while_reconnecting(self):
+        port = self.broker.port
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.broker.stop()
+            deadline = time.monotonic() + 5
+            while self.session.connected.is_set() and time.monotonic() < deadline:
+                time.sleep(0.02)
+            self.assertFalse(self.session.connected.is_set())
+            handler = self.session.subscribe('a/#', 1, lambda msg: None)
+            self.assertFalse(self.session.wait_subscribed(handler, 0.2))
+            self.broker = StandInBroker(port=port).start()
+            # acknowledged by the subscription restored on reconnect, not after the full timeout
+            started = time.monotonic()
+            self.assertTrue(self.session.wait_subscribed(handler, 10))
+        self.assertLess(time.monotonic() - started, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+# Tests of the NGSI-LD q filter (see ngsildquery.py).
+#
+# Run from the Comdex directory:
+#   python3 -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ngsildquery import compile_query, QuerySyntaxError
+
+
+class PatternTest(unittest.TestCase):
+
+    def test_pattern_matches(self):
+        self.assertTrue(compile_query('name~=^tur')({'name': {'type': 'Property', 'value': 'turbine'}}))
+        self.assertFalse(compile_query('name!~=^tur')({'name': {'type': 'Property', 'value': 'turbine'}}))
+
+    def test_unquoted_pattern_keeps_its_groups(self):
+        turbine = {'name': {'type': 'Property', 'value': 'turbine'}, 'rpm': {'type': 'Property', 'value': 150}}
+        pump = {'name': {'type': 'Property', 'value': 'pump'}, 'rpm': {'type': 'Property', 'value': 50}}
+        query = compile_query('name~=^(turbine|pump)$;rpm>100')
+        self.assertTrue(query(turbine))
+        self.assertFalse(query(pump))
+        self.assertTrue(compile_query('(name~=^(x|pump)$)|rpm>100')(pump))
+        self.assertFalse(compile_query('name~=^[|;]|name~=p\\|q')(pump))
+        self.assertTrue(compile_query('name~=tur[)]*b;rpm>100')(turbine))
+
+    def test_invalid_pattern_is_a_syntax_error(self):
+        with self.assertRaises(QuerySyntaxError):
+            compile_query('name~=(abc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# Tests of the provider discovery cache (see providercache.py) against the stand-in broker of the benchmarks.
+#
+# Run from the Comdex directory:
+#   python3 -m unittest discover -s tests
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'benchmarks'))
+
+import paho.mqtt.client as mqtt
+import mqttsession
+from providercache import ProviderCache
+from standin_broker import StandInBroker
+
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StandInBroker().start()
+        self.cache = ProviderCache(os.path.join(tempfile.mkdtemp(prefix='comdex-test-'), 'providers.json'), ttl=30)
+        self.remote = mqtt.Client()
+        self.remote.connect('127.0.0.1', self.broker.port)
+        self.remote.loop_start()
+
+    def tearDown(self):
+        self.remote.loop_stop()
+        self.remote.disconnect()
+        mqttsession.close_sessions()
+        self.broker.stop()
+
+    def publish_remote(self, topic, payload):
+        # published by another node, through a bridge: no ComDeX publish observer sees it
+        self.remote.publish(topic, payload, qos=1, retain=True).wait_for_publish()
+
+    def discover(self, filters):
+        self.cache.store('127.0.0.1', self.broker.port, filters, [('10.0.0.1', '1026', 'area')])
+
+    def wait_invalidated(self, filters):
+        deadline = time.monotonic() + 5
+        while self.cache.lookup('127.0.0.1', self.broker.port, filters) is not None and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return self.cache.lookup('127.0.0.1', self.broker.port, filters) is None
+
+    def test_remote_advertisements_invalidate(self):
+        filters = ['provider/+/+/area/ctx/Turbine']
+        self.publish_remote('provider/10.0.0.1/1026/area/ctx/Turbine', b'{}')
+        self.assertTrue(self.cache.watch('127.0.0.1', self.broker.port))
+        self.discover(filters)
+        self.assertIsNotNone(self.cache.lookup('127.0.0.1', self.broker.port, filters))
+        # the retained replay of the watch subscription is not a change
+        time.sleep(0.2)
+        self.assertIsNotNone(self.cache.lookup('127.0.0.1', self.broker.port, filters))
+
+        self.publish_remote('provider/10.0.0.2/1026/area/ctx/Turbine', b'{}')
+        self.assertTrue(self.wait_invalidated(filters))
+
+        self.discover(filters)
+        self.publish_remote('provider/10.0.0.1/1026/area/ctx/Turbine', b'')
+        self.assertTrue(self.wait_invalidated(filters))
+
+    def test_other_advertisements_keep_entries(self):
+        filters = ['provider/+/+/area/ctx/Turbine']
+        self.assertTrue(self.cache.watch('127.0.0.1', self.broker.port))
+        self.discover(filters)
+        self.publish_remote('provider/10.0.0.3/1026/area/ctx/Pump', b'{}')
+        time.sleep(0.3)
+        self.assertIsNotNone(self.cache.lookup('127.0.0.1', self.broker.port, filters))
+
+
+if __name__ == '__main__':
+    unittest.main()
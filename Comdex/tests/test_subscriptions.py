@@ -0,0 +1,52 @@
+# Tests of the subscription lifetime (expiresAt / expires, see actionhandler.subscription_lifetime) and of the
+# notification endpoints a subscription may name (sinks.make_endpoint_sink).
+#
+# Run from the Comdex directory:
+#   python3 -m unittest discover -s tests
+
+import os
+import sys
+import time
+import datetime
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from actionhandler import subscription_lifetime
+from sinks import WebhookSink, OrionLDSink, make_endpoint_sink
+
+
+class LifetimeTest(unittest.TestCase):
+
+    def test_expires_at(self):
+        deadline = datetime.datetime.fromtimestamp(time.time() + 600, datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+        self.assertAlmostEqual(subscription_lifetime({'expiresAt': deadline}), 600, delta=5)
+        self.assertEqual(subscription_lifetime({'expiresAt': '2000-01-01T00:00:00Z'}), 0)
+
+    def test_expires_seconds(self):
+        self.assertEqual(subscription_lifetime({}), 3600)
+        self.assertEqual(subscription_lifetime({'expires': '90'}), 90)
+
+    def test_invalid_values(self):
+        for data in ({'expiresAt': 'tomorrow'}, {'expiresAt': 12}, {'expires': '2030-01-01T00:00:00Z'}, {'expires': -1},
+                     {'expires': None}):
+            with self.assertRaises(ValueError):
+                subscription_lifetime(data)
+
+
+class EndpointTest(unittest.TestCase):
+
+    def test_webhooks(self):
+        self.assertIsInstance(make_endpoint_sink('http://localhost:8080/notify'), WebhookSink)
+        self.assertIsInstance(make_endpoint_sink('orionld:http://orion:1026'), OrionLDSink)
+
+    def test_local_paths_are_rejected(self):
+        cwd = os.getcwd()
+        for uri in ('mqtt://broker:1883/notify', 'urn:ngsi-ld:Endpoint:1', '/tmp/notifications.ndjson', 'ndjson', 'pretty', 12):
+            with self.assertRaises(ValueError):
+                make_endpoint_sink(uri)
+        self.assertFalse(os.path.exists(os.path.join(cwd, 'urn:ngsi-ld:Endpoint:1')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# Tests of the attribute time-series store and its recorder (timeseries.py).
+#
+# Run from the Comdex directory:
+#   python3 -m unittest discover -s tests
+
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import codec
+from timeseries import AttributeSeries, TimeSeriesStore, HistoryRecorder, modified_time
+
+
+class AttributeSeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='comdex-test-')
+        self.series = AttributeSeries(os.path.join(self.directory, 'rpm.ts'), {'attr': 'rpm'}, capacity=4)
+
+    def tearDown(self):
+        self.series.close()
+        shutil.rmtree(self.directory)
+
+    def test_ring_buffer(self):
+        for value in range(6):
+            self.assertTrue(self.series.append({'type': 'Property', 'value': value}, ts=100 + value))
+        # the oldest slot of a full series is the next one rewritten, it is not read
+        self.assertEqual([a['value'] for ts, a in self.series.read()], [3, 4, 5])
+        self.assertEqual([ts for ts, a in self.series.read(start=103, end=105)], [103, 104])
+        self.assertEqual([a['value'] for ts, a in self.series.read(last_n=1)], [5])
+
+    def test_slot_being_overwritten_is_dropped(self):
+        for value in range(4):
+            self.series.append({'type': 'Property', 'value': value}, ts=100 + value)
+        # the appender of the fifth update has rewritten the slot of the oldest one, but not bumped the count yet
+        self.series.numbers[0] = 99
+        self.series.times[0] = 104
+        self.assertEqual([a['value'] for ts, a in self.series.read()], [1, 2, 3])
+
+
+class RecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='comdex-test-')
+        self.recorder = HistoryRecorder('127.0.0.1', 1883, TimeSeriesStore(self.directory))
+
+    def tearDown(self):
+        self.recorder.store.close()
+        shutil.rmtree(self.directory)
+
+    def receive(self, attr, payload):
+        msg = mqtt.MQTTMessage(topic=f"area/entities/ctx/Turbine/LNA/urn:ngsi-ld:Turbine:1/{attr}".encode('utf-8'))
+        msg.payload = payload
+        self.recorder._on_message(msg)
+
+    def history(self, attr):
+        path = self.recorder.store._path('ctx', 'Turbine', 'urn:ngsi-ld:Turbine:1', attr)
+        series = AttributeSeries(path)
+        try:
+            return series.read()
+        finally:
+            series.close()
+
+    def test_envelope_modified_at_is_recorded(self):
+        modified = datetime.datetime(2024, 5, 1, 10, 0, 0)
+        attribute = {'type': 'Property', 'value': 7}
+        self.receive('rpm', codec.encode(codec.wrap_attribute(attribute, [str(modified)], [str(modified)])))
+        self.assertEqual(self.history('rpm'), [(modified.timestamp(), attribute)])
+
+    def test_plain_payload_is_recorded_at_receipt(self):
+        before = datetime.datetime.now().timestamp()
+        self.receive('status', codec.encode({'type': 'Property', 'value': 'ok'}))
+        [(ts, attribute)] = self.history('status')
+        self.assertGreaterEqual(ts, before)
+
+    def test_modified_time(self):
+        self.assertEqual(modified_time({'modifiedAt': ['2024-05-01T10:00:00Z']}),
+                         datetime.datetime(2024, 5, 1, 10, tzinfo=datetime.timezone.utc).timestamp())
+        for temporal in (None, {}, {'modifiedAt': []}, {'modifiedAt': ['yesterday']}, {'modifiedAt': [12]}):
+            self.assertIsNone(modified_time(temporal))
+
+
+if __name__ == '__main__':
+    unittest.main()
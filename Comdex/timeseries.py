@@ -0,0 +1,592 @@
+# ComDeX Attribute Time-Series Store
+
+# Retained MQTT only keeps the latest value of an attribute. The history
+# recorder below follows the entity topics of the local broker and appends
+# every live attribute update to a per-attribute file, so short-horizon
+# NGSI-LD temporal queries (timerel=before|after|between, lastN) are answered
+# next to the broker, without a round trip to Mintaka.
+#
+# One file per attribute, {dir}/{context}/{type}/{id}/{attr}.ts, memory-mapped
+# and laid out in columns behind a 512-byte header:
+#
+#   header   magic, capacity, slot size, metadata length, appended count, metadata (JSON: context, type, id, attr)
+#   time     capacity x float64, the modifiedAt of the update (the time it was recorded when its payload has no
+#            envelope, see codec.wrap_attribute), never decreasing
+#   number   capacity x float64, the value of plain numeric Properties
+#   length   capacity x uint16, the size of the encoded attribute in its slot (0: float, 0xFFFE: integer)
+#   slot     capacity x slot size, the JSON encoded attribute for every other value
+#
+# The columns are ring buffers: once capacity updates were appended the
+# oldest are overwritten, which bounds the disk used per attribute. Numeric
+# samples only take 18 bytes (files are created sparse). The time column is
+# sorted, so a time range is found with two binary searches over the mapped
+# column and only the matching records are decoded. The appended count is
+# written after the record, and records overwritten while a query read them
+# are dropped, so queries can run in other processes while the recorder
+# writes. The oldest slot of a full series is the next one rewritten and is
+# never read: queries see the last capacity - 1 updates.
+#
+#   python3 timeseries.py -b localhost -p 1026 --dir /var/lib/comdex/history [--area plant1] [--capacity 10000]
+
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import bisect
+import struct
+import getopt
+import hashlib
+import datetime
+import threading
+import collections
+import urllib.parse
+import codec
+import mqttsession
+from sinks import PrettyPrintSink
+
+magic = b'CDXTS\x01\x00\x00'
+header_size = 512
+_header = struct.Struct('<8sQIIQ')
+_count_offset = 24
+float_sample = 0
+int_sample = 0xFFFE
+default_capacity = 10000
+default_slot_bytes = 128
+default_max_open = 256
+default_limit = 1800
+timerels = ('before', 'after', 'between')
+
+
+def _file_name(name):
+    quoted = urllib.parse.quote(name, safe='')
+    # names beyond the file name limit are hashed, the metadata keeps the real name
+    return quoted if len(quoted) <= 200 else hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+
+def _iso(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+# Function: parse_time
+# Description: Parses an NGSI-LD DateTime (ISO 8601, UTC when no offset is given).
+# Parameters:
+#   - text: The DateTime, e.g. 2024-05-01T10:00:00Z.
+# Returns: The POSIX timestamp. Raises ValueError if the text is not a DateTime.
+
+def parse_time(text):
+    moment = datetime.datetime.fromisoformat(text.strip().replace('Z', '+00:00').replace('z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+class _Timeline:
+    # the time column in append order, as a sequence for bisect
+
+    def __init__(self, times, first, size, capacity):
+        self.times = times
+        self.first = first
+        self.size = size
+        self.capacity = capacity
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, k):
+        return self.times[(self.first + k) % self.capacity]
+
+
+# Class: AttributeSeries
+# Description: The memory-mapped ring buffer of the updates of one attribute.
+# Parameters:
+#   - path: The file of the series.
+#   - meta (optional): Metadata of a new series (context, type, id, attr); the file is created when given.
+#   - capacity / slot_bytes (optional): Size of a new series.
+
+class AttributeSeries:
+
+    def __init__(self, path, meta=None, capacity=default_capacity, slot_bytes=default_slot_bytes):
+        self.path = path
+        if meta is not None and not os.path.exists(path):
+            self._create(meta, capacity, slot_bytes)
+        with open(path, 'r+b' if meta is not None else 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if meta is not None else mmap.ACCESS_READ)
+        signature, self.capacity, self.slot_bytes, meta_length, count = _header.unpack_from(self.map, 0)
+        if signature != magic:
+            self.map.close()
+            raise ValueError(f"{path} is not a ComDeX time series")
+        self.meta = json.loads(self.map[_header.size:_header.size + meta_length])
+        view = memoryview(self.map)
+        self.view = view
+        offset = header_size
+        self.times = view[offset:offset + 8 * self.capacity].cast('d')
+        offset += 8 * self.capacity
+        self.numbers = view[offset:offset + 8 * self.capacity].cast('d')
+        offset += 8 * self.capacity
+        self.lengths = view[offset:offset + 2 * self.capacity].cast('H')
+        self.slots = offset + 2 * self.capacity
+
+    def _create(self, meta, capacity, slot_bytes):
+        encoded = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+        if _header.size + len(encoded) > header_size:
+            raise ValueError(f"Metadata of {self.path} is too long")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(_header.pack(magic, capacity, slot_bytes, len(encoded), 0) + encoded)
+            f.truncate(header_size + capacity * (18 + slot_bytes))
+        os.replace(temporary, self.path)
+
+    def count(self):
+        return struct.unpack_from('<Q', self.map, _count_offset)[0]
+
+    # Function: append
+    # Description: Appends an update of the attribute, overwriting the oldest one when the series is full.
+    # Parameters:
+    #   - attribute: The attribute object.
+    #   - ts (optional): The time of the update (default: now); kept at or after the previous update.
+    # Returns: True if it was recorded, False if its encoding does not fit in a slot.
+    def append(self, attribute, ts=None):
+        count = self.count()
+        index = count % self.capacity
+        ts = time.time() if ts is None else ts
+        if count:
+            ts = max(ts, self.times[(count - 1) % self.capacity])
+        value = attribute.get('value') if isinstance(attribute, dict) else None
+        if (isinstance(attribute, dict) and attribute.get('type') == 'Property' and len(attribute) == 2 and
+                isinstance(value, (int, float)) and not isinstance(value, bool) and float(value) == value and abs(value) < 2 ** 53):
+            self.numbers[index] = value
+            self.lengths[index] = int_sample if isinstance(value, int) else float_sample
+        else:
+            encoded = codec.encode(attribute, 'json')
+            if len(encoded) > self.slot_bytes or len(encoded) >= int_sample:
+                return False
+            start = self.slots + index * self.slot_bytes
+            self.map[start:start + len(encoded)] = encoded
+            self.lengths[index] = len(encoded)
+        self.times[index] = ts
+        struct.pack_into('<Q', self.map, _count_offset, count + 1)
+        return True
+
+    # Function: read
+    # Description: Returns the recorded updates of a time range.
+    # Parameters:
+    #   - start / end (optional): The range [start, end) as POSIX timestamps (default: unbounded).
+    #   - last_n (optional): Only the last N updates of the range.
+    # Returns: List of (timestamp, attribute) tuples, oldest first.
+    def read(self, start=None, end=None, last_n=None):
+        count = self.count()
+        size = min(count, self.capacity)
+        first = count - size
+        timeline = _Timeline(self.times, first, size, self.capacity)
+        low = 0 if start is None else bisect.bisect_left(timeline, start)
+        high = size if end is None else bisect.bisect_left(timeline, end, low)
+        if last_n is not None:
+            low = max(low, high - last_n)
+        records = []
+        for k in range(low, high):
+            index = (first + k) % self.capacity
+            length = self.lengths[index]
+            if length == float_sample:
+                attribute = {'type': 'Property', 'value': self.numbers[index]}
+            elif length == int_sample:
+                attribute = {'type': 'Property', 'value': int(self.numbers[index])}
+            else:
+                slot = self.slots + index * self.slot_bytes
+                try:
+                    attribute = codec.decode(self.map[slot:slot + length])
+                except ValueError:
+                    continue
+            records.append((first + k, self.times[index], attribute))
+        # records overwritten by the recorder while they were read are dropped: the appender rewrites the slot of
+        # sequence count - capacity before it bumps the count, so that one can be torn as well
+        oldest = self.count() - self.capacity
+        return [(ts, attribute) for seq, ts, attribute in records if seq > oldest]
+
+    def close(self):
+        self.times.release()
+        self.numbers.release()
+        self.lengths.release()
+        self.view.release()
+        self.map.close()
+
+
+# Class: TimeSeriesStore
+# Description: The attribute series of a directory, written by one recorder and queried by any process.
+# Parameters:
+#   - directory: The directory of the store (created if missing).
+#   - capacity (optional): Updates kept per attribute (default: 10000).
+#   - slot_bytes (optional): Maximum size of a non-numeric attribute (default: 128 bytes).
+#   - max_open (optional): Series kept mapped by the recorder (default: 256).
+
+class TimeSeriesStore:
+
+    def __init__(self, directory, capacity=default_capacity, slot_bytes=default_slot_bytes, max_open=default_max_open):
+        self.directory = directory
+        self.capacity = capacity
+        self.slot_bytes = slot_bytes
+        self.max_open = max_open
+        self.open_series = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.oversized = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, context, typee, entity_id, attr):
+        return os.path.join(self.directory, _file_name(context), _file_name(typee), _file_name(entity_id), _file_name(attr) + '.ts')
+
+    # Function: record
+    # Description: Appends an attribute update to its series.
+    # Parameters:
+    #   - context / typee / entity_id / attr: The attribute, as in its topic (context with '§').
+    #   - attribute: The attribute object.
+    #   - ts (optional): The time of the update (default: now).
+    # Returns: True if it was recorded.
+    def record(self, context, typee, entity_id, attr, attribute, ts=None):
+        path = self._path(context, typee, entity_id, attr)
+        with self.lock:
+            series = self.open_series.get(path)
+            if series is None:
+                series = AttributeSeries(path, {'context': context, 'type': typee, 'id': entity_id, 'attr': attr},
+                                         self.capacity, self.slot_bytes)
+                self.open_series[path] = series
+                if len(self.open_series) > self.max_open:
+                    self.open_series.popitem(last=False)[1].close()
+            else:
+                self.open_series.move_to_end(path)
+            if series.append(attribute, ts):
+                self.recorded += 1
+                return True
+            self.oversized += 1
+            return False
+
+    # Function: entities
+    # Description: Lists the recorded entities matching a selection.
+    # Parameters:
+    #   - context (optional): Context with '§' (default: '+', every context).
+    #   - types / ids (optional): Lists of entity types / ids (default: every one).
+    #   - id_pattern (optional): Regular expression the ids must match.
+    # Returns: An iterator of (context, type, id, {attr: series file}) tuples, sorted by id within a type.
+    def entities(self, context='+', types=None, ids=None, id_pattern=None):
+        pattern = re.compile(id_pattern) if id_pattern else None
+        contexts = [_file_name(context)] if context != '+' else sorted(_listdir(self.directory))
+        for context_dir in contexts:
+            type_dirs = [_file_name(t) for t in types] if types else sorted(_listdir(os.path.join(self.directory, context_dir)))
+            for type_dir in type_dirs:
+                base = os.path.join(self.directory, context_dir, type_dir)
+                id_dirs = [_file_name(i) for i in ids] if ids else sorted(_listdir(base))
+                for id_dir in id_dirs:
+                    files = {name: os.path.join(base, id_dir, name) for name in _listdir(os.path.join(base, id_dir)) if name.endswith('.ts')}
+                    if not files:
+                        continue
+                    series = AttributeSeries(next(iter(files.values())))
+                    meta = series.meta
+                    series.close()
+                    if pattern is not None and not pattern.fullmatch(meta['id']):
+                        continue
+                    yield meta['context'], meta['type'], meta['id'], files
+
+    def stats(self):
+        with self.lock:
+            return {'recorded': self.recorded, 'oversized': self.oversized, 'open_series': len(self.open_series)}
+
+    def close(self):
+        with self.lock:
+            for series in self.open_series.values():
+                series.close()
+            self.open_series.clear()
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+# Function: temporal_entity
+# Description: Builds the NGSI-LD temporal representation of a recorded entity.
+# Parameters:
+#   - entity_type / entity_id: The entity.
+#   - files: Dictionary of its series files, as returned by TimeSeriesStore.entities.
+#   - attrs (optional): Attributes to return (default: every recorded one).
+#   - start / end / last_n (optional): Time range and last N updates per attribute, as in AttributeSeries.read.
+#   - temporal_values (optional): Use the simplified representation (options=temporalValues).
+# Returns: The entity, None when no attribute has an update in the range.
+
+def temporal_entity(entity_type, entity_id, files, attrs=None, start=None, end=None, last_n=None, temporal_values=False):
+    entity = {'id': entity_id, 'type': entity_type}
+    for path in sorted(files.values()):
+        series = AttributeSeries(path)
+        try:
+            if attrs and series.meta['attr'] not in attrs:
+                continue
+            records = series.read(start, end, last_n)
+            attr = series.meta['attr']
+        finally:
+            series.close()
+        if not records:
+            continue
+        if temporal_values:
+            kind = records[-1][1].get('type', 'Property') if isinstance(records[-1][1], dict) else 'Property'
+            key = 'objects' if kind == 'Relationship' else 'values'
+            entity[attr] = {'type': kind, key: [[a.get('object' if kind == 'Relationship' else 'value') if isinstance(a, dict) else a,
+                                                 _iso(ts)] for ts, a in records]}
+        else:
+            entity[attr] = [dict(a, modifiedAt=_iso(ts)) if isinstance(a, dict) else {'value': a, 'modifiedAt': _iso(ts)}
+                            for ts, a in records]
+    return entity if len(entity) > 2 else None
+
+
+# Function: query_temporal
+# Description: Answers an NGSI-LD temporal query (GET /temporal/entities) from a store.
+# Parameters:
+#   - store: The TimeSeriesStore (or its directory).
+#   - query_string: The query, e.g. "?type=Turbine&attrs=rpm&timerel=after&timeAt=2024-05-01T10:00:00Z&lastN=10".
+#     Parameters: id, idPattern, type, attrs, timerel (before, after, between), timeAt, endTimeAt, lastN,
+#     timeproperty (only modifiedAt, the time ComDeX recorded the update), options=temporalValues, limit.
+#   - HLink (optional): Context of the entities (default: any context).
+#   - sink (optional): Sink receiving the entities (default: print them as indented JSON).
+# Returns: The number of entities delivered, None if the query could not be parsed.
+
+def query_temporal(store, query_string, HLink='', sink=None):
+    if not isinstance(store, TimeSeriesStore):
+        if not os.path.isdir(store):
+            print(f"No time-series store in {store}")
+            return None
+        store = TimeSeriesStore(store)
+    if sink is None:
+        sink = PrettyPrintSink()
+    ids = types = attrs = None
+    id_pattern = timerel = time_at = end_time_at = last_n = None
+    temporal_values = False
+    limit = default_limit
+    for name, value in urllib.parse.parse_qsl(query_string.lstrip('?'), keep_blank_values=True):
+        if name == 'id':
+            ids = value.split(',')
+        elif name == 'idPattern':
+            id_pattern = value
+        elif name == 'type':
+            types = value.split(',')
+        elif name == 'attrs':
+            attrs = set(value.split(','))
+        elif name == 'timerel':
+            timerel = value
+        elif name == 'timeAt':
+            time_at = value
+        elif name == 'endTimeAt':
+            end_time_at = value
+        elif name in ('lastN', 'limit'):
+            try:
+                number = int(value)
+            except ValueError:
+                print(f"{name} must be an integer")
+                return None
+            if number < 1:
+                print(f"{name} must be positive")
+                return None
+            if name == 'lastN':
+                last_n = number
+            else:
+                limit = number
+        elif name == 'timeproperty':
+            if value != 'modifiedAt':
+                print("Only timeproperty=modifiedAt is recorded")
+                return None
+        elif name == 'options':
+            temporal_values = 'temporalValues' in value.split(',')
+        elif name == '':
+            continue
+        else:
+            print(f"Temporal query parameter {name} not recognised")
+            return None
+
+    start = end = None
+    try:
+        if timerel is not None:
+            if timerel not in timerels:
+                print(f"timerel must be one of {', '.join(timerels)}")
+                return None
+            if time_at is None or (timerel == 'between' and end_time_at is None):
+                print("timerel needs timeAt, and endTimeAt for between")
+                return None
+            if timerel == 'before':
+                end = parse_time(time_at)
+            elif timerel == 'after':
+                # after excludes timeAt itself
+                start = parse_time(time_at) + 1e-6
+            else:
+                start, end = parse_time(time_at), parse_time(end_time_at)
+        if id_pattern is not None:
+            re.compile(id_pattern)
+    except ValueError as e:
+        print(f"Invalid temporal query: {e}")
+        return None
+    except re.error as e:
+        print(f"Invalid idPattern: {e}")
+        return None
+
+    context = HLink.replace('/', '§') if HLink else '+'
+    delivered = 0
+    for entity_context, entity_type, entity_id, files in store.entities(context, types, ids, id_pattern):
+        if delivered >= limit:
+            break
+        entity = temporal_entity(entity_type, entity_id, files, attrs, start, end, last_n, temporal_values)
+        if entity is None:
+            continue
+        entity['@context'] = entity_context.replace('§', '/')
+        sink.emit(entity)
+        delivered += 1
+    return delivered
+
+
+# Function: modified_time
+# Description: Reads the time of an update from the temporal values of its envelope.
+# Parameters:
+#   - temporal: The temporal values of the envelope (see codec.unwrap_attribute), or None.
+# Returns: The POSIX timestamp of its last modifiedAt, None when there is none or it cannot be read.
+
+def modified_time(temporal):
+    values = temporal.get('modifiedAt') if isinstance(temporal, dict) else None
+    if isinstance(values, list):
+        values = values[-1] if values else None
+    if not isinstance(values, str):
+        return None
+    try:
+        moment = datetime.datetime.fromisoformat(values.strip().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    # ComDeX writes str(datetime.datetime.now()), the local time of the writer
+    return moment.timestamp()
+
+
+# Class: HistoryRecorder
+# Description: Records the live attribute updates of a broker into a TimeSeriesStore, over a dedicated MQTT session.
+# Retained replays (on subscription and after a reconnect) are not updates and are not recorded. An update is recorded
+# at the modifiedAt of its envelope, or at the time it was received when it has none.
+# Parameters:
+#   - broker: The name or IP address of the broker.
+#   - port: The port number of the broker.
+#   - store: The TimeSeriesStore.
+#   - area (optional): Only record this area (default: '+', every area).
+#   - username / password (optional): MQTT credentials.
+
+class HistoryRecorder:
+
+    def __init__(self, broker, port, store, area='+', username=None, password=None):
+        self.store = store
+        self.area = area
+        self.session = mqttsession.Session(broker, port, username, password)
+        self.handler = None
+        self.skipped = 0
+
+    # Function: start
+    # Description: Connects and subscribes to the entity topics.
+    # Returns: The recorder. Raises ConnectionError if the broker cannot be reached.
+    def start(self):
+        self.session.connect()
+        self.handler = self.session.subscribe(f"{self.area}/entities/#", 1, self._on_message)
+        self.session.wait_subscribed(self.handler, mqttsession.default_connect_timeout)
+        return self
+
+    def _on_message(self, msg):
+        if msg.retain or not msg.payload:
+            return
+        # {area}/entities/{context}/{type}/{node}/{id}/{attr}
+        levels = msg.topic.split('/')
+        if len(levels) != 7 or levels[6].endswith(('_CreatedAt', '_modifiedAt')):
+            return
+        try:
+            attribute, temporal = codec.unwrap_attribute(codec.decode_message(msg))
+            self.store.record(levels[2], levels[3], levels[5], levels[6], attribute, modified_time(temporal))
+        except (ValueError, OSError) as e:
+            self.skipped += 1
+            print(f"Could not record {msg.topic}: {e}")
+
+    def stats(self):
+        return dict(self.store.stats(), skipped=self.skipped)
+
+    def close(self):
+        if self.handler is not None:
+            self.session.unsubscribe(self.handler)
+        self.session.close()
+        self.store.close()
+
+
+def usage():
+    print("\nUsage:")
+    print("python3 timeseries.py [options]\n")
+    print("Records the attribute updates of a ComDeX broker for temporal queries (GET/temporal/entities/).\n")
+    print("Options:")
+    print("-h, --help                Show this help message and exit")
+    print("-b, --broker_address      Specify the address of the MQTT broker of the ComDeX node")
+    print("-p, --port                Specify the port number of the MQTT broker of the ComDeX node")
+    print("-N, --username            MQTT username")
+    print("-S, --password            MQTT password")
+    print("--dir                     Directory of the time-series store")
+    print("--area                    Only record the entities of this area (default: all areas)")
+    print("--capacity                Updates kept per attribute, the oldest are overwritten (default: 10000)")
+    print("--slot_bytes              Maximum encoded size of a non-numeric attribute (default: 128)")
+    print("\nExample:")
+    print("python3 timeseries.py -b localhost -p 1026 --dir /var/lib/comdex/history\n")
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hb:p:N:S:", ["help", "broker_address=", "port=", "username=", "password=", "dir=",
+                                                      "area=", "capacity=", "slot_bytes="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    broker = 'localhost'
+    port = 1026
+    username = None
+    password = None
+    directory = None
+    area = '+'
+    capacity = default_capacity
+    slot_bytes = default_slot_bytes
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage(); sys.exit()
+        elif opt in ("-b", "--broker_address"):
+            broker = arg
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-N", "--username"):
+            username = arg
+        elif opt in ("-S", "--password"):
+            password = arg
+        elif opt == "--dir":
+            directory = arg
+        elif opt == "--area":
+            area = arg
+        elif opt == "--capacity":
+            capacity = int(arg)
+        elif opt == "--slot_bytes":
+            slot_bytes = int(arg)
+    if directory is None:
+        print("Missing --dir")
+        usage()
+        sys.exit(2)
+
+    recorder = HistoryRecorder(broker, port, TimeSeriesStore(directory, capacity, slot_bytes), area, username, password)
+    try:
+        recorder.start()
+    except ConnectionError as e:
+        print(f"Could not connect to the broker: {e}")
+        sys.exit(2)
+    print(f"Recording the attribute updates of {broker}:{port} into {directory}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(recorder.stats()))
+    recorder.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])